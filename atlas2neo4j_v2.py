@@ -1,14 +1,97 @@
 #!/usr/bin/env python
 
-from __future__ import print_function
-
 import sys
 import logging
+from collections import OrderedDict
+
+_graph_db = None  # py2neo GraphDatabaseService, connected by graph()
+
+
+def graph():
+    """ the Neo4j database, py2neo is imported and connected at the first call """
+    global _graph_db
+    if _graph_db is None:
+        from py2neo import neo4j
+        _graph_db = neo4j.GraphDatabaseService()
+        # _graph_db = neo4j.Graph() #DatabaseService()
+    return _graph_db
+
+
+def __getattr__(name):
+    """ graph_db connects when it is first used, eg. from atlas2neo4j_v2 import graph_db """
+    if name == 'graph_db':
+        return graph()
+    raise AttributeError("module %r has no attribute %r" % (__name__, name))
+
+
+def node(*args, **kwargs):
+    """ py2neo.node, imported at the first call """
+    from py2neo import node as py2neo_node
+    return py2neo_node(*args, **kwargs)
+
+
+def rel(*args, **kwargs):
+    """ py2neo.rel, imported at the first call """
+    from py2neo import rel as py2neo_rel
+    return py2neo_rel(*args, **kwargs)
+
+# labels which get a (label, volId) index at startup, others when first looked up
+INDEXED_LABELS = ("physvol", "PhysVol", "FullPhysVol", "LogVol", "Shape", "Material", "NameTag",
+                  "Transform", "AlignableTransform", "SerialTransformer", "SerialDenominator", "Function")
+NODE_CACHE_SIZE = 100000
+
+
+class NodeCache(object):
+    """ (label, volId) -> node, least recently used nodes are dropped first """
+
+    def __init__(self, max_size=NODE_CACHE_SIZE):
+        self.max_size = max_size
+        self.nodes = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
 
-from py2neo import neo4j, node, rel
+    def get(self, label, volId):
+        key = (label, volId)
+        if key in self.nodes:
+            self.nodes.move_to_end(key)
+            self.hits += 1
+            return self.nodes[key]
+        self.misses += 1
+        return None
 
-graph_db = neo4j.GraphDatabaseService()
-# graph_db = neo4j.Graph() #DatabaseService()
+    def put(self, label, volId, vol_node):
+        key = (label, volId)
+        self.nodes[key] = vol_node
+        self.nodes.move_to_end(key)
+        if len(self.nodes) > self.max_size:
+            self.nodes.popitem(last=False)
+            self.evictions += 1
+
+    def clear(self):
+        self.nodes.clear()
+
+    def stats(self):
+        return {'entries': len(self.nodes), 'hits': self.hits, 'misses': self.misses, 'evictions': self.evictions}
+
+
+NODE_CACHE = NodeCache()
+_indexed = set()
+
+
+def create_index(label):
+    """ schema index on (label, volId), once per label """
+    if label in _indexed:
+        return
+    if "volId" not in graph().schema.get_indexes(label):
+        logging.debug("creating index on :%s(volId)", label)
+        graph().schema.create_index(label, "volId")
+    _indexed.add(label)
+
+
+def create_indexes(labels=INDEXED_LABELS):
+    for label in labels:
+        create_index(label)
 
 
 class Node(object):
@@ -22,8 +105,9 @@ class Node(object):
         vol_node = cls.getNodeFromDB(volId)
         if not vol_node:
             logging.debug("creating", cls._label, "node with Id:", volId)
-            vol_node, = graph_db.create( node(volId=volId) )
+            vol_node, = graph().create( node(volId=volId) )
             vol_node.add_labels( cls._label )
+            NODE_CACHE.put(cls._label, volId, vol_node)
         else:
             logging.debug("node with label", cls._label, "with volId:", volId, "is stored already in the DB. Using that.")
 
@@ -33,14 +117,15 @@ class Node(object):
             vol_child = cls.getNodeFromDB(nodeId=childId)
             if not vol_child:
                 logging.debug("Creating node", childId, "and the relationship", volId, "->", childId)
-                vol_child, _ = graph_db.create(node(volId=childId), rel(vol_node, "CHILD", 0))
+                vol_child, _ = graph().create(node(volId=childId), rel(vol_node, "CHILD", 0))
                 vol_child.add_labels( cls._label )
+                NODE_CACHE.put(cls._label, childId, vol_child)
             else:
                 logging.debug("Node", childId, "stored already")
                 # check if a parent->child relationship with this child node exists already
-                rels = list(graph_db.match(start_node=vol_node, end_node=vol_child, rel_type="CHILD"))
+                rels = list(graph().match(start_node=vol_node, end_node=vol_child, rel_type="CHILD"))
                 if len(rels) == 0:
-                    graph_db.create(rel(vol_node, "CHILD", vol_child))
+                    graph().create(rel(vol_node, "CHILD", vol_child))
                 else:
                     logging.debug("Relationship", volId, "->", childId, "stored already")
                     pass
@@ -56,9 +141,10 @@ class Node(object):
         if not vol_node:
             # logging.debug("creating", cls._label, "node with Id:", volId)
             logging.debug("creating", volType, "node with Id:", volId)
-            vol_node, = graph_db.create( node(volId=volId) )
+            vol_node, = graph().create( node(volId=volId) )
             # vol_node.add_labels( cls._label )
             vol_node.add_labels( volType )
+            NODE_CACHE.put(volType, volId, vol_node)
         else:
             # logging.debug("node with label", cls._label, "with volId:", volId, "is stored already in the DB. Using that.")
             logging.debug("parent node with label", volType, "with volId:", volId, "is stored already in the DB. Using that.")
@@ -73,9 +159,10 @@ class Node(object):
         if not vol_node:
             # logging.debug("creating", cls._label, "node with Id:", volId)
             logging.debug("creating", parentType, "node with Id:", volId)
-            vol_node, = graph_db.create( node(volId=volId) )
+            vol_node, = graph().create( node(volId=volId) )
             # vol_node.add_labels( cls._label )
             vol_node.add_labels( parentType )
+            NODE_CACHE.put(parentType, volId, vol_node)
         else:
             # logging.debug("node with label", cls._label, "with volId:", volId, "is stored already in the DB. Using that.")
             logging.debug( " ".join( ["parent node with label", parentType, "with volId:", str(volId), "is stored already in the DB. Using that."] ))
@@ -86,15 +173,16 @@ class Node(object):
         vol_child = cls.getNodeFromDB(childId, childType)
         if not vol_child:
             logging.debug( " ".join( ["Creating child node", str(childId), "and the relationship", str(volId), "->", str(childId) ] ) )
-            vol_child, _ = graph_db.create(node(volId=childId, position=position), rel(vol_node, "CHILD", 0))
+            vol_child, _ = graph().create(node(volId=childId, position=position), rel(vol_node, "CHILD", 0))
             # vol_child.add_labels( cls._label )
             vol_child.add_labels( childType )
+            NODE_CACHE.put(childType, childId, vol_child)
         else:
             logging.debug("Child node", childId, "of type", childType, "stored already")
             # check if a parent->child relationship with this child node exists already
-            rels = list(graph_db.match(start_node=vol_node, end_node=vol_child, rel_type="CHILD"))
+            rels = list(graph().match(start_node=vol_node, end_node=vol_child, rel_type="CHILD"))
             if len(rels) == 0:
-                graph_db.create(rel(vol_node, "CHILD", vol_child))
+                graph().create(rel(vol_node, "CHILD", vol_child))
             else:
                 logging.debug("Relationship", volId, "->", childId, "stored already")
                 pass
@@ -110,9 +198,10 @@ class Node(object):
         if not vol_node:
             # logging.debug("creating", cls._label, "node with Id:", volId)
             logging.debug( " ".join(["creating", volType, "node with Id:", str(volId)]) )
-            vol_node, = graph_db.create( node(volId=volId) )
+            vol_node, = graph().create( node(volId=volId) )
             # vol_node.add_labels( cls._label )
             vol_node.add_labels( volType )
+            NODE_CACHE.put(volType, volId, vol_node)
         else:
             # logging.debug("node with label", cls._label, "with volId:", volId, "is stored already in the DB. Using that.")
             logging.debug( "".join( ["parent node with label", volType, "with volId:", str(volId), "is stored already in the DB. Using that."]) )
@@ -125,9 +214,9 @@ class Node(object):
         vol_child = cls.getNodeFromDB(childId, childType)
         if (vol_parent and vol_child):
             # verify if this relation exists already
-            relation = list( graph_db.match(start_node=vol_parent, end_node=vol_child, rel_type=relString) )
+            relation = list( graph().match(start_node=vol_parent, end_node=vol_child, rel_type=relString) )
             if ( (not relation and unique) or (relation and not unique) ):
-                graph_db.create( rel( vol_parent, relString, vol_child) )
+                graph().create( rel( vol_parent, relString, vol_child) )
             else:
                 logging.debug( " ".join( ["Relationship", relString, "between parent ", parentType, str(parentId), "and child", childType, str(childId), "exists already. Skipping..."]) )
         else:
@@ -156,6 +245,7 @@ class Node(object):
             sys.exit()
         for label in labels:
             node.add_labels( label )
+            NODE_CACHE.put(label, volId, node)
 
 
     @classmethod
@@ -164,23 +254,28 @@ class Node(object):
 
     @classmethod
     def getNodeFromDB(cls, nodeId, nodeType=_label):
-        # vol_node_gen = graph_db.find(cls._label, "volId", nodeId)
-        vol_node_gen = graph_db.find(nodeType, "volId", nodeId)
-        if (vol_node_gen):
-            vol_node_list = list(vol_node_gen)
-        else:
-            logging.error("ERROR!! Node %s %s not found in the DB!! Aborting...", nodeId, nodeType)
-            sys.exit()
+        vol_node = NODE_CACHE.get(nodeType, nodeId)
+        if vol_node is not None:
+            return vol_node
+        create_index(nodeType)
+        # vol_node_gen = graph().find(cls._label, "volId", nodeId)
+        vol_node_list = list(graph().find(nodeType, "volId", nodeId))
         if len(vol_node_list) > 1:
             logging.warning("WARNING!!! Found more than one %s node with Id: %s", nodeType, nodeId)
         elif len(vol_node_list) == 1:
             vol_node = vol_node_list[0]
             # logging.debug("Found: %s", vol_node )
+            NODE_CACHE.put(nodeType, nodeId, vol_node)
             return vol_node
         else:
             # print("No", cls._label, "node found with Id:", nodeId, " in the DB")
             return None
 
+    @classmethod
+    def cache_stats(cls):
+        """ hits, misses and evictions of the (label, volId) node cache """
+        return NODE_CACHE.stats()
+
 
     def __init__(self, node):
         logging.debug(node)
@@ -208,13 +303,17 @@ if __name__ == "__main__":
         print("       {0} list".format(app))
         sys.exit()
     method = sys.argv[1]
+    if method in ("add", "list"):
+        create_indexes()
     if method == "add":
         print("created vol with volId", Node.create(*sys.argv[2:]))
+        print("node cache:", Node.cache_stats())
     elif method == "list":
         for physvol in Node.get_all():
             print(physvol)
     elif method == "clear":
-        graph_db.clear()
+        graph().clear()
+        NODE_CACHE.clear()
         print('DB cleared')
     else:
         print(method + " : Unknown command")
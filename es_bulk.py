@@ -0,0 +1,164 @@
+"""
+Streaming bulk indexing into Elasticsearch.
+
+Documents are added one by one, cut into chunks by count and by size,
+and a bounded queue hands the chunks to a few sender threads, so the
+traversal keeps running while earlier chunks are being indexed and blocks
+only when all senders are busy and the queue is full.
+
+Chunks failing with a connection error or 429 (too many requests) are
+retried with exponential backoff, as are single documents rejected with 429.
+Documents rejected for any other reason, or still failing after the last
+retry, are written to a dead-letter NDJSON file together with the error.
+"""
+
+import json
+import time
+import queue
+import threading
+import logging
+
+from elasticsearch import exceptions as es_exceptions
+
+META_FIELDS = ('_index', '_type', '_id', '_routing')
+
+
+def bulk_lines(doc):
+    """ action and source lines of a document, meta fields go to the action """
+    source = {k: v for k, v in doc.items() if k not in META_FIELDS}
+    op_type = source.pop('_op_type', 'index')
+    action = {op_type: {k: doc[k] for k in META_FIELDS if k in doc}}
+    if op_type == 'delete':
+        return json.dumps(action) + '\n'
+    return json.dumps(action) + '\n' + json.dumps(source) + '\n'
+
+
+class BulkIndexer():
+    """ es - Elasticsearch client
+    chunk_docs, chunk_bytes - a chunk is sent when either is reached
+    threads - number of bulk requests in flight
+    queue_size - chunks waiting for a sender before add() blocks
+    max_retries, backoff, max_backoff - retrying of 429s and connection errors, in seconds
+    dead_letter - file name for the documents that could not be indexed
+    """
+    def __init__(self, es, chunk_docs=1000, chunk_bytes=10 * 1024 * 1024, threads=4, queue_size=8,
+                 max_retries=8, backoff=1.0, max_backoff=60.0, dead_letter='dead_letter.ndjson',
+                 request_timeout=60):
+        self.es = es
+        self.chunk_docs = chunk_docs
+        self.chunk_bytes = chunk_bytes
+        self.max_retries = max_retries
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self.dead_letter = dead_letter
+        self.request_timeout = request_timeout
+
+        self.chunk = []  # (doc, lines)
+        self.chunk_size = 0
+        self.queue = queue.Queue(maxsize=queue_size)
+        self.lock = threading.Lock()
+        self.dead_letter_file = None
+        self.stats = {'docs': 0, 'indexed': 0, 'failed': 0, 'retries': 0, 'chunks': 0, 'bytes': 0}
+        self.start = time.time()
+        self.threads = [threading.Thread(target=self.sender, daemon=True) for _ in range(threads)]
+        for thread in self.threads:
+            thread.start()
+
+    def add(self, doc):
+        """ queues a document, blocks while the senders can't keep up """
+        lines = bulk_lines(doc)
+        size = len(lines.encode('utf-8'))
+        if self.chunk and (len(self.chunk) >= self.chunk_docs or self.chunk_size + size > self.chunk_bytes):
+            self.flush()
+        self.chunk.append((doc, lines))
+        self.chunk_size += size
+        self.stats['docs'] += 1
+
+    def flush(self):
+        """ hands the current chunk to the senders """
+        if self.chunk:
+            self.queue.put(self.chunk)
+            self.chunk = []
+            self.chunk_size = 0
+
+    def close(self):
+        """ sends what is left, waits for the senders and returns the stats """
+        self.flush()
+        for _ in self.threads:
+            self.queue.put(None)
+        for thread in self.threads:
+            thread.join()
+        if self.dead_letter_file is not None:
+            self.dead_letter_file.close()
+        elapsed = time.time() - self.start
+        self.stats['seconds'] = round(elapsed, 3)
+        self.stats['docs_per_s'] = round(self.stats['indexed'] / elapsed, 1) if elapsed > 0 else 0.0
+        self.stats['mb_per_s'] = round(self.stats['bytes'] / elapsed / 1e6, 3) if elapsed > 0 else 0.0
+        return self.stats
+
+    def count(self, key, n=1):
+        with self.lock:
+            self.stats[key] += n
+
+    def sender(self):
+        """ sender thread: indexes chunks from the queue until it gets None """
+        while True:
+            chunk = self.queue.get()
+            if chunk is None:
+                return
+            try:
+                self.send(chunk)
+            except Exception as e:  # never lose a chunk because of a bug in error handling
+                logging.exception('bulk sender failed')
+                self.reject(chunk, 'sender error: %s' % e)
+
+    def send(self, chunk):
+        """ one chunk, with retries of the retryable failures """
+        attempt = 0
+        while chunk:
+            body = ''.join(lines for (_, lines) in chunk)
+            try:
+                res = self.es.bulk(body=body, request_timeout=self.request_timeout)
+            except (es_exceptions.ConnectionError, es_exceptions.ConnectionTimeout) as e:
+                error = 'connection error: %s' % e
+                retry = chunk
+            except es_exceptions.TransportError as e:
+                if e.status_code != 429:
+                    self.reject(chunk, 'transport error %s: %s' % (e.status_code, e.error))
+                    return
+                error = 'too many requests'
+                retry = chunk
+            else:
+                self.count('chunks')
+                self.count('bytes', len(body.encode('utf-8')))
+                retry = []
+                error = None
+                for ((doc, lines), item) in zip(chunk, res['items']):
+                    result = list(item.values())[0]
+                    status = result.get('status', 500)
+                    if status < 300 or (status == 404 and 'delete' in item):
+                        self.count('indexed')
+                    elif status == 429:
+                        retry.append((doc, lines))
+                        error = 'too many requests'
+                    else:
+                        self.reject([(doc, lines)], result.get('error'))
+            if not retry:
+                return
+            attempt += 1
+            if attempt > self.max_retries:
+                self.reject(retry, error)
+                return
+            self.count('retries')
+            time.sleep(min(self.max_backoff, self.backoff * 2 ** (attempt - 1)))
+            chunk = retry
+
+    def reject(self, chunk, error):
+        """ writes documents that can't be indexed to the dead-letter file """
+        with self.lock:
+            if self.dead_letter_file is None:
+                self.dead_letter_file = open(self.dead_letter, 'a')
+            for (doc, _) in chunk:
+                self.dead_letter_file.write(json.dumps({'error': error, 'doc': doc}) + '\n')
+            self.dead_letter_file.flush()
+            self.stats['failed'] += len(chunk)
@@ -0,0 +1,325 @@
+#!/usr/bin/env python
+"""
+Benchmarks on synthetic geometries (see geo_synth.py) at several scales:
+    geo_bench.py --scales small medium --report bench.json
+    geo_bench.py --scales medium --baseline bench.json
+The second run compares to an earlier report and exits with 1 if any
+benchmark got slower by more than --tolerance.
+
+Per scale:
+    generate          writing the synthetic DB
+    snapshot          compiling it with geo_snapshot
+    gm2json           the full export in this process with gm2json.open_geometry, one result
+                      per mode (orm, sql, preload, snapshot), the document count is checked
+    gm2json_process   the full export by the gm2json.py command into the null sink, the
+                      interpreter start and imports included, one result per mode
+                      (the ones above, workers and pipeline)
+    sink              the exported documents through every sink (null, ndjson, gzip, zstd, normalized ndjson)
+    transforms        synthetic micro-benchmark of geo_transforms.place on the Transforms rows
+    serial            evaluating the serial transformer functions for all copies
+    shapes            parsing the Shapes rows
+    neo4j_csv         neo4j_bulk CSV files for neo4j-admin import
+    neo4j             neo4j_bulk into the atlas2neo4j_v2 database, only with --neo4j
+
+The report is JSON: the environment, the generator options and DB stats of
+every scale, and a list of results with seconds (the best of --repeat runs),
+items and items per second.
+"""
+
+import os
+import sys
+import json
+import time
+import shutil
+import sqlite3
+import platform
+import tempfile
+import argparse
+import subprocess
+
+import numpy as np
+
+import gm2json
+import geo_synth
+import geo_sinks
+import geo_shapes
+import geo_snapshot
+import geo_normalize
+import geo_transforms
+import neo4j_bulk
+
+SCALES = {
+    'small': {'depth': 3, 'fanout': 4, 'copies': 4},
+    'medium': {'depth': 4, 'fanout': 6, 'copies': 8},
+    'large': {'depth': 5, 'fanout': 8, 'copies': 8},
+}
+MODES = ('orm', 'sql', 'preload', 'snapshot', 'workers', 'pipeline')
+IN_PROCESS = {'orm': {'orm': True}, 'sql': {}, 'preload': {'preload': True}, 'snapshot': {}}  # open_geometry options
+GM2JSON = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'gm2json.py')
+
+
+def best_time(function, repeat):
+    """ (best seconds, result of the last call) of repeat calls """
+    best = None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        result = function()
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+    return (best, result)
+
+
+class Bench():
+    """ runs the benchmarks of one scale in workdir and collects the results """
+    def __init__(self, scale, options, workdir, repeat=3, workers=4, neo4j=False):
+        self.scale = scale
+        self.options = options
+        self.workdir = workdir
+        self.repeat = repeat
+        self.workers = workers
+        self.neo4j = neo4j
+        self.db = os.path.join(workdir, '%s.db' % scale)
+        self.results = []
+        self.stats = {}
+
+    def result(self, benchmark, seconds, items, unit, **extra):
+        res = {'scale': self.scale, 'benchmark': benchmark, 'seconds': round(seconds, 6), 'items': items,
+               'rate': round(items / seconds, 1) if seconds > 0 else None, 'unit': unit}
+        res.update(extra)
+        self.results.append(res)
+        print(json.dumps(res))
+        return res
+
+    def run(self, modes=MODES):
+        self.generate()
+        self.snapshot()
+        for mode in modes:
+            if mode in IN_PROCESS:
+                self.gm2json(mode)
+            self.gm2json_process(mode)
+        self.sinks()
+        self.transforms()
+        self.serial()
+        self.shapes()
+        self.neo4j_csv()
+        if self.neo4j:
+            self.neo4j_cypher()
+        return self.results
+
+    def generate(self):
+        def write():
+            return geo_synth.GeometryGenerator(**self.options).write(self.db)
+        (seconds, self.stats) = best_time(write, 1)
+        rows = sum(v for (k, v) in self.stats.items() if k[0].isupper())
+        self.result('generate', seconds, rows, 'rows/s')
+
+    def snapshot(self):
+        path = os.path.join(self.workdir, '%s.snap' % self.scale)
+        (seconds, stats) = best_time(lambda: geo_snapshot.compile_snapshot(self.db, path), self.repeat)
+        self.result('snapshot', seconds, stats['rows'] + stats['children'], 'rows/s', bytes=stats['bytes'])
+
+    def check_documents(self, mode, docs):
+        if docs != self.stats['documents']:
+            raise RuntimeError('gm2json %s made %d documents, expected %d' % (mode, docs, self.stats['documents']))
+
+    def gm2json(self, mode):
+        """ full export in this process, the documents of Geometry.documents are counted """
+        source = os.path.join(self.workdir, '%s.snap' % self.scale) if mode == 'snapshot' else self.db
+
+        def export():
+            with gm2json.open_geometry(source, **IN_PROCESS[mode]) as geometry:
+                docs = sum(1 for _ in geometry.documents())
+                return (docs, geometry.stats())
+        (seconds, (docs, summary)) = best_time(export, self.repeat)
+        self.check_documents(mode, docs)
+        self.result('gm2json', seconds, docs, 'docs/s', mode=mode, timers=summary['timers'])
+
+    def gm2json_process(self, mode):
+        """ full export by the command into the null sink, the run summary is read back from --stats """
+        source = self.db
+        args = ['-s', 'null']
+        if mode == 'orm':
+            args.append('--orm')
+        elif mode == 'preload':
+            args.append('-p')
+        elif mode == 'snapshot':
+            source = os.path.join(self.workdir, '%s.snap' % self.scale)
+        elif mode == 'workers':
+            args += ['-p', '-w', str(self.workers)]
+        elif mode == 'pipeline':
+            args += ['-p', '--pipeline']
+        summary_path = os.path.join(self.workdir, 'gm2json.json')
+        args += ['--stats', summary_path]
+
+        def export():
+            with open(os.devnull, 'w') as out:
+                subprocess.check_call([sys.executable, GM2JSON, '-i', source] + args, stdout=out,
+                                      stderr=subprocess.DEVNULL)
+            with open(summary_path) as f:
+                return json.load(f)
+        (seconds, summary) = best_time(export, self.repeat)
+        docs = summary['sink']['docs']
+        self.check_documents(mode, docs)
+        self.result('gm2json_process', seconds, docs, 'docs/s', mode=mode, timers=summary['timers'])
+
+    def documents(self):
+        """ the exported documents, written once by gm2json """
+        path = os.path.join(self.workdir, '%s.ndjson' % self.scale)
+        if not os.path.exists(path):
+            with open(os.devnull, 'w') as out:
+                subprocess.check_call([sys.executable, GM2JSON, '-i', self.db, '-p', '-s', 'ndjson', '-o', path],
+                                      stdout=out, stderr=subprocess.DEVNULL)
+        return list(geo_sinks.read_documents(path))
+
+    def sinks(self):
+        docs = self.documents()
+        kinds = [('null', None), ('ndjson', None), ('ndjson', 'gzip')]
+        try:
+            import zstandard
+            kinds.append(('ndjson', 'zstd'))
+        except ImportError:
+            pass
+        for (kind, compression) in kinds:
+            path = os.path.join(self.workdir, 'sink.ndjson')
+
+            def write():
+                sink = geo_sinks.open_sink(kind, path, compression)
+                for doc in docs:
+                    sink.write(doc)
+                return sink.close()
+            (seconds, stats) = best_time(write, self.repeat)
+            self.result('sink', seconds, len(docs), 'docs/s', mode=compression or kind,
+                        bytes=stats.get('file_bytes'))
+
+        def write_normalized():
+            sink = geo_normalize.open_normalizing_sink('ndjson', os.path.join(self.workdir, 'sink.ndjson'))
+            for doc in docs:
+                sink.write(doc)
+            return sink.close()
+        (seconds, stats) = best_time(write_normalized, self.repeat)
+        self.result('sink', seconds, len(docs), 'docs/s', mode='normalized',
+                    bytes=stats['file_bytes'] + sum(stats['%s_sink' % k]['file_bytes'] for k in geo_normalize.REF_KINDS))
+
+    def transforms(self):
+        """ synthetic micro-benchmark of geo_transforms.place: every fanout-th row of
+        the Transforms table is the parent of the group of fanout rows it starts.
+        These are not the world transforms of the traversal, the gm2json timers
+        have those.
+        """
+        snap = geo_snapshot.Snapshot(os.path.join(self.workdir, '%s.snap' % self.scale))
+        locals_ = geo_transforms.from_rows(snap.transform_rows('Transforms'))
+        fanout = max(self.options.get('fanout', 4), 1)
+        parents = locals_[::fanout]
+
+        def fold():
+            for (k, parent) in enumerate(parents):
+                geo_transforms.place(parent, locals_[k * fanout:(k + 1) * fanout])
+        (seconds, _) = best_time(fold, self.repeat)
+        self.result('transforms', seconds, len(locals_), 'matrices/s')
+
+    def serial(self):
+        copies = self.options.get('copies', 8)
+        functions = [f % 0.1 for f in geo_synth.FUNCTIONS]
+
+        def evaluate():
+            for _ in range(100):
+                for function in functions:
+                    geo_transforms.serial_transforms(function, copies)
+        (seconds, _) = best_time(evaluate, self.repeat)
+        self.result('serial', seconds, 100 * len(functions) * copies, 'copies/s')
+
+    def shapes(self):
+        db = sqlite3.connect(self.db)
+        rows = dict((row[0], (row[1], row[2])) for row in db.execute('SELECT id, type, parameters FROM Shapes'))
+        db.close()
+
+        def parse():
+            parser = geo_shapes.ShapeParser(rows.get, lambda i: np.eye(4))
+            for shape_id in rows:
+                parser.parse(shape_id)
+        (seconds, _) = best_time(parse, self.repeat)
+        self.result('shapes', seconds, len(rows), 'shapes/s')
+
+    def neo4j_csv(self):
+        directory = os.path.join(self.workdir, 'csv')
+
+        def load():
+            return neo4j_bulk.load(neo4j_bulk.GeometryReader(self.db), neo4j_bulk.CsvWriter(directory))
+        (seconds, stats) = best_time(load, self.repeat)
+        self.result('neo4j_csv', seconds, stats['nodes'] + stats['relationships'], 'entities/s')
+
+    def neo4j_cypher(self):
+        from atlas2neo4j_v2 import graph
+        graph_db = graph()
+        graph_db.clear()
+        (seconds, stats) = best_time(lambda: neo4j_bulk.load(neo4j_bulk.GeometryReader(self.db),
+                                                             neo4j_bulk.CypherWriter(graph_db)), 1)
+        self.result('neo4j', seconds, stats.get('nodes', 0) + stats.get('relationships', 0), 'entities/s')
+
+
+def environment():
+    """ where the report was made """
+    try:
+        commit = subprocess.check_output(['git', 'rev-parse', 'HEAD'], cwd=os.path.dirname(GM2JSON),
+                                         stderr=subprocess.DEVNULL).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        commit = None
+    return {'time': time.strftime('%Y-%m-%dT%H:%M:%S'), 'host': platform.node(), 'platform': platform.platform(),
+            'python': platform.python_version(), 'numpy': np.__version__, 'cpus': os.cpu_count(), 'commit': commit}
+
+
+def regressions(results, baseline, tolerance):
+    """ results slower than the same (scale, benchmark, mode) of a baseline report by more than tolerance """
+    def key(res):
+        return (res['scale'], res['benchmark'], res.get('mode'))
+    before = dict((key(res), res) for res in baseline['results'])
+    slower = []
+    for res in results:
+        old = before.get(key(res))
+        if old and old['seconds'] > 0 and res['seconds'] > old['seconds'] * (1.0 + tolerance):
+            slower.append({'scale': res['scale'], 'benchmark': res['benchmark'], 'mode': res.get('mode'),
+                           'seconds': res['seconds'], 'baseline': old['seconds'],
+                           'ratio': round(res['seconds'] / old['seconds'], 3)})
+    return slower
+
+
+if __name__ == '__main__':
+    PARSER = argparse.ArgumentParser(description='Benchmarks the geometry tools on synthetic geometries.')
+    PARSER.add_argument('--scales', nargs='+', choices=sorted(SCALES), default=['small', 'medium'],
+                        help='generator presets to run')
+    PARSER.add_argument('--modes', nargs='+', choices=MODES, default=list(MODES), help='gm2json modes to time')
+    PARSER.add_argument('--repeat', type=int, default=3, help='runs of every benchmark, the best one counts')
+    PARSER.add_argument('--workers', type=int, default=4, help='processes of the gm2json workers mode')
+    PARSER.add_argument('--seed', type=int, default=1, help='random seed of the generator')
+    PARSER.add_argument('--neo4j', action='store_true', help='also load into Neo4j (needs py2neo and a server)')
+    PARSER.add_argument('--report', help='write the JSON report to this file')
+    PARSER.add_argument('--baseline', help='earlier report to compare to')
+    PARSER.add_argument('--tolerance', type=float, default=0.2, help='allowed slowdown against the baseline')
+    PARSER.add_argument('--workdir', help='keep the generated files here instead of a temporary directory')
+    ARGS = PARSER.parse_args()
+
+    WORKDIR = ARGS.workdir or tempfile.mkdtemp(prefix='geo_bench')
+    if not os.path.isdir(WORKDIR):
+        os.makedirs(WORKDIR)
+    REPORT = {'version': 1, 'environment': environment(), 'repeat': ARGS.repeat, 'scales': {}, 'results': []}
+    try:
+        for SCALE in ARGS.scales:
+            OPTIONS = dict(SCALES[SCALE], seed=ARGS.seed)
+            BENCH = Bench(SCALE, OPTIONS, WORKDIR, ARGS.repeat, ARGS.workers, ARGS.neo4j)
+            REPORT['results'] += BENCH.run(ARGS.modes)
+            REPORT['scales'][SCALE] = {'options': OPTIONS, 'db': BENCH.stats}
+    finally:
+        if not ARGS.workdir:
+            shutil.rmtree(WORKDIR)
+
+    if ARGS.report:
+        with open(ARGS.report, 'w') as f:
+            json.dump(REPORT, f, indent=1)
+        print('report:', ARGS.report)
+    if ARGS.baseline:
+        with open(ARGS.baseline) as f:
+            SLOWER = regressions(REPORT['results'], json.load(f), ARGS.tolerance)
+        for RES in SLOWER:
+            print('slower:', json.dumps(RES))
+        if SLOWER:
+            sys.exit(1)
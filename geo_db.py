@@ -0,0 +1,295 @@
+#!/usr/bin/env python
+"""
+Read only access to a GeoModel SQLite file with the sqlite3 module.
+
+The ORM of gm2json builds a mapped object and goes through the identity
+map for every row it reads. GeometryDB returns rows as named tuples with
+the same attributes and as_dict(), as plain tuples, or whole tables as
+numpy structured arrays:
+    db = GeometryDB('geometry_atlas.db')
+    db.row('LogVols', 12)              # LogVolsRow(id=12, name='BLM Module', shape=..., material=...)
+    db.rows('Shapes', [3, 5, 8])       # {id: row}, one statement for up to BATCH_IDS ids
+    db.children(1, 1)                  # (id, parentId, childTable, childId, position), by position
+    db.array('Materials')              # structured array, one field per column
+The SQL of every kind of lookup is built once and stays prepared in the
+statement cache of the connection, a lookup only binds its parameters.
+The file is opened read only (mode=ro) with a large page cache and memory
+mapped I/O. Every thread gets a connection of its own, SQLite connections
+belong to the thread that opened them.
+
+GeoModel files have no index on ChildrenPositions, so the children of a
+volume are found by a scan of the table. The file itself is never changed:
+with_indexes() copies it next to the original, creates the indexes in the
+copy (geometry_atlas.indexed.db) and reuses it while the original is older:
+    db = GeometryDB(with_indexes('geometry_atlas.db'))
+From the command line:
+    geo_db.py geometry_atlas.db --index
+"""
+
+import os
+import json
+import time
+import sqlite3
+import logging
+import argparse
+import threading
+import collections
+
+import numpy as np
+
+CACHE_MB = 256  # page cache of every connection
+MMAP_MB = 1024  # memory mapped part of the file
+STATEMENTS = 128  # prepared statements kept per connection
+BATCH_IDS = 256  # most ids bound to one statement, below the 999 variables of old SQLite versions
+INDEXES = {'ChildrenPositions_parent': ('ChildrenPositions', ('parentTable', 'parentId', 'position')),
+           'ChildrenPositions_child': ('ChildrenPositions', ('childTable', 'childId'))}
+CHILDREN_COLUMNS = ('id', 'parentId', 'childTable', 'childId', 'position')
+
+
+def row_class(table_name, columns):
+    """ named tuple of the rows of a table, used like the mapped ORM objects:
+    columns are attributes, as_dict() returns them all
+    """
+    base = collections.namedtuple(table_name + 'Row', columns, rename=True)
+    return type(base.__name__, (base,), {
+        '__slots__': (), '__tablename__': table_name, '_columns': tuple(columns),
+        'as_dict': lambda self: dict(zip(self._columns, self))})
+
+
+def indexed_path(path):
+    """ working copy with the indexes, geometry_atlas.db -> geometry_atlas.indexed.db """
+    (head, ext) = os.path.splitext(path)
+    return '%s.indexed%s' % (head, ext or '.db')
+
+
+def missing_indexes(db):
+    """ names of INDEXES no index of the connected DB starts with """
+    existing = {}  # table -> [columns of an index]
+    for (name, (table, _)) in INDEXES.items():
+        if table in existing:
+            continue
+        existing[table] = []
+        for row in db.execute('PRAGMA index_list("%s")' % table).fetchall():
+            info = db.execute('PRAGMA index_info("%s")' % row[1]).fetchall()
+            existing[table].append(tuple(r[2] for r in sorted(info)))
+    tables = set(r[0] for r in db.execute("SELECT name FROM sqlite_master WHERE type='table'"))
+    return sorted(name for (name, (table, columns)) in INDEXES.items()
+                  if table in tables and not any(cols[:len(columns)] == columns for cols in existing[table]))
+
+
+def with_indexes(path, output=None):
+    """ path itself if it has the INDEXES, otherwise a working copy that has them,
+    made once and made again when path is newer than the copy
+    """
+    db = sqlite3.connect('file:%s?mode=ro' % path, uri=True)
+    try:
+        missing = missing_indexes(db)
+    finally:
+        db.close()
+    if not missing:
+        return path
+    output = output or indexed_path(path)
+    if os.path.exists(output) and os.path.getmtime(output) >= os.path.getmtime(path):
+        db = sqlite3.connect('file:%s?mode=ro' % output, uri=True)
+        try:
+            if not missing_indexes(db):
+                return output
+        finally:
+            db.close()
+    start = time.time()
+    tmp = output + '.tmp'
+    source = sqlite3.connect('file:%s?mode=ro' % path, uri=True)
+    copy = sqlite3.connect(tmp)
+    try:
+        source.backup(copy)
+        for name in missing:
+            (table, columns) = INDEXES[name]
+            copy.execute('CREATE INDEX "%s" ON "%s" (%s)' % (name, table, ', '.join(columns)))
+        copy.execute('ANALYZE')
+        copy.commit()
+    finally:
+        copy.close()
+        source.close()
+    os.replace(tmp, output)
+    logging.info('indexed %s into %s in %.3f s: %s', path, output, time.time() - start, ', '.join(missing))
+    return output
+
+
+class GeometryDB():
+    """ path - SQLite geometry file, opened read only
+    cache_mb, mmap_mb - page cache and memory mapped size of every connection
+    """
+    def __init__(self, path, cache_mb=CACHE_MB, mmap_mb=MMAP_MB):
+        if not os.path.isfile(path):
+            raise IOError('could not find the input DB file %s' % path)
+        self.path = path
+        self.cache_mb = cache_mb
+        self.mmap_mb = mmap_mb
+        self.local = threading.local()
+        self.statements = 0  # executed, all threads together
+        db = self.connection()
+        self.tables = {}  # table name -> column names
+        for (name,) in db.execute("SELECT name FROM sqlite_master WHERE type='table' "
+                                  "AND name NOT LIKE 'sqlite_%' ORDER BY name").fetchall():
+            self.tables[name] = tuple(r[1] for r in db.execute('PRAGMA table_info("%s")' % name))
+        self.row_classes = dict((name, row_class(name, columns)) for (name, columns) in self.tables.items())
+        self.sql = {}  # (kind, table, column, size) -> SQL text
+
+    def connection(self):
+        """ the connection of the calling thread, opened at its first call """
+        db = getattr(self.local, 'db', None)
+        if db is None:
+            db = sqlite3.connect('file:%s?mode=ro' % self.path, uri=True, cached_statements=STATEMENTS)
+            db.execute('PRAGMA cache_size = %d' % (-1024 * self.cache_mb))  # negative: in KiB
+            db.execute('PRAGMA mmap_size = %d' % (self.mmap_mb << 20))
+            self.local.db = db
+        return db
+
+    def reopen(self):
+        """ forgets the connections, eg. in a forked worker process, which must not use the parent's """
+        self.local = threading.local()
+
+    def close(self):
+        """ closes the connection of the calling thread """
+        db = getattr(self.local, 'db', None)
+        if db is not None:
+            db.close()
+            self.local.db = None
+
+    def execute(self, sql, params=()):
+        self.statements += 1
+        return self.connection().execute(sql, params)
+
+    def statement(self, kind, table_name, column=None, size=1):
+        """ SQL of a kind of lookup, built once, so the connections find it in their statement cache.
+        An 'in' lookup binds size values.
+        """
+        key = (kind, table_name, column, size)
+        sql = self.sql.get(key)
+        if sql is None:
+            if table_name not in self.tables or (column is not None and column not in self.tables[table_name]):
+                raise KeyError('no table %s or column %s in %s' % (table_name, column, self.path))
+            columns = ', '.join('"%s"' % c for c in self.tables[table_name])
+            if kind == 'all':
+                order = ' ORDER BY id' if 'id' in self.tables[table_name] else ''
+                sql = 'SELECT %s FROM "%s"%s' % (columns, table_name, order)
+            elif kind == 'in':
+                sql = 'SELECT %s FROM "%s" WHERE "%s" IN (%s)' % (columns, table_name, column,
+                                                                 ', '.join(['?'] * size))
+            else:
+                sql = 'SELECT %s FROM "%s" WHERE "%s" = ?' % (columns, table_name, column)
+            self.sql[key] = sql
+        return sql
+
+    def row(self, table_name, row_id):
+        """ row of a table by id, KeyError if there is none """
+        values = self.execute(self.statement('eq', table_name, 'id'), (row_id,)).fetchone()
+        if values is None:
+            raise KeyError('%s has no row %s' % (table_name, row_id))
+        return self.row_classes[table_name]._make(values)
+
+    def one(self, table_name):
+        """ the first row of a table, eg. RootVolume """
+        values = self.execute(self.statement('all', table_name)).fetchone()
+        if values is None:
+            raise KeyError('%s is empty' % table_name)
+        return self.row_classes[table_name]._make(values)
+
+    def table(self, table_name):
+        """ all the rows of a table, by id """
+        make = self.row_classes[table_name]._make
+        return [make(values) for values in self.execute(self.statement('all', table_name))]
+
+    def tuples(self, table_name, column, values):
+        """ plain tuples of the rows whose column has one of the values. The values
+        are bound BATCH_IDS at a time, a smaller batch is padded with its last value
+        up to a power of two, so a few prepared statements serve any number of values.
+        """
+        values = list(dict.fromkeys(values))
+        out = []
+        for first in range(0, len(values), BATCH_IDS):
+            batch = values[first:first + BATCH_IDS]
+            size = 1 << (len(batch) - 1).bit_length()
+            batch += batch[-1:] * (size - len(batch))
+            out.extend(self.execute(self.statement('in', table_name, column, size), batch).fetchall())
+        return out
+
+    def where(self, table_name, column, values):
+        """ rows whose column has one of the values """
+        make = self.row_classes[table_name]._make
+        return [make(values) for values in self.tuples(table_name, column, values)]
+
+    def rows(self, table_name, ids):
+        """ {id: row} of the rows with these ids, the missing ones left out """
+        k = self.tables[table_name].index('id')
+        make = self.row_classes[table_name]._make
+        return dict((values[k], make(values)) for values in self.tuples(table_name, 'id', ids))
+
+    def children(self, node_id, node_table):
+        """ (id, parentId, childTable, childId, position) of the children of a volume, by position """
+        key = ('children', 'ChildrenPositions', None, 1)
+        if key not in self.sql:
+            self.sql[key] = ('SELECT %s FROM ChildrenPositions WHERE parentTable = ? AND parentId = ? '
+                             'ORDER BY position' % ', '.join(CHILDREN_COLUMNS))
+        return self.execute(self.sql[key], (node_table, node_id)).fetchall()
+
+    def parents(self, node_id, node_table):
+        """ (parentTable, parentId) of the children rows that place a volume """
+        key = ('parents', 'ChildrenPositions', None, 1)
+        if key not in self.sql:
+            self.sql[key] = 'SELECT parentTable, parentId FROM ChildrenPositions WHERE childTable = ? AND childId = ?'
+        return self.execute(self.sql[key], (node_table, node_id)).fetchall()
+
+    def children_rows(self):
+        """ (id, parentTable, parentId, childTable, childId, position) of all the children rows,
+        sorted by (parentTable, parentId, position)
+        """
+        return self.execute('SELECT id, parentTable, parentId, childTable, childId, position '
+                            'FROM ChildrenPositions ORDER BY parentTable, parentId, position').fetchall()
+
+    def array(self, table_name, columns=None):
+        """ numpy structured array of a table, by id. Integer columns are int64,
+        real ones and integer ones with NULLs float64 (NaN for NULL), text object.
+        """
+        columns = tuple(columns or self.tables[table_name])
+        rows = self.execute(self.statement('all', table_name)).fetchall()
+        positions = [self.tables[table_name].index(c) for c in columns]
+        fields = []
+        values = []
+        for (name, k) in zip(columns, positions):
+            column = [r[k] for r in rows]
+            kinds = set(type(v) for v in column)
+            if kinds <= set([int]):
+                dtype = np.int64
+            elif kinds <= set([int, float, type(None)]):
+                dtype = np.float64
+                column = [np.nan if v is None else v for v in column]
+            else:
+                dtype = object
+            fields.append((name, dtype))
+            values.append(column)
+        out = np.empty(len(rows), dtype=fields)
+        for ((name, dtype), column) in zip(fields, values):
+            out[name] = np.asarray(column, dtype=dtype)
+        return out
+
+    def info(self):
+        """ row counts, indexes and settings, for --info """
+        counts = dict((name, self.execute('SELECT count(*) FROM "%s"' % name).fetchone()[0]) for name in self.tables)
+        return {'path': self.path, 'sqlite': sqlite3.sqlite_version, 'tables': counts,
+                'missing_indexes': missing_indexes(self.connection()),
+                'cache_mb': self.cache_mb, 'mmap_mb': self.mmap_mb}
+
+
+if __name__ == '__main__':
+    PARSER = argparse.ArgumentParser(description='Shows the tables of a GeoModel SQLite file, '
+                                     'or makes an indexed working copy of it.')
+    PARSER.add_argument('input', help='SQLite geometry file')
+    PARSER.add_argument('--index', action='store_true',
+                        help='copy the file with the ChildrenPositions indexes it lacks, the input is not changed')
+    PARSER.add_argument('-o', '--output', help='the indexed copy, default: the input name with .indexed')
+    ARGS = PARSER.parse_args()
+
+    logging.basicConfig(level=logging.INFO, format='%(message)s')
+    PATH = with_indexes(ARGS.input, ARGS.output) if ARGS.index else ARGS.input
+    print(json.dumps(GeometryDB(PATH).info(), indent=2))
@@ -0,0 +1,199 @@
+#!/usr/bin/env python
+"""
+Mass and volume of the geometry, rolled up from the bottom of the volume DAG.
+
+The material of a volume fills its shape less the shapes of its daughters
+(every copy of a GeoSerialTransformer is a daughter), so
+    net_volume  = shape volume - daughter shape volumes          (mm3)
+    own_mass    = net_volume * density of the LogVol's material  (kg)
+    mass        = own_mass + the mass of every daughter          (kg)
+MassAggregator computes these once per (table id, volume id), however
+often the volume is placed, and gm2json --mass adds them to every document
+with mass_unknown, the number of volumes of the subtree whose own mass is
+unknown: their shape, or the shape of one of their daughters, has no
+analytic volume (geo_shapes), or their material no density. Their own
+mass is missing from the sums.
+Materials.density is in g/cm3, as GeoModel writes it.
+
+MassTable sums the masses of an export by NameTag path, the placements at
+the top of the path carry everything below them:
+    masses = MassTable.from_file('atlas_geo.ndjson.gz')
+    masses.total('Tile/Barrel')      # {'mass': ..., 'volume': ..., 'placements': ..., ...}
+    masses.children('Tile')          # the same for every NameTag one step below
+From the command line:
+    geo_mass.py atlas_geo.ndjson.gz --query Tile --query '**/TileEndcapNeg' --children Tile
+"""
+
+import json
+import time
+import logging
+import argparse
+
+import numpy as np
+
+import geo_normalize
+import geo_tagindex
+
+KG_PER_MM3 = 1e-6  # of a density of 1 g/cm3
+MASS_FIELDS = ('mass', 'own_mass', 'net_volume', 'mass_unknown')
+
+
+class MassAggregator():
+    """ get_row, get_children - as for geo_reindex.SubtreeHasher
+    shapes - geo_shapes.ShapeParser giving the shape volumes
+    density_unit - kg/mm3 of one unit of Materials.density
+    """
+    def __init__(self, get_row, get_children, shapes, density_unit=KG_PER_MM3):
+        self.get_row = get_row
+        self.get_children = get_children
+        self.shapes = shapes
+        self.density_unit = density_unit
+        self.aggregates = {}  # (table id, volume id) -> aggregate dict
+        self.tables = {}  # table id -> (nodeType, tableName)
+        self.overfull = 0  # volumes whose daughters take more than their shape
+
+    def table(self, table_id):
+        if table_id not in self.tables:
+            row = self.get_row('GeoNodesTypes', table_id)
+            self.tables[table_id] = (row['nodeType'], row['tableName'])
+        return self.tables[table_id]
+
+    def content(self, table_id, vol_id):
+        """ (shape volume, density, [(daughter key, copies)]) of a volume """
+        vol = self.get_row(self.table(table_id)[1], vol_id)
+        logvol = self.get_row('LogVols', vol['logvol'])
+        volume = self.shapes.parse(logvol['shape'])['volume']
+        density = self.get_row('Materials', logvol['material']).get('density')
+        daughters = []
+        for child in self.get_children(vol_id, table_id):
+            (node_type, table_name) = self.table(child[2])
+            if node_type in ('GeoPhysVol', 'GeoFullPhysVol'):
+                daughters.append(((child[2], child[3]), 1))
+            elif node_type == 'GeoSerialTransformer':
+                row = self.get_row(table_name, child[3])
+                key = (row.get('volTable') or 1, row.get('volId', row.get('vol')))
+                daughters.append((key, row.get('copies') or 0))
+        return (volume, density, daughters)
+
+    def subtree(self, table_id, vol_id):
+        """ aggregate of a volume and everything below it, daughters first with an
+        explicit stack so the depth is not limited by the recursion limit
+        """
+        key = (table_id, vol_id)
+        stack = [key]
+        pending = {}  # key -> content, waiting for the aggregates of its daughters
+        while stack:
+            current = stack[-1]
+            if current in self.aggregates:
+                stack.pop()
+                continue
+            if current not in pending:
+                pending[current] = self.content(*current)
+            (volume, density, daughters) = pending[current]
+            missing = [d for (d, _) in daughters if d not in self.aggregates]
+            if missing:
+                stack.extend(missing)
+                continue
+            self.aggregates[current] = self.aggregate(current, volume, density, daughters)
+            del pending[current]
+            stack.pop()
+        return self.aggregates[key]
+
+    def aggregate(self, key, volume, density, daughters):
+        below = [(self.aggregates[d], copies) for (d, copies) in daughters]
+        net_volume = None
+        own_mass = None
+        # a daughter of unknown volume leaves the space the material fills unknown
+        if volume is not None and all(agg['volume'] is not None for (agg, copies) in below if copies):
+            net_volume = volume - sum(copies * agg['volume'] for (agg, copies) in below)
+            if net_volume < 0:
+                logging.debug("daughters of %s take %g mm3 more than its shape", key, -net_volume)
+                self.overfull += 1
+                net_volume = 0.0
+            if density is not None:
+                own_mass = net_volume * density * self.density_unit
+        return {'volume': volume, 'net_volume': net_volume, 'own_mass': own_mass,
+                'mass': (own_mass or 0.0) + sum(copies * agg['mass'] for (agg, copies) in below),
+                'mass_unknown': (own_mass is None) + sum(copies * agg['mass_unknown'] for (agg, copies) in below),
+                'daughters': sum(copies * (1 + agg['daughters']) for (agg, copies) in below)}
+
+    def fields(self, table_id, vol_id):
+        """ the document fields of a volume """
+        agg = self.subtree(table_id, vol_id)
+        return dict((name, agg[name]) for name in MASS_FIELDS)
+
+    def stats(self):
+        return {'volumes': len(self.aggregates), 'overfull': self.overfull}
+
+
+class MassTable():
+    """ masses of the documents of an export, by NameTag path
+    index - geo_tagindex.TagIndex of the export
+    mass, volume, unknown - per document number
+    """
+    def __init__(self, index, mass, volume, unknown):
+        self.index = index
+        self.mass = np.asarray(mass, dtype=np.float64)
+        self.volume = np.asarray(volume, dtype=np.float64)
+        self.unknown = np.asarray(unknown, dtype=np.int64)
+
+    @classmethod
+    def from_documents(cls, docs):
+        builder = geo_tagindex.TagIndexBuilder()
+        (mass, volume, unknown) = ([], [], [])
+        for doc in docs:
+            if doc.get('_op_type') == 'delete':
+                continue
+            if 'mass' not in doc:
+                raise ValueError('the documents have no mass, export them with gm2json --mass')
+            builder.add_document(doc)
+            mass.append(doc['mass'])
+            volume.append(doc['volume'] if doc.get('volume') is not None else np.nan)
+            unknown.append(doc['mass_unknown'])
+        return cls(builder.index(), mass, volume, unknown)
+
+    @classmethod
+    def from_file(cls, path):
+        """ table of an NDJSON output of gm2json --mass, normalized or not """
+        return cls.from_documents(geo_normalize.read_denormalized(path))
+
+    def total(self, pattern, exact=False):
+        """ mass (kg) and envelope volume (mm3) of the volumes under the paths matching
+        pattern, summed over the placements at the top of the selection
+        """
+        return self.summary(pattern, self.index.query(pattern, exact))
+
+    def children(self, path):
+        """ totals of the NameTags one step below path, in document order """
+        steps = geo_tagindex.split_path(path)
+        return [self.summary('/'.join(steps + [name]), self.index.prefix(steps + [name]))
+                for (name, _) in self.index.children(path)]
+
+    def summary(self, path, ranges):
+        tops = self.index.tops(ranges)
+        volume = self.volume[tops]
+        return {'path': path, 'mass': float(self.mass[tops].sum()), 'volume': float(np.nansum(volume)),
+                'placements': len(tops), 'documents': self.index.count(ranges),
+                'mass_unknown': int(self.unknown[tops].sum()), 'volume_unknown': int(np.isnan(volume).sum())}
+
+
+if __name__ == '__main__':
+    PARSER = argparse.ArgumentParser(description='Sums the masses of a gm2json --mass export by NameTag path.')
+    PARSER.add_argument('input', help='NDJSON output of gm2json --mass (.gz and .zst too)')
+    PARSER.add_argument('--query', action='append', default=[], metavar='PATTERN',
+                        help='mass under the paths matching PATTERN, eg. Tile/Barrel or **/TileEndcapNeg')
+    PARSER.add_argument('--exact', action='store_true', help='only the volumes tagged with the path itself')
+    PARSER.add_argument('--children', action='append', default=[], metavar='PATH',
+                        help='mass under every NameTag one step below PATH, "" for the root volume')
+    ARGS = PARSER.parse_args()
+
+    START = time.time()
+    try:
+        MASSES = MassTable.from_file(ARGS.input)
+    except ValueError as e:
+        PARSER.error(str(e))
+    print(json.dumps(dict(MASSES.index.stats(), seconds=round(time.time() - START, 3))))
+    for PATTERN in ARGS.query:
+        print(json.dumps(MASSES.total(PATTERN, ARGS.exact)))
+    for PATH in ARGS.children:
+        print(json.dumps({'children': PATH, 'totals': MASSES.children(PATH)}))
@@ -0,0 +1,210 @@
+#!/usr/bin/env python
+"""
+Normalized output: materials and shapes written once as reference documents.
+
+Thousands of volumes share a few materials and shapes, but every document
+repeats the material name, the shape type, the parameters string, the
+parsed parameters, the extent and the volume. In the normalized form a
+volume document keeps depth, tags, transform, name and _id and refers to
+the rest by material_ref and shape_ref. The reference documents are
+    {"_id": "0123456789ab", "kind": "material", "ref": 1250999896491, "material": "Air"}
+    {"_id": ..., "kind": "shape", "ref": ..., "shape": "Tubs", "dimensions": ..., "shape_params": ...,
+     "extent": ..., "volume": ...}
+Their ids are 48 bit hashes of the content, so they are the same in every
+export of every DB version, and exact as JSON numbers (doubles) too.
+
+NormalizingSink wraps any sink of geo_sinks. A reference document is
+written before the first volume document that uses it: into its own file
+(atlas_geo.shapes.ndjson.gz next to atlas_geo.ndjson.gz), its own index
+(atlas_geo_shapes) or, for stdout, into the same stream. Denormalizer puts
+the values back inline:
+    docs = read_denormalized('atlas_geo.ndjson.gz')
+From the command line:
+    geo_normalize.py atlas_geo.ndjson.gz -o atlas_norm.ndjson.gz
+    geo_normalize.py atlas_norm.ndjson.gz --denormalize -o atlas_geo.ndjson.gz
+"""
+
+import os
+import json
+import time
+import argparse
+
+import geo_sinks
+import geo_reindex
+
+REF_KINDS = ('material', 'shape')
+REF_FIELDS = {'material': ('material',),
+              'shape': ('shape', 'dimensions', 'shape_params', 'extent', 'volume')}
+INLINE_FIELDS = frozenset(f for fields in REF_FIELDS.values() for f in fields)
+ID_BITS = 48  # ids below 2**53 survive JSON parsers that read numbers as doubles
+
+
+def ref_path(path, kind):
+    """ file of the reference documents of kind next to an output file,
+    atlas_geo.ndjson.gz -> atlas_geo.shapes.ndjson.gz
+    """
+    (head, sep, tail) = path.rpartition('.ndjson')
+    if sep:
+        return '%s.%ss%s%s' % (head, kind, sep, tail)
+    return '%s.%ss' % (path, kind)
+
+
+class RefTable():
+    """ interned contents of one kind of reference document """
+    def __init__(self, kind):
+        self.kind = kind
+        self.ids = {}  # lookup key -> id
+        self.contents = {}  # id -> content
+
+    def __len__(self):
+        return len(self.contents)
+
+    def intern(self, key, content):
+        """ id of a content, and the reference document if it is new.
+        key identifies the content and is cheaper to hash than the content itself.
+        """
+        ref = self.ids.get(key)
+        if ref is not None:
+            return (ref, None)
+        ref = geo_reindex.hash64(self.kind, json.dumps(content, sort_keys=True)) >> (64 - ID_BITS)
+        while ref in self.contents:  # a collision, only then the id depends on the order
+            ref = (ref + 1) % (1 << ID_BITS)
+        self.ids[key] = ref
+        self.contents[ref] = content
+        ref_doc = {'_id': '%012x' % ref, 'kind': self.kind, 'ref': ref}
+        ref_doc.update(content)
+        return (ref, ref_doc)
+
+
+class Normalizer():
+    """ turns volume documents into compact ones and reference documents """
+    def __init__(self):
+        self.tables = dict((kind, RefTable(kind)) for kind in REF_KINDS)
+
+    def normalize(self, doc):
+        """ (compact document, new reference documents) of a volume document """
+        out = {k: v for (k, v) in doc.items() if k not in INLINE_FIELDS}
+        new = []
+        for kind in REF_KINDS:
+            fields = REF_FIELDS[kind]
+            # the parsed shape fields follow from type and parameters
+            key = (doc['shape'], doc['dimensions']) if kind == 'shape' else doc[fields[0]]
+            (ref, ref_doc) = self.tables[kind].intern(key, {f: doc[f] for f in fields})
+            out[kind + '_ref'] = ref
+            if ref_doc is not None:
+                new.append(ref_doc)
+        return (out, new)
+
+    def stats(self):
+        return dict((kind, len(table)) for (kind, table) in self.tables.items())
+
+
+class Denormalizer():
+    """ puts the reference values back into compact documents """
+    def __init__(self, ref_docs=()):
+        self.contents = {}  # (kind, ref) -> content
+        for ref_doc in ref_docs:
+            self.add(ref_doc)
+
+    def add(self, ref_doc):
+        self.contents[(ref_doc['kind'], ref_doc['ref'])] = {f: ref_doc[f] for f in REF_FIELDS[ref_doc['kind']]}
+
+    def denormalize(self, doc):
+        """ the document with the values inline, KeyError for an unknown reference """
+        out = {k: v for (k, v) in doc.items() if not k.endswith('_ref')}
+        for kind in REF_KINDS:
+            ref = doc.get(kind + '_ref')
+            if ref is not None:
+                out.update(self.contents[(kind, ref)])
+        return out
+
+    def documents(self, docs):
+        """ denormalized volume documents of a stream, reference documents in it are added on the way """
+        for doc in docs:
+            if 'kind' in doc and 'ref' in doc:
+                self.add(doc)
+            elif '_op_type' in doc:
+                yield doc
+            else:
+                yield self.denormalize(doc)
+
+
+def read_denormalized(path):
+    """ the documents of a normalized NDJSON output with their values inline.
+    The reference files next to it are read first, if there are any.
+    """
+    denormalizer = Denormalizer()
+    for kind in REF_KINDS:
+        if os.path.exists(ref_path(path, kind)):
+            for ref_doc in geo_sinks.read_documents(ref_path(path, kind)):
+                denormalizer.add(ref_doc)
+    return denormalizer.documents(geo_sinks.read_documents(path))
+
+
+class NormalizingSink(geo_sinks.Sink):
+    """ sink - where the compact documents go
+    ref_sinks - kind -> sink of its reference documents, the ones missing go into sink
+    """
+    def __init__(self, sink, ref_sinks=None):
+        geo_sinks.Sink.__init__(self)
+        self.sink = sink
+        self.ref_sinks = ref_sinks or {}
+        self.normalizer = Normalizer()
+
+    def write(self, doc):
+        if doc.get('_op_type') == 'delete':
+            self.sink.write(doc)
+            return
+        (compact, ref_docs) = self.normalizer.normalize(doc)
+        for ref_doc in ref_docs:
+            self.ref_sinks.get(ref_doc['kind'], self.sink).write(ref_doc)
+        self.sink.write(compact)
+        self.docs += 1
+
+    def close(self):
+        stats = self.sink.close()
+        stats['docs'] = self.docs
+        stats['refs'] = self.normalizer.stats()
+        for (kind, sink) in self.ref_sinks.items():
+            stats['%s_sink' % kind] = sink.close()
+        return stats
+
+
+def open_normalizing_sink(kind, output=None, compression=None, **es_options):
+    """ geo_sinks.open_sink with the references in files next to the output or in their own indexes """
+    ref_sinks = {}
+    if kind == 'ndjson':
+        for ref_kind in REF_KINDS:
+            ref_sinks[ref_kind] = geo_sinks.NdjsonSink(ref_path(output, ref_kind), compression)
+    elif kind == 'es':
+        index = es_options.pop('index', 'atlas_geo')
+        for ref_kind in REF_KINDS:
+            ref_sinks[ref_kind] = geo_sinks.EsSink(index='%s_%ss' % (index, ref_kind), **es_options)
+        es_options['index'] = index
+    return NormalizingSink(geo_sinks.open_sink(kind, output, compression, **es_options), ref_sinks)
+
+
+if __name__ == '__main__':
+    PARSER = argparse.ArgumentParser(description='Normalizes (or denormalizes) an NDJSON output of gm2json.')
+    PARSER.add_argument('input', help='NDJSON output of gm2json (.gz and .zst too)')
+    PARSER.add_argument('-o', '--output', required=True, help='output file, the reference files go next to it')
+    PARSER.add_argument('--denormalize', action='store_true',
+                        help='put the values of the reference files next to the input back inline')
+    ARGS = PARSER.parse_args()
+
+    START = time.time()
+    if ARGS.denormalize:
+        SINK = geo_sinks.NdjsonSink(ARGS.output)
+        for DOC in read_denormalized(ARGS.input):
+            SINK.write(DOC)
+    else:
+        SINK = open_normalizing_sink('ndjson', ARGS.output)
+        for DOC in geo_sinks.read_documents(ARGS.input):
+            SINK.write(DOC)
+    STATS = SINK.close()
+    STATS['input_bytes'] = os.path.getsize(ARGS.input)
+    if not ARGS.denormalize:
+        for KIND in REF_KINDS:
+            STATS['file_bytes'] += os.path.getsize(ref_path(ARGS.output, KIND))
+    STATS['seconds'] = round(time.time() - START, 3)
+    print(json.dumps(STATS))
@@ -0,0 +1,169 @@
+"""
+SQLAlchemy mapping of the GeoModel tables, for gm2json --orm.
+
+Only imported when the ORM is used: importing it costs SQLAlchemy, and the
+columns of the mapped classes are reflected from the DB by open_session(),
+not when the classes are defined.
+    session = geo_orm.open_session('geometry_atlas_20Apr17.db')
+    session.query(geo_orm.LogVol).filter(geo_orm.LogVol.id == 12).one().as_dict()
+"""
+
+### declarative reflection method ###
+# refs:
+# - http://www.blog.pythonlibrary.org/2010/09/10/sqlalchemy-connecting-to-pre-existing-databases/
+
+import os
+
+from sqlalchemy import create_engine
+from sqlalchemy.ext.declarative import declarative_base, DeferredReflection
+from sqlalchemy.orm import sessionmaker
+
+BASE = declarative_base()
+REFLECTED = []  # the DB path the tables were reflected from, once per process
+TABLE_CLASSES = {}  # tableName -> mapped class, filled by class_by_tablename
+
+
+class Reflected(DeferredReflection, BASE):
+    """ columns read from the DB by prepare() """
+    __abstract__ = True
+
+
+class MyBaseClass(object):
+    """ a general node object can be from any table."""
+    def as_dict(self):
+        """returns a dictionary of all the columns and values
+        eg {'id': 3798, 'name': u'BLM Module'}
+        """
+        return {c.name: getattr(self, c.name) for c in self.__table__.columns}
+
+### Utility tables ###
+
+
+class GeoNodesType(Reflected, MyBaseClass):
+    """ there are 11 node types
+    id:1 nodeType:GeoPhysVol tableName:PhysVols
+    id:2 nodeType:GeoFullPhysVol tableName:FullPhysVols
+    ...
+    id:11 nodeType:GeoNameTag tableName:NameTags
+    """
+    __tablename__ = 'GeoNodesTypes'
+
+class RootVolume(Reflected, MyBaseClass):
+    """docstring for ."""
+    __tablename__ = 'RootVolume'
+
+
+class ChildPos(Reflected, MyBaseClass):
+    """docstring for ."""
+    __tablename__ = 'ChildrenPositions'
+
+
+
+
+### GeoModel objects tables ###
+
+class PhysVol(Reflected, MyBaseClass):
+    """ from table 1. only points to a logvol"""
+    __tablename__ = 'PhysVols'
+    def __repr__(self):
+        return self.as_dict().__str__()
+
+class LogVol(Reflected, MyBaseClass):
+    """ from table 3. """
+    __tablename__ = 'LogVols'
+
+
+class Material(Reflected, MyBaseClass):
+    """from table 4"""
+    __tablename__ = 'Materials'
+
+
+class Shape(Reflected, MyBaseClass):
+    """from table 5. type is a string like box, cylinder etc.,
+    parameters a string that needs parsing."""
+    __tablename__ = 'Shapes'
+
+
+class SerialDenominator(Reflected, MyBaseClass):
+    """docstring for ."""
+    __tablename__ = 'SerialDenominators'
+
+
+class Function(Reflected, MyBaseClass):
+    """docstring for ."""
+    __tablename__ = 'Functions'
+
+
+class SerialTransformer(Reflected, MyBaseClass):
+    """docstring for ."""
+    __tablename__ = 'SerialTransformers'
+
+
+class AlignableTransform(Reflected, MyBaseClass):
+    """in table 10. only these 12 variables and id
+      xx, xy, xz, yx, yy, yz, zx, zy, zz
+      dx, dy, dz
+    """
+    __tablename__ = 'AlignableTransforms'
+    def __repr__(self):
+        return [self.xx, self.xy, self.xz, self.yx, self.yy, self.yz, self.zx, self.zy, self.zz, self.dx, self.dy, self.dz].__str__()
+
+
+class NameTags(Reflected, MyBaseClass):
+    """docstring for ."""
+    __tablename__ = 'NameTags'
+    def __repr__(self):
+        return self.as_dict().__str__()
+
+class FullPhysVols(Reflected, MyBaseClass):
+    """ points to a log_vol. comes from table 2."""
+    __tablename__ = 'FullPhysVols'
+    def __repr__(self):
+        return self.as_dict().__str__()
+
+
+class Transforms(Reflected, MyBaseClass):
+    """in table 9. only these 12 variables and id
+       xx, xy, xz, yx, yy, yz, zx, zy, zz
+       dx, dy, dz
+    """
+    __tablename__ = 'Transforms'
+    def __repr__(self):
+        return [self.xx, self.xy, self.xz, self.yx, self.yy, self.yz, self.zx, self.zy, self.zz, self.dx, self.dy, self.dz].__str__()
+
+#----------------------------------------------------------------------
+
+
+def open_session(path, read_only=False):
+    """ session on a SQLite geometry, the tables are reflected from the first one opened.
+    read_only - open the file with mode=ro, eg. in worker processes
+    """
+    if read_only:
+        engine = create_engine('sqlite:///file:%s?mode=ro&uri=true' % os.path.abspath(path), echo=False)
+    else:
+        engine = create_engine('sqlite:///%s' % path, echo=False)
+    if not REFLECTED:
+        Reflected.prepare(engine)
+        REFLECTED.append(path)
+    return sessionmaker(bind=engine)()
+
+
+def class_by_tablename(table_fullname):
+    """Return class reference mapped to table.
+    :param table_fullname: String with fullname of table.
+    :return: Class reference or None.
+    """
+
+    if table_fullname in TABLE_CLASSES:
+        return TABLE_CLASSES[table_fullname]
+
+    classItem = None
+
+    for c in BASE._decl_class_registry.values():
+        if hasattr(c, '__table__') and c.__table__.fullname == table_fullname:
+            classItem = c
+
+    if classItem:
+        TABLE_CLASSES[table_fullname] = classItem
+
+    return classItem
@@ -0,0 +1,316 @@
+#!/usr/bin/env python
+"""
+Overlaps between sibling volumes of the flattened geometry.
+
+Works on geo_spatial.SpatialIndex of an export: world boxes, transforms
+and shape parameters of every volume, the mother of a volume being the
+last one before it with a smaller depth. For every mother:
+    dedup   mothers with the same daughters at the same places relative to
+            the mother (a shared volume placed many times) are checked
+            once, the report counts their placements
+    broad   sweep and prune of the world boxes of the daughters along the
+            longest axis of the mother, the candidate pairs are the boxes
+            overlapping along all three axes
+    narrow  the separating axis test of the oriented local extents of a
+            pair. For two Boxes it is exact and its smallest penetration
+            is the overlap depth. Other pairs are sampled: points in the
+            intersection of their world boxes are tested in both shapes,
+            and the depth is the largest distance of a point inside both
+            to the nearest surface.
+            Box, Tube, Tubs, Cons and Trd are tested exactly, the other
+            shapes by their extent only (reported as approximate).
+Mothers are checked in parallel by a pool of processes. Pairs overlapping
+by tolerance or less are touching, not overlapping.
+
+    checker = OverlapChecker(SpatialIndex.from_file('atlas_geo.ndjson.gz'))
+    overlaps = checker.check(workers=8)   # dicts, the deepest first
+From the command line:
+    geo_overlaps.py atlas_geo.ndjson.gz -w 8 --tolerance 0.01 -o overlaps.ndjson
+"""
+
+import json
+import time
+import argparse
+import multiprocessing
+
+import numpy as np
+
+import geo_spatial
+from geo_spatial import OBB, CONS, TRD, TWO_PI
+
+TOLERANCE = 1e-3  # mm
+SAMPLES = 512  # points sampled in the common box of a pair
+QUANTUM = 1e-6  # mm, and for the rotations, placements closer than this are the same
+REFINE_ROUNDS = 3  # rounds of sampling around the best point of a pair
+CHUNK_MOTHERS = 256  # mothers of one task, fixed so the sampling does not depend on the workers
+PAIR_BATCH = 512  # candidate pairs sampled together
+CHECKER = None  # OverlapChecker of the worker processes, inherited through fork
+
+
+def mix64(x):
+    """ splitmix64 finalizer of a uint64 array """
+    with np.errstate(over='ignore'):
+        x = (x ^ (x >> np.uint64(30))) * np.uint64(0xbf58476d1ce4e5b9)
+        x = (x ^ (x >> np.uint64(27))) * np.uint64(0x94d049bb133111eb)
+        return x ^ (x >> np.uint64(31))
+
+
+def hash_rows(columns):
+    """ uint64 hash of every row of (n, k) arrays, floats are quantized first """
+    h = np.zeros(len(columns[0]), dtype=np.uint64)
+    for block in columns:
+        block = np.asarray(block).reshape(len(h), -1)
+        if block.dtype.kind == 'f':
+            block = np.round(block / QUANTUM)
+        for col in block.astype(np.int64).T:
+            h = mix64(h ^ col.view(np.uint64))
+    return h
+
+
+def surface_distance(local, kind, params, lo, hi):
+    """ distance of local points to the nearest surface of their shapes, negative outside.
+    Slanted surfaces are measured along x, y or r, which overestimates a little.
+    """
+    (x, y, z) = local.T
+    d = np.minimum(np.minimum(x - lo[:, 0], hi[:, 0] - x), np.minimum(y - lo[:, 1], hi[:, 1] - y))
+    d = np.minimum(d, np.minimum(z - lo[:, 2], hi[:, 2] - z))
+    sel = np.flatnonzero(kind == CONS)
+    if len(sel):
+        (rmin1, rmin2, rmax1, rmax2, dz, sphi, dphi) = params[sel].T
+        (xs, ys, zs) = (x[sel], y[sel], z[sel])
+        t = (zs + dz) / (2.0 * dz)
+        r = np.hypot(xs, ys)
+        dc = np.minimum(np.minimum(r - rmin1 - (rmin2 - rmin1) * t, rmax1 + (rmax2 - rmax1) * t - r),
+                        dz - np.abs(zs))
+        partial = dphi < TWO_PI - 1e-9
+        if partial.any():
+            phi = np.mod(np.arctan2(ys, xs) - sphi, TWO_PI)
+            edge = np.where(phi <= dphi, r * np.sin(np.minimum(np.minimum(phi, dphi - phi), np.pi / 2)), -r)
+            dc = np.where(partial, np.minimum(dc, edge), dc)
+        d[sel] = np.minimum(d[sel], dc)
+    sel = np.flatnonzero(kind == TRD)
+    if len(sel):
+        (x1, x2, y1, y2, dz, _, _) = params[sel].T
+        (xs, ys, zs) = (x[sel], y[sel], z[sel])
+        t = (zs + dz) / (2.0 * dz)
+        dt = np.minimum(np.minimum(x1 + (x2 - x1) * t - np.abs(xs), y1 + (y2 - y1) * t - np.abs(ys)),
+                        dz - np.abs(zs))
+        d[sel] = np.minimum(d[sel], dt)
+    return d
+
+
+def box_penetration(ca, ha, ra, cb, hb, rb):
+    """ smallest penetration of pairs of oriented boxes along the 15 separating
+    axes, <= 0 if they are apart. c - (n, 3) centers, h - (n, 3) half sizes,
+    r - (n, 3, 3) rotations whose columns are the axes of the boxes
+    """
+    d = cb - ca
+    axes = [ra[:, :, k] for k in range(3)] + [rb[:, :, k] for k in range(3)]
+    axes += [np.cross(ra[:, :, i], rb[:, :, j]) for i in range(3) for j in range(3)]
+    best = np.full(len(d), np.inf)
+    for axis in axes:
+        norm = np.sqrt((axis * axis).sum(axis=1))
+        ok = norm > 1e-9  # parallel edges give no axis
+        axis = axis / np.where(ok, norm, 1.0)[:, None]
+        pa = (ha * np.abs(np.einsum('ni,nik->nk', axis, ra))).sum(axis=1)
+        pb = (hb * np.abs(np.einsum('ni,nik->nk', axis, rb))).sum(axis=1)
+        pen = pa + pb - np.abs((axis * d).sum(axis=1))
+        best = np.where(ok, np.minimum(best, pen), best)
+    return best
+
+
+def check_chunk(task):
+    """ runs in a worker process """
+    (mothers, seed) = task
+    return CHECKER.check_mothers(mothers, seed)
+
+
+class OverlapChecker():
+    """ index - geo_spatial.SpatialIndex of an export
+    tolerance - overlaps up to this depth (mm) are touching volumes
+    samples - points sampled for a pair that are not two Boxes
+    """
+    def __init__(self, index, tolerance=TOLERANCE, samples=SAMPLES, seed=1):
+        self.index = index
+        self.tolerance = tolerance
+        self.samples = samples
+        self.seed = seed
+        self.lo = index.local_lo + geo_spatial.TOLERANCE
+        self.hi = index.local_hi - geo_spatial.TOLERANCE
+        box = np.array([shape == 'Box' for shape in index.shapes], dtype=bool)
+        self.is_box = box & (index.kind == OBB)
+        self.exact = self.is_box | (index.kind != OBB)  # shapes tested exactly, not by their extent
+        self.stats = {'volumes': len(index), 'mothers': 0, 'checked': 0, 'candidates': 0, 'sampled': 0,
+                      'overlaps': 0}
+        self.group()
+
+    def group(self):
+        """ the daughters of every mother and one mother per arrangement of daughters """
+        index = self.index
+        n = len(index)
+        mother = geo_spatial.mothers(index.depth)
+        mother[mother < 0] = n  # the top volumes are the daughters of a virtual mother
+        self.order = np.argsort(mother, kind='stable')
+        count = np.bincount(mother, minlength=n + 1)
+        self.start = np.cumsum(count) - count
+        self.count = count
+
+        # the placement of every daughter relative to its mother
+        (rot, shift) = (index.rot.copy(), index.shift.copy())
+        inner = np.flatnonzero(mother < n)
+        m = mother[inner]
+        rot[inner] = np.einsum('nij,njk->nik', index.inv_rot[m], index.rot[inner])
+        shift[inner] = np.einsum('nij,nj->ni', index.inv_rot[m], index.shift[inner]) + index.inv_shift[m]
+        (_, names) = np.unique(np.array([str(name) for name in index.names], dtype=object), return_inverse=True)
+        daughter = hash_rows([names, index.kind, rot, shift, self.lo, self.hi, index.params])
+
+        # a mother's signature does not depend on the order of its daughters
+        mothers = np.flatnonzero(count >= 2)
+        sums = np.add.reduceat(daughter[self.order], self.start[mothers]) if len(mothers) else daughter[:0]
+        signature = mix64(sums ^ count[mothers].astype(np.uint64))
+        (_, first, placements) = np.unique(signature, return_index=True, return_counts=True)
+        keep = np.argsort(first)
+        self.mothers = mothers[first[keep]]
+        self.placements = dict(zip(self.mothers.tolist(), placements[keep].tolist()))
+        self.stats['mothers'] = len(mothers)
+        self.stats['checked'] = len(self.mothers)
+
+    def daughters(self, m):
+        return self.order[self.start[m]:self.start[m] + self.count[m]]
+
+    def candidates(self, m):
+        """ sweep and prune: (a, b) pairs of daughters of m whose world boxes overlap """
+        d = self.daughters(m)
+        (lo, hi) = (self.index.lo[d], self.index.hi[d])
+        axis = int(np.argmax(hi.max(axis=0) - lo.min(axis=0)))
+        order = np.argsort(lo[:, axis], kind='stable')
+        (d, lo, hi) = (d[order], lo[order], hi[order])
+        # the boxes starting before box i ends along the axis follow it in the sorted order
+        end = np.searchsorted(lo[:, axis], hi[:, axis], side='left')
+        count = np.maximum(end - np.arange(len(d)) - 1, 0)
+        i = np.repeat(np.arange(len(d)), count)
+        j = i + 1 + np.arange(count.sum()) - np.repeat(np.cumsum(count) - count, count)
+        ok = np.all((lo[j] < hi[i]) & (lo[i] < hi[j]), axis=1)
+        return (d[i[ok]], d[j[ok]])
+
+    def check_mothers(self, mothers, seed):
+        """ overlapping daughter pairs of mothers as (mother, a, b, depth, volume, exact) and the counts """
+        rng = np.random.default_rng([self.seed, seed])
+        pairs = [(np.full(len(a), m), a, b) for (m, a, b) in ((m,) + self.candidates(m) for m in mothers)]
+        if not pairs:
+            return ([], {'candidates': 0, 'sampled': 0})
+        (m, a, b) = (np.concatenate(p) for p in zip(*pairs))
+        found = []
+        sampled = 0
+        for start in range(0, len(a), PAIR_BATCH):
+            sl = slice(start, start + PAIR_BATCH)
+            (depth, volume, exact, n_sampled) = self.narrow(a[sl], b[sl], rng)
+            sampled += n_sampled
+            for k in np.flatnonzero(depth > self.tolerance).tolist():
+                found.append((int(m[sl][k]), int(a[sl][k]), int(b[sl][k]), float(depth[k]),
+                              None if np.isnan(volume[k]) else float(volume[k]), bool(exact[k])))
+        return (found, {'candidates': len(a), 'sampled': sampled})
+
+    def narrow(self, a, b, rng):
+        """ (depth, volume, exact, number sampled) of candidate pairs, depth <= tolerance if they don't overlap """
+        index = self.index
+        (ha, hb) = ((self.hi[a] - self.lo[a]) / 2.0, (self.hi[b] - self.lo[b]) / 2.0)
+        ca = np.einsum('nij,nj->ni', index.rot[a], (self.hi[a] + self.lo[a]) / 2.0) + index.shift[a]
+        cb = np.einsum('nij,nj->ni', index.rot[b], (self.hi[b] + self.lo[b]) / 2.0) + index.shift[b]
+        depth = box_penetration(ca, ha, index.rot[a], cb, hb, index.rot[b])
+        volume = np.full(len(a), np.nan)
+        exact = self.is_box[a] & self.is_box[b]
+        todo = np.flatnonzero(~exact & (depth > self.tolerance))
+        if len(todo):
+            (depth[todo], volume[todo]) = self.sample(a[todo], b[todo], rng)
+        return (depth, volume, exact, len(todo))
+
+    def distance(self, x, world):
+        """ surface_distance of (n, s, 3) world points in the shapes x """
+        index = self.index
+        local = np.matmul(world, index.inv_rot[x].transpose(0, 2, 1)) + index.inv_shift[x][:, None, :]
+        xs = np.repeat(x, world.shape[1])
+        return surface_distance(local.reshape(-1, 3), index.kind[xs], index.params[xs], self.lo[xs], self.hi[xs])
+
+    def sample(self, a, b, rng):
+        """ points sampled in the intersection of the world boxes of pairs: the
+        largest distance to the nearest surface of a point inside both shapes,
+        and the estimated volume of the overlap. Half the points are spread
+        over the box, the others go to smaller and smaller boxes around the
+        best point so far, which finds thin overlaps and refines the depth.
+        """
+        index = self.index
+        (lo, hi) = (np.maximum(index.lo[a], index.lo[b]), np.minimum(index.hi[a], index.hi[b]))
+        size = np.maximum(hi - lo, 0.0)
+        n = len(a)
+        spread = max(1, self.samples // 2)
+        world = lo[:, None, :] + rng.random((n, spread, 3)) * size[:, None, :]
+        both = np.minimum(self.distance(a, world), self.distance(b, world)).reshape(n, spread)
+        volume = (both > 0).mean(axis=1) * size.prod(axis=1)
+        best = both.argmax(axis=1)
+        (depth, center) = (both[np.arange(n), best], world[np.arange(n), best])
+        rounds = REFINE_ROUNDS
+        per_round = max(1, (self.samples - spread) // rounds)
+        for k in range(1, rounds + 1):
+            half = size / 2.0 / 4 ** k
+            world = center[:, None, :] + (2.0 * rng.random((n, per_round, 3)) - 1.0) * half[:, None, :]
+            world = np.clip(world, lo[:, None, :], hi[:, None, :])
+            both = np.minimum(self.distance(a, world), self.distance(b, world)).reshape(n, per_round)
+            best = both.argmax(axis=1)
+            better = both[np.arange(n), best] > depth
+            depth = np.where(better, both[np.arange(n), best], depth)
+            center = np.where(better[:, None], world[np.arange(n), best], center)
+        return (depth, volume)
+
+    def check(self, workers=1):
+        """ the overlapping sibling pairs, the deepest first """
+        start = time.time()
+        tasks = [(chunk, k) for (k, chunk) in
+                 enumerate(np.array_split(self.mothers, max(1, -(-len(self.mothers) // CHUNK_MOTHERS))))]
+        if workers > 1 and len(tasks) > 1:
+            global CHECKER
+            CHECKER = self
+            with multiprocessing.get_context('fork').Pool(workers) as pool:
+                results = pool.map(check_chunk, tasks)
+        else:
+            results = [self.check_mothers(*task) for task in tasks]
+        overlaps = []
+        for (found, counts) in results:
+            for name in counts:
+                self.stats[name] += counts[name]
+            overlaps.extend(self.report(*f) for f in found)
+        overlaps.sort(key=lambda o: -o['depth'])
+        self.stats['overlaps'] = len(overlaps)
+        self.stats['seconds'] = round(time.time() - start, 3)
+        return overlaps
+
+    def report(self, m, a, b, depth, volume, exact):
+        index = self.index
+        return {'mother': index.volume(m) if m < len(index) else None, 'a': index.volume(a), 'b': index.volume(b),
+                'depth': round(depth, 6), 'volume': None if volume is None else round(volume, 3),
+                'method': 'exact' if exact else 'sampled',
+                'approximate': not (self.exact[a] and self.exact[b]), 'placements': self.placements[m]}
+
+
+if __name__ == '__main__':
+    PARSER = argparse.ArgumentParser(description='Finds overlapping sibling volumes in a gm2json export.')
+    PARSER.add_argument('input', help='NDJSON output of gm2json (.gz and .zst too)')
+    PARSER.add_argument('-w', '--workers', type=int, default=1, help='processes checking the mothers')
+    PARSER.add_argument('--tolerance', type=float, default=TOLERANCE, help='mm, shallower overlaps are ignored')
+    PARSER.add_argument('--samples', type=int, default=SAMPLES, help='points sampled for a pair of shapes')
+    PARSER.add_argument('--seed', type=int, default=1, help='random seed of the sampling')
+    PARSER.add_argument('-o', '--output', help='write all the overlaps to this NDJSON file')
+    PARSER.add_argument('--top', type=int, default=20, help='print the deepest TOP overlaps')
+    ARGS = PARSER.parse_args()
+
+    START = time.time()
+    INDEX = geo_spatial.SpatialIndex.from_file(ARGS.input)
+    CHECK = OverlapChecker(INDEX, ARGS.tolerance, ARGS.samples, ARGS.seed)
+    OVERLAPS = CHECK.check(ARGS.workers)
+    if ARGS.output:
+        with open(ARGS.output, 'w') as f:
+            for OVERLAP in OVERLAPS:
+                f.write(json.dumps(OVERLAP) + '\n')
+    for OVERLAP in OVERLAPS[:ARGS.top]:
+        print(json.dumps(OVERLAP))
+    print(json.dumps(dict(CHECK.stats, skipped=INDEX.skipped, total_seconds=round(time.time() - START, 3))))
@@ -0,0 +1,175 @@
+"""
+Asyncio pipeline of three stages connected by bounded queues.
+
+    reader     takes batches of items from a blocking iterator (eg. a traversal
+               reading SQLite) in a worker thread of its own
+    transform  turns every batch into a batch of outputs (eg. documents), in the event loop
+    writers    hand the output batches to a blocking writer (eg. a bulk request)
+               in worker threads, several batches in flight at once
+
+While a batch is being read the previous one is transformed and earlier
+ones are written, so SQLite, CPU and network time overlap instead of
+adding up, as far as the GIL allows: SQLite and socket calls release it.
+A full queue blocks the stage before it, so memory stays bounded. With
+more than one writer the batches may be written out of order.
+
+run() returns the summary: per stage the batches, items, seconds busy,
+seconds waiting for input and blocked on a full queue, and the slowest
+batch; per queue the mean and max depth; and the latency from reading a
+batch to the end of its write.
+"""
+
+import time
+import asyncio
+import itertools
+from concurrent.futures import ThreadPoolExecutor
+
+
+class StageStats():
+    """ time accounting of one stage """
+    def __init__(self):
+        self.batches = 0
+        self.items = 0
+        self.busy = 0.0
+        self.busy_max = 0.0
+        self.waiting = 0.0  # for input
+        self.blocked = 0.0  # on a full output queue
+
+    def done(self, items, seconds):
+        self.batches += 1
+        self.items += items
+        self.busy += seconds
+        self.busy_max = max(self.busy_max, seconds)
+
+    def summary(self):
+        return {'batches': self.batches, 'items': self.items, 'busy': round(self.busy, 6),
+                'busy_max': round(self.busy_max, 6), 'waiting': round(self.waiting, 6),
+                'blocked': round(self.blocked, 6)}
+
+
+class QueueStats():
+    """ depth of a queue, sampled at every put """
+    def __init__(self, size):
+        self.size = size
+        self.samples = 0
+        self.total = 0
+        self.max = 0
+
+    def sample(self, depth):
+        self.samples += 1
+        self.total += depth
+        self.max = max(self.max, depth)
+
+    def summary(self):
+        return {'size': self.size, 'mean': round(self.total / self.samples, 2) if self.samples else 0.0,
+                'max': self.max}
+
+
+def take(iterator, n):
+    """ the next n items of an iterator, fewer at its end """
+    return list(itertools.islice(iterator, n))
+
+
+class Pipeline():
+    """ source - iterable read in a worker thread
+    transform - callable(list of items) returning a list of outputs, runs in the event loop
+    writer - callable(list of outputs), runs in worker threads, by several at once if writers > 1
+    batch_size - items read at once
+    queue_size - batches waiting between two stages
+    """
+    def __init__(self, source, transform, writer, batch_size=500, queue_size=8, writers=1):
+        self.source = source
+        self.transform = transform
+        self.writer = writer
+        self.batch_size = batch_size
+        self.queue_size = queue_size
+        self.writers = writers
+        self.stages = {'reader': StageStats(), 'transform': StageStats(), 'writer': StageStats()}
+        self.queues = {'read': QueueStats(queue_size), 'write': QueueStats(queue_size)}
+        self.latency = StageStats()  # reading to written, per batch
+
+    def run(self):
+        """ runs the pipeline to the end of the source, returns the summary """
+        start = time.perf_counter()
+        loop = asyncio.new_event_loop()
+        try:
+            loop.run_until_complete(self.main())
+        finally:
+            loop.close()
+        return self.summary(time.perf_counter() - start)
+
+    async def main(self):
+        loop = asyncio.get_event_loop()
+        read_queue = asyncio.Queue(self.queue_size)
+        write_queue = asyncio.Queue(self.queue_size)
+        # the reader keeps to one thread, SQLite connections belong to the thread that opened them
+        with ThreadPoolExecutor(1) as read_pool, ThreadPoolExecutor(self.writers) as write_pool:
+            tasks = [loop.create_task(self.reader(loop, read_pool, read_queue)),
+                     loop.create_task(self.transformer(read_queue, write_queue))]
+            tasks += [loop.create_task(self.write(loop, write_pool, write_queue)) for _ in range(self.writers)]
+            try:
+                await asyncio.gather(*tasks)
+            except BaseException:
+                for task in tasks:
+                    task.cancel()
+                raise
+
+    async def put(self, queue, item, stats, queue_stats):
+        start = time.perf_counter()
+        await queue.put(item)
+        stats.blocked += time.perf_counter() - start
+        queue_stats.sample(queue.qsize())
+
+    async def get(self, queue, stats):
+        start = time.perf_counter()
+        item = await queue.get()
+        stats.waiting += time.perf_counter() - start
+        return item
+
+    async def reader(self, loop, pool, out):
+        stats = self.stages['reader']
+        iterator = iter(self.source)
+        while True:
+            start = time.perf_counter()
+            batch = await loop.run_in_executor(pool, take, iterator, self.batch_size)
+            if not batch:
+                break
+            stats.done(len(batch), time.perf_counter() - start)
+            await self.put(out, (start, batch), stats, self.queues['read'])
+        await out.put(None)
+
+    async def transformer(self, inp, out):
+        stats = self.stages['transform']
+        while True:
+            item = await self.get(inp, stats)
+            if item is None:
+                break
+            (read, batch) = item
+            start = time.perf_counter()
+            outputs = self.transform(batch)
+            stats.done(len(outputs), time.perf_counter() - start)
+            await self.put(out, (read, outputs), stats, self.queues['write'])
+        for _ in range(self.writers):
+            await out.put(None)
+
+    async def write(self, loop, pool, inp):
+        stats = self.stages['writer']
+        while True:
+            item = await self.get(inp, stats)
+            if item is None:
+                return
+            (read, outputs) = item
+            start = time.perf_counter()
+            await loop.run_in_executor(pool, self.writer, outputs)
+            end = time.perf_counter()
+            stats.done(len(outputs), end - start)
+            self.latency.done(len(outputs), end - read)
+
+    def summary(self, seconds):
+        stages = dict((name, stats.summary()) for (name, stats) in self.stages.items())
+        stages['writer']['in_flight'] = self.writers
+        latency = self.latency
+        return {'seconds': round(seconds, 3), 'batch_size': self.batch_size, 'stages': stages,
+                'queues': dict((name, stats.summary()) for (name, stats) in self.queues.items()),
+                'latency': {'mean': round(latency.busy / latency.batches, 6) if latency.batches else 0.0,
+                            'max': round(latency.busy_max, 6)}}
@@ -0,0 +1,287 @@
+"""
+Incremental re-indexing between geometry versions.
+
+Stable document ids: a volume's _id is a 64 bit hash of its path from the
+root volume. Every step of the path is the NameTag the volume gets (or its
+LogVol name if it gets none) and the number of earlier siblings with the
+same step, eg. Tile#0/TileBarrel#0/Module12#0/Absorber#3. Ids don't depend on
+row ids, so they survive renumbering between DB versions.
+
+Subtree hashes: a Merkle hash of a PhysVol/FullPhysVol over its LogVol,
+Shape and Material content and its ordered children (NameTags, serial
+denominators, transforms, serial transformers and the hashes of the child
+volumes). They are computed once per (table id, volume id).
+
+A manifest keeps, in document order, the id, document hash, subtree hash
+and depth of every exported volume. With a baseline manifest a volume whose
+document and subtree hash are unchanged is skipped with its whole subtree,
+a volume with an unchanged document is not re-emitted, and the ids of the
+baseline missing from the new version are reported for deletion.
+"""
+
+import json
+import hashlib
+
+import numpy as np
+
+from geo_transforms import ROW_FIELDS
+
+NEW, CHANGED, SAME, SKIPPED = 'new', 'changed', 'same', 'skipped'
+
+
+def hash64(*parts):
+    """ 64 bit blake2b of strings """
+    h = hashlib.blake2b(digest_size=8)
+    for part in parts:
+        h.update(part.encode('utf-8'))
+        h.update(b'\0')
+    return int.from_bytes(h.digest(), 'big')
+
+
+def doc_hash(doc):
+    """ hash of a document, without its _id """
+    return hash64(json.dumps({k: v for (k, v) in doc.items() if k != '_id'}, sort_keys=True))
+
+
+def doc_id(path_id):
+    """ the Elasticsearch _id of a path id """
+    return '%016x' % path_id
+
+
+class PathIds():
+    """ assigns path ids to the documents of one traversal, in document order.
+    tags is the number of NameTags the documents of the starting volume inherit.
+    depth, path_id and counts continue the ids below a volume of another traversal, see frame().
+    """
+    def __init__(self, tags=0, depth=-1, path_id=0, counts=None):
+        # (depth, number of tags, path id, step counts of the children)
+        self.stack = [(depth, tags, path_id, dict(counts or {}))]
+
+    def assign(self, depth, tags, name):
+        while self.stack[-1][0] >= depth:
+            self.stack.pop()
+        (_, parent_tags, parent_id, counts) = self.stack[-1]
+        step = 't:%s' % tags[-1] if len(tags) > parent_tags else 'n:%s' % name
+        k = counts.get(step, 0)
+        counts[step] = k + 1
+        path_id = hash64('%016x' % parent_id, step, str(k))
+        self.stack.append((depth, len(tags), path_id, {}))
+        return path_id
+
+    def frame(self, depth):
+        """ PathIds arguments that give the next volume at depth the id it gets here """
+        k = len(self.stack) - 1
+        while self.stack[k][0] >= depth:
+            k -= 1
+        (parent_depth, tags, path_id, counts) = self.stack[k]
+        return (tags, parent_depth, path_id, dict(counts))
+
+
+class SubtreeHasher():
+    """ Merkle hashes of volumes
+    get_row - callable(table name, id) returning a row as a dict
+    get_children - callable(volume id, table id) returning ChildrenPositions tuples
+        (id, parentId, childTable, childId, position) ordered by position
+    """
+    def __init__(self, get_row, get_children):
+        self.get_row = get_row
+        self.get_children = get_children
+        self.hashes = {}  # (table id, volume id) -> hash
+        self.tables = {}  # table id -> (nodeType, tableName)
+
+    def table(self, table_id):
+        if table_id not in self.tables:
+            row = self.get_row('GeoNodesTypes', table_id)
+            self.tables[table_id] = (row['nodeType'], row['tableName'])
+        return self.tables[table_id]
+
+    def content(self, table_id, vol_id):
+        """ the volume's own content and its children as (parts, volume keys the parts refer to) """
+        vol = self.get_row(self.table(table_id)[1], vol_id)
+        logvol = self.get_row('LogVols', vol['logvol'])
+        shape = self.get_row('Shapes', logvol['shape'])
+        material = self.get_row('Materials', logvol['material'])
+        parts = [['logvol', logvol['name'], shape['type'], shape['parameters'],
+                  [v for (k, v) in sorted(material.items()) if k != 'id']]]
+        refs = []
+        for child in self.get_children(vol_id, table_id):
+            (node_type, table_name) = self.table(child[2])
+            if node_type in ('GeoPhysVol', 'GeoFullPhysVol'):
+                parts.append(['vol', (child[2], child[3])])
+                refs.append((child[2], child[3]))
+                continue
+            row = self.get_row(table_name, child[3])
+            if node_type in ('GeoTransform', 'GeoAlignableTransform'):
+                parts.append(['transform'] + [row[f] for f in ROW_FIELDS])
+            elif node_type == 'GeoSerialTransformer':
+                func_id = row.get('funcId', row.get('func'))
+                function = self.get_row('Functions', func_id)
+                key = (row.get('volTable') or 1, row.get('volId', row.get('vol')))
+                parts.append(['serial', [v for (k, v) in sorted(function.items()) if k != 'id'],
+                              row.get('copies'), key])
+                refs.append(key)
+            else:
+                parts.append([node_type] + [v for (k, v) in sorted(row.items()) if k != 'id'])
+        return (parts, refs)
+
+    def subtree(self, table_id, vol_id):
+        """ hash of a volume and everything below it, children are hashed first
+        with an explicit stack so the depth is not limited by the recursion limit
+        """
+        key = (table_id, vol_id)
+        stack = [key]
+        pending = {}  # key -> content, waiting for the hashes of its children
+        while stack:
+            current = stack[-1]
+            if current in self.hashes:
+                stack.pop()
+                continue
+            if current not in pending:
+                pending[current] = self.content(*current)
+            (parts, refs) = pending[current]
+            missing = [ref for ref in refs if ref not in self.hashes]
+            if missing:
+                stack.extend(missing)
+                continue
+            resolved = []
+            for part in parts:
+                if part[0] == 'vol':
+                    part = [part[0], '%016x' % self.hashes[part[1]]]
+                elif part[0] == 'serial':
+                    part = part[:3] + ['%016x' % self.hashes[part[3]]]
+                resolved.append(part)
+            self.hashes[current] = hash64(json.dumps(resolved))
+            del pending[current]
+            stack.pop()
+        return self.hashes[key]
+
+
+def subtree_ends(depths):
+    """ for every entry of a document order list, the index after its last descendant """
+    ends = np.full(len(depths), len(depths), dtype=np.int64)
+    stack = []
+    for (i, depth) in enumerate(depths.tolist()):
+        while stack and depths[stack[-1]] >= depth:
+            ends[stack.pop()] = i
+        stack.append(i)
+    return ends
+
+
+class Manifest():
+    """ id, document hash, subtree hash and depth of the exported volumes,
+    in document order, with the options of the export that made them
+    """
+    def __init__(self, ids, docs, subtrees, depths, options):
+        self.ids = np.asarray(ids, dtype=np.uint64)
+        self.docs = np.asarray(docs, dtype=np.uint64)
+        self.subtrees = np.asarray(subtrees, dtype=np.uint64)
+        self.depths = np.asarray(depths, dtype=np.int32)
+        self.options = options
+        self.order = np.argsort(self.ids, kind='stable')
+        self.sorted_ids = self.ids[self.order]
+        self._ends = None
+
+    def __len__(self):
+        return len(self.ids)
+
+    @classmethod
+    def load(cls, path):
+        with np.load(path) as data:
+            return cls(data['ids'], data['docs'], data['subtrees'], data['depths'],
+                       json.loads(str(data['options'])))
+
+    def save(self, path):
+        with open(path, 'wb') as f:
+            np.savez_compressed(f, ids=self.ids, docs=self.docs, subtrees=self.subtrees, depths=self.depths,
+                                options=np.array(json.dumps(self.options)))
+
+    @property
+    def ends(self):
+        if self._ends is None:
+            self._ends = subtree_ends(self.depths)
+        return self._ends
+
+    def find(self, path_id):
+        """ index of an id, -1 if it is not in the manifest """
+        i = int(np.searchsorted(self.sorted_ids, np.uint64(path_id)))
+        if i < len(self.sorted_ids) and int(self.sorted_ids[i]) == path_id:
+            return int(self.order[i])
+        return -1
+
+
+class Reindex():
+    """ ids, hashes and the baseline comparison of one export.
+    hasher - SubtreeHasher, only needed to write a manifest or compare to a baseline
+    baseline - Manifest of the previous export, or None
+    """
+    def __init__(self, hasher=None, baseline=None, tags=0):
+        self.paths = PathIds(tags)
+        self.hasher = hasher
+        self.baseline = baseline
+        self.seen = np.zeros(len(baseline), dtype=bool) if baseline is not None else None
+        self.entries = []  # (ids, docs, subtrees, depths) arrays of the new manifest
+        self.current = ([], [], [], [])
+        self.stats = {NEW: 0, CHANGED: 0, SAME: 0, SKIPPED: 0, 'kept': 0}
+
+    def start(self, frame):
+        """ the next documents are the subtree of a volume placed from a PathIds.frame() """
+        self.paths = PathIds(*frame)
+
+    def place(self, doc, key):
+        """ sets the _id of a document and compares it to the baseline.
+        key is the (table id, volume id) of the volume.
+        Returns NEW or CHANGED if the document has to be stored, SAME if it
+        didn't change and SKIPPED if nothing in its subtree did either.
+        """
+        path_id = self.paths.assign(doc['depth'], doc['tags'], doc['name'])
+        if self.hasher is None:
+            doc['_id'] = doc_id(path_id)
+            return NEW
+        subtree = self.hasher.subtree(*key)
+        digest = doc_hash(doc)
+        doc['_id'] = doc_id(path_id)
+        status = NEW
+        if self.baseline is not None:
+            i = self.baseline.find(path_id)
+            if i >= 0 and int(self.baseline.docs[i]) == digest:
+                if int(self.baseline.subtrees[i]) == subtree:
+                    self.keep(i)
+                    self.stats[SKIPPED] += 1
+                    return SKIPPED
+                status = SAME
+            elif i >= 0:
+                status = CHANGED
+            if i >= 0:
+                self.seen[i] = True
+        for (column, value) in zip(self.current, (path_id, digest, subtree, doc['depth'])):
+            column.append(value)
+        self.stats[status] += 1
+        return status
+
+    def keep(self, first):
+        """ an unchanged subtree of the baseline goes to the new manifest as it is """
+        last = int(self.baseline.ends[first])
+        self.seen[first:last] = True
+        self.stats['kept'] += last - first
+        self.flush()
+        self.entries.append((self.baseline.ids[first:last], self.baseline.docs[first:last],
+                             self.baseline.subtrees[first:last], self.baseline.depths[first:last]))
+
+    def flush(self):
+        if self.current[0]:
+            self.entries.append(tuple(np.array(c, dtype=np.uint64) for c in self.current[:3]) +
+                                (np.array(self.current[3], dtype=np.int32),))
+            self.current = ([], [], [], [])
+
+    def deleted(self):
+        """ _ids of the baseline volumes that are not in the new version """
+        if self.baseline is None:
+            return []
+        return [doc_id(int(i)) for i in self.baseline.ids[~self.seen]]
+
+    def manifest(self, options):
+        """ Manifest of the new version """
+        self.flush()
+        columns = [np.concatenate([e[k] for e in self.entries]) if self.entries else []
+                   for k in range(4)]
+        return Manifest(columns[0], columns[1], columns[2], columns[3], options)
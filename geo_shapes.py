@@ -0,0 +1,269 @@
+"""
+Parsing of the GeoModel Shapes table.
+
+A Shapes row has a type (Box, Tube, ...) and a parameters string like
+    XHalfLength=1000;YHalfLength=500;ZHalfLength=20
+Polycones and polygons repeat ZPos, ZRmin and ZRmax for every plane.
+Boolean shapes point to other rows: Shift has A (shape id) and X
+(transform id), Union, Subtraction and Intersection have opA and opB.
+
+ShapeParser turns every row, once, into
+    type    - the shape type
+    params  - the parameters as numbers (lists for the repeated ones)
+    extent  - local axis aligned bounding box (xmin, ymin, zmin, xmax, ymax, zmax)
+    volume  - analytic volume in mm3
+extent and volume are None where they can't be computed. Boolean shapes
+get a bounding box, but a volume only for Shift.
+"""
+
+import math
+import logging
+
+import numpy as np
+
+import geo_transforms
+
+TWO_PI = 2.0 * math.pi
+BOOLEAN_TYPES = ('Shift', 'Union', 'Subtraction', 'Intersection')
+
+
+def parse_parameters(parameters):
+    """ 'A=1;B=2;B=3' -> {'A': 1.0, 'B': [2.0, 3.0]}, repeated keys become lists """
+    params = {}
+    repeated = set()
+    if not parameters:
+        return params
+    for part in parameters.split(';'):
+        if '=' not in part:
+            continue
+        (key, value) = part.split('=', 1)
+        key = key.strip()
+        try:
+            value = float(value)
+        except ValueError:
+            value = value.strip()
+        if key in params:
+            if key not in repeated:
+                params[key] = [params[key]]
+                repeated.add(key)
+            params[key].append(value)
+        else:
+            params[key] = value
+    return params
+
+
+def as_list(value):
+    """ a repeated parameter that appeared only once is not a list yet """
+    if isinstance(value, list):
+        return value
+    return [value]
+
+
+def arc_extent(rmin, rmax, sphi, dphi):
+    """ (xmin, ymin, xmax, ymax) of a ring sector in the xy plane """
+    if dphi >= TWO_PI - 1e-9:
+        return (-rmax, -rmax, rmax, rmax)
+    angles = [sphi, sphi + dphi]
+    # the axis directions inside the sector are where the outer arc is extreme
+    k = math.ceil(sphi / (math.pi / 2.0))
+    while k * math.pi / 2.0 <= sphi + dphi:
+        angles.append(k * math.pi / 2.0)
+        k += 1
+    xs = []
+    ys = []
+    for a in angles:
+        xs.append(rmax * math.cos(a))
+        ys.append(rmax * math.sin(a))
+    for a in (sphi, sphi + dphi):
+        xs.append(rmin * math.cos(a))
+        ys.append(rmin * math.sin(a))
+    return (min(xs), min(ys), max(xs), max(ys))
+
+
+def cone_volume(rmin1, rmax1, rmin2, rmax2, height, dphi):
+    """ volume of a hollow cone segment """
+    outer = rmax1 * rmax1 + rmax1 * rmax2 + rmax2 * rmax2
+    inner = rmin1 * rmin1 + rmin1 * rmin2 + rmin2 * rmin2
+    return dphi / 2.0 * height / 3.0 * (outer - inner)
+
+
+def box_extent(dx, dy, dz):
+    return (-dx, -dy, -dz, dx, dy, dz)
+
+
+def transformed_extent(extent, mat):
+    """ axis aligned box around a transformed box """
+    (xmin, ymin, zmin, xmax, ymax, zmax) = extent
+    corners = np.array([[x, y, z] for x in (xmin, xmax) for y in (ymin, ymax) for z in (zmin, zmax)])
+    corners = geo_transforms.apply(mat, corners)
+    return tuple(corners.min(axis=0).tolist() + corners.max(axis=0).tolist())
+
+
+def shape_box(p):
+    extent = box_extent(p['XHalfLength'], p['YHalfLength'], p['ZHalfLength'])
+    return (extent, 8.0 * p['XHalfLength'] * p['YHalfLength'] * p['ZHalfLength'])
+
+
+def shape_tube(p):
+    (rmin, rmax, dz) = (p['RMin'], p['RMax'], p['ZHalfLength'])
+    return ((-rmax, -rmax, -dz, rmax, rmax, dz), math.pi * (rmax * rmax - rmin * rmin) * 2.0 * dz)
+
+
+def shape_tubs(p):
+    (rmin, rmax, dz, sphi, dphi) = (p['RMin'], p['RMax'], p['ZHalfLength'], p['SPhi'], p['DPhi'])
+    (xmin, ymin, xmax, ymax) = arc_extent(rmin, rmax, sphi, dphi)
+    return ((xmin, ymin, -dz, xmax, ymax, dz), dphi / 2.0 * (rmax * rmax - rmin * rmin) * 2.0 * dz)
+
+
+def shape_cons(p):
+    dz = p['DZ']
+    rmax = max(p['RMax1'], p['RMax2'])
+    rmin = min(p['RMin1'], p['RMin2'])
+    (xmin, ymin, xmax, ymax) = arc_extent(rmin, rmax, p['SPhi'], p['DPhi'])
+    volume = cone_volume(p['RMin1'], p['RMax1'], p['RMin2'], p['RMax2'], 2.0 * dz, p['DPhi'])
+    return ((xmin, ymin, -dz, xmax, ymax, dz), volume)
+
+
+def shape_trd(p):
+    (x1, x2, y1, y2, dz) = (p['XHalfLength1'], p['XHalfLength2'], p['YHalfLength1'], p['YHalfLength2'],
+                            p['ZHalfLength'])
+    extent = box_extent(max(x1, x2), max(y1, y2), dz)
+    (a, b) = (x2 - x1, y2 - y1)
+    volume = 8.0 * dz * (x1 * y1 + (x1 * b + y1 * a) / 2.0 + a * b / 3.0)
+    return (extent, volume)
+
+
+def trap_vertices(p):
+    """ the 8 corners of a Trap, as in G4Trap """
+    dz = p['ZHalfLength']
+    ttheta = math.tan(p['Theta'])
+    (tcphi, tsphi) = (ttheta * math.cos(p['Phi']), ttheta * math.sin(p['Phi']))
+    (dy1, dx1, dx2, ta1) = (p['Dydzn'], p['Dxdyndzn'], p['Dxdypdzn'], math.tan(p['Angleydzn']))
+    (dy2, dx3, dx4, ta2) = (p['Dydzp'], p['Dxdyndzp'], p['Dxdypdzp'], math.tan(p['Angleydzp']))
+    return [(-dz * tcphi - dy1 * ta1 - dx1, -dz * tsphi - dy1, -dz),
+            (-dz * tcphi - dy1 * ta1 + dx1, -dz * tsphi - dy1, -dz),
+            (-dz * tcphi + dy1 * ta1 - dx2, -dz * tsphi + dy1, -dz),
+            (-dz * tcphi + dy1 * ta1 + dx2, -dz * tsphi + dy1, -dz),
+            (dz * tcphi - dy2 * ta2 - dx3, dz * tsphi - dy2, dz),
+            (dz * tcphi - dy2 * ta2 + dx3, dz * tsphi - dy2, dz),
+            (dz * tcphi + dy2 * ta2 - dx4, dz * tsphi + dy2, dz),
+            (dz * tcphi + dy2 * ta2 + dx4, dz * tsphi + dy2, dz)]
+
+
+def shape_trap(p):
+    vertices = np.array(trap_vertices(p))
+    extent = tuple(vertices.min(axis=0).tolist() + vertices.max(axis=0).tolist())
+    # the z sections are trapezoids of area 2 * (dx_low + dx_high) * dy, all linear in z
+    (s1, dy1) = (p['Dxdyndzn'] + p['Dxdypdzn'], p['Dydzn'])
+    (s2, dy2) = (p['Dxdyndzp'] + p['Dxdypdzp'], p['Dydzp'])
+    (a, b) = (s2 - s1, dy2 - dy1)
+    volume = 4.0 * p['ZHalfLength'] * (s1 * dy1 + (s1 * b + dy1 * a) / 2.0 + a * b / 3.0)
+    return (extent, volume)
+
+
+def planes(p):
+    """ (z, rmin, rmax) of the planes of a Pcon or Pgon """
+    return list(zip(as_list(p['ZPos']), as_list(p['ZRmin']), as_list(p['ZRmax'])))
+
+
+def shape_pcon(p):
+    zplanes = planes(p)
+    (sphi, dphi) = (p['SPhi'], p['DPhi'])
+    volume = 0.0
+    for ((z1, rmin1, rmax1), (z2, rmin2, rmax2)) in zip(zplanes, zplanes[1:]):
+        volume += cone_volume(rmin1, rmax1, rmin2, rmax2, abs(z2 - z1), dphi)
+    rmax = max(r for (_, _, r) in zplanes)
+    rmin = min(r for (_, r, _) in zplanes)
+    (xmin, ymin, xmax, ymax) = arc_extent(rmin, rmax, sphi, dphi)
+    zs = [z for (z, _, _) in zplanes]
+    return ((xmin, ymin, min(zs), xmax, ymax, max(zs)), volume)
+
+
+def shape_pgon(p):
+    """ radii of a Pgon are measured to the middle of the sides """
+    zplanes = planes(p)
+    (sphi, dphi, nsides) = (p['SPhi'], p['DPhi'], int(p['NSides']))
+    half = dphi / nsides / 2.0
+    factor = nsides * math.tan(half)  # polygon area is factor * apothem**2
+    volume = 0.0
+    for ((z1, rmin1, rmax1), (z2, rmin2, rmax2)) in zip(zplanes, zplanes[1:]):
+        outer = rmax1 * rmax1 + rmax1 * rmax2 + rmax2 * rmax2
+        inner = rmin1 * rmin1 + rmin1 * rmin2 + rmin2 * rmin2
+        volume += factor * abs(z2 - z1) / 3.0 * (outer - inner)
+    corner = 1.0 / math.cos(half)
+    rmax = max(r for (_, _, r) in zplanes) * corner
+    rmin = min(r for (_, r, _) in zplanes) * corner
+    angles = [sphi + k * 2.0 * half for k in range(nsides + 1)]
+    points = [(rmax * math.cos(a), rmax * math.sin(a)) for a in angles]
+    if dphi < TWO_PI - 1e-9:
+        points += [(rmin * math.cos(a), rmin * math.sin(a)) for a in (angles[0], angles[-1])]
+    zs = [z for (z, _, _) in zplanes]
+    return ((min(x for (x, _) in points), min(y for (_, y) in points), min(zs),
+             max(x for (x, _) in points), max(y for (_, y) in points), max(zs)), volume)
+
+
+SHAPES = {'Box': shape_box, 'Tube': shape_tube, 'Tubs': shape_tubs, 'Cons': shape_cons,
+          'Trd': shape_trd, 'Trap': shape_trap, 'Pcon': shape_pcon, 'Pgon': shape_pgon}
+
+
+class ShapeParser():
+    """ parses each Shapes row once.
+    get_shape(id) returns the (type, parameters) of a Shapes row,
+    get_transform(id) the 4x4 matrix of a Transforms row (for Shift).
+    """
+    def __init__(self, get_shape, get_transform):
+        self.get_shape = get_shape
+        self.get_transform = get_transform
+        self.shapes = {}  # shape id -> parsed shape
+        self.unknown = set()  # shape types without extent and volume
+
+    def parse(self, shape_id):
+        """ dict with type, params, extent and volume of a Shapes row """
+        if shape_id not in self.shapes:
+            (shape_type, parameters) = self.get_shape(shape_id)
+            self.shapes[shape_id] = self.parse_row(shape_type, parameters)
+        return self.shapes[shape_id]
+
+    def parse_row(self, shape_type, parameters):
+        params = parse_parameters(parameters)
+        shape = {'type': shape_type, 'params': params, 'extent': None, 'volume': None}
+        try:
+            if shape_type in SHAPES:
+                (shape['extent'], shape['volume']) = SHAPES[shape_type](params)
+            elif shape_type in BOOLEAN_TYPES:
+                (shape['extent'], shape['volume']) = self.boolean(shape_type, params)
+            elif shape_type not in self.unknown:
+                self.unknown.add(shape_type)
+                logging.warning("shape type %s is not parsed", shape_type)
+        except (KeyError, TypeError, ValueError, ZeroDivisionError) as e:
+            logging.warning("could not parse %s shape %r: %s", shape_type, parameters, e)
+        return shape
+
+    def boolean(self, shape_type, params):
+        if shape_type == 'Shift':
+            shape_a = self.parse(int(params['A']))
+            if shape_a['extent'] is None:
+                return (None, shape_a['volume'])
+            mat = self.get_transform(int(params['X']))
+            return (transformed_extent(shape_a['extent'], mat), shape_a['volume'])
+        shape_a = self.parse(int(params['opA']))
+        shape_b = self.parse(int(params['opB']))
+        (ea, eb) = (shape_a['extent'], shape_b['extent'])
+        if shape_type == 'Subtraction':
+            return (ea, None)
+        if ea is None or eb is None:
+            return (None, None)
+        if shape_type == 'Union':
+            return (tuple(min(ea[i], eb[i]) for i in range(3)) + tuple(max(ea[i], eb[i]) for i in range(3, 6)),
+                    None)
+        extent = tuple(max(ea[i], eb[i]) for i in range(3)) + tuple(min(ea[i], eb[i]) for i in range(3, 6))
+        if any(extent[i] > extent[i + 3] for i in range(3)):
+            return (None, 0.0)  # the boxes don't overlap, the intersection is empty
+        return (extent, None)
+
+
+def extent_fields(extent):
+    """ the extent as named numeric document fields """
+    if extent is None:
+        return None
+    return dict(zip(('xmin', 'ymin', 'zmin', 'xmax', 'ymax', 'zmax'), extent))
@@ -0,0 +1,201 @@
+"""
+Output sinks for the flattened volume documents.
+
+Every sink has write(doc) and close(), close() returns a dict of stats.
+    NdjsonSink - one JSON document per line into a file, optionally gzip or zstd compressed
+    StdoutSink - one JSON document per line to stdout
+    NullSink   - drops the documents, only counts them
+    EsSink     - bulk indexing into Elasticsearch (see es_bulk)
+read_documents(path) reads an NDJSON output back.
+"""
+
+import io
+import os
+import sys
+import json
+import gzip
+import time
+
+SINKS = ('es', 'ndjson', 'stdout', 'null')
+
+
+class Sink():
+    """ base class, counts documents """
+    def __init__(self):
+        self.docs = 0
+        self.start = time.time()
+        self.serialize_seconds = None  # time spent in json.dumps, if the sink measures it
+
+    def write(self, doc):
+        raise NotImplementedError
+
+    def close(self):
+        elapsed = time.time() - self.start
+        stats = {'docs': self.docs, 'seconds': round(elapsed, 3),
+                 'docs_per_s': round(self.docs / elapsed, 1) if elapsed > 0 else 0.0}
+        if self.serialize_seconds is not None:
+            stats['serialize_seconds'] = round(self.serialize_seconds, 6)
+        return stats
+
+
+class NdjsonSink(Sink):
+    """ path - output file, compression is guessed from .gz/.zst if not given
+    compression - None, 'gzip' or 'zstd' (needs the zstandard package)
+    buffer_size - bytes collected before writing to the file
+    """
+    def __init__(self, path, compression=None, buffer_size=1024 * 1024, level=None):
+        Sink.__init__(self)
+        if compression is None:
+            if path.endswith('.gz'):
+                compression = 'gzip'
+            elif path.endswith('.zst'):
+                compression = 'zstd'
+        self.path = path
+        self.compression = compression
+        self.raw = open(path, 'wb')
+        if compression == 'gzip':
+            self.out = gzip.GzipFile(fileobj=self.raw, mode='wb', compresslevel=level or 6)
+        elif compression == 'zstd':
+            try:
+                import zstandard
+            except ImportError:
+                self.raw.close()
+                raise RuntimeError('zstd output needs the zstandard package')
+            self.out = zstandard.ZstdCompressor(level=level or 3).stream_writer(self.raw)
+        elif compression is None:
+            self.out = self.raw
+        else:
+            self.raw.close()
+            raise ValueError('unknown compression %s' % compression)
+        self.buffer = io.StringIO()
+        self.buffered = 0
+        self.buffer_size = buffer_size
+        self.bytes = 0
+        self.serialize_seconds = 0.0
+
+    def write(self, doc):
+        start = time.perf_counter()
+        line = json.dumps(doc) + '\n'
+        self.serialize_seconds += time.perf_counter() - start
+        self.buffer.write(line)
+        self.buffered += len(line)
+        self.docs += 1
+        if self.buffered >= self.buffer_size:
+            self.flush()
+
+    def flush(self):
+        data = self.buffer.getvalue().encode('utf-8')
+        self.out.write(data)
+        self.bytes += len(data)
+        self.buffer = io.StringIO()
+        self.buffered = 0
+
+    def close(self):
+        self.flush()
+        if self.out is not self.raw:
+            self.out.close()
+        if not self.raw.closed:
+            self.raw.close()
+        stats = Sink.close(self)
+        stats['bytes'] = self.bytes
+        stats['file_bytes'] = os.path.getsize(self.path)
+        stats['path'] = self.path
+        return stats
+
+
+class StdoutSink(Sink):
+    """ NDJSON to stdout, or any other text stream """
+    def __init__(self, stream=None):
+        Sink.__init__(self)
+        self.stream = stream if stream is not None else sys.stdout
+        self.serialize_seconds = 0.0
+        self.bytes = 0
+
+    def write(self, doc):
+        start = time.perf_counter()
+        line = json.dumps(doc) + '\n'
+        self.serialize_seconds += time.perf_counter() - start
+        self.stream.write(line)
+        self.bytes += len(line)
+        self.docs += 1
+
+    def close(self):
+        self.stream.flush()
+        stats = Sink.close(self)
+        stats['bytes'] = self.bytes
+        return stats
+
+
+class NullSink(Sink):
+    """ counts and drops the documents, eg. when only a manifest is wanted """
+    def write(self, doc):
+        self.docs += 1
+
+
+class EsSink(Sink):
+    """ index - target index, doc_type - mapping type of the documents
+    host - 'host:port' of Elasticsearch, the client is created here
+    the other options are passed to es_bulk.BulkIndexer
+    """
+    def __init__(self, host, index='atlas_geo', doc_type='vol', **bulk_options):
+        Sink.__init__(self)
+        from elasticsearch import Elasticsearch
+        from es_bulk import BulkIndexer
+        (es_host, es_port) = host.rsplit(':', 1)
+        es = Elasticsearch([{'host': es_host, 'port': int(es_port)}], timeout=60,
+                           maxsize=bulk_options.get('threads', 4))
+        self.index = index
+        self.doc_type = doc_type
+        self.indexer = BulkIndexer(es, **bulk_options)
+
+    def write(self, doc):
+        doc['_index'] = self.index
+        doc['_type'] = self.doc_type
+        self.indexer.add(doc)
+        self.docs += 1
+
+    def write_batch(self, docs):
+        """ indexes the documents as one bulk request in the calling thread,
+        for callers keeping several requests in flight themselves (gm2json --pipeline)
+        """
+        from es_bulk import bulk_lines
+        chunk = []
+        for doc in docs:
+            doc['_index'] = self.index
+            doc['_type'] = self.doc_type
+            chunk.append((doc, bulk_lines(doc)))
+        self.indexer.count('docs', len(chunk))
+        self.indexer.send(chunk)
+
+    def close(self):
+        return self.indexer.close()
+
+
+def read_documents(path):
+    """ yields the documents of an NDJSON file written by NdjsonSink (plain, .gz or .zst) """
+    if path.endswith('.gz'):
+        stream = io.TextIOWrapper(gzip.open(path, 'rb'), encoding='utf-8')
+    elif path.endswith('.zst'):
+        import zstandard
+        stream = io.TextIOWrapper(zstandard.ZstdDecompressor().stream_reader(open(path, 'rb')), encoding='utf-8')
+    else:
+        stream = open(path, encoding='utf-8')
+    with stream:
+        for line in stream:
+            if line.strip():
+                yield json.loads(line)
+
+
+def open_sink(kind, output=None, compression=None, **es_options):
+    """ creates a sink by name, see SINKS """
+    if kind == 'ndjson':
+        if not output:
+            raise ValueError('the ndjson sink needs an output file')
+        return NdjsonSink(output, compression)
+    if kind == 'stdout':
+        return StdoutSink()
+    if kind == 'null':
+        return NullSink()
+    if kind == 'es':
+        return EsSink(**es_options)
+    raise ValueError('unknown sink %s' % kind)
@@ -0,0 +1,375 @@
+#!/usr/bin/env python
+"""
+Columnar snapshot of a GeoModel SQLite geometry.
+
+A one time compile step reads the whole DB into flat arrays and writes
+them into one file:
+    geo_snapshot.py geometry_atlas_20Apr17.db -o geometry_atlas_20Apr17.snap
+Later runs map the file with numpy.memmap instead of reading SQLite, so
+opening it costs nothing and worker processes share its pages:
+    gm2json.py -i geometry_atlas_20Apr17.snap -s ndjson -o docs.ndjson.zst
+
+Layout: the magic, the offset and the length of a JSON header, then the
+arrays, each aligned to 64 bytes, then the header. It lists every array
+with its dtype, shape and offset, the tables with their columns, the root
+volume and the DB schema. Arrays:
+    <table>.id                  row ids, sorted
+    <table>.<column>            int or float values, text as ids into the string table
+    <table>.<column>.null       True where an int or real column is NULL, only if it has NULLs
+    <table>.rows                (N, 12) Transforms/AlignableTransforms in the document layout
+    children.<parentTable>      ChildrenPositions offsets, in CSR layout as gm2json.ChildrenIndex
+    children.id, children.table, children.child, children.position
+                                the rows, sorted by (parentTable, parentId, position)
+    strings.data, strings.offsets
+                                interned text: names, materials, shape types and parameters, ...
+"""
+
+import os
+import sys
+import json
+import time
+import sqlite3
+import argparse
+
+import numpy as np
+
+from geo_transforms import ROW_FIELDS
+
+MAGIC = b'GEOSNAP1'
+VERSION = 1
+PREAMBLE = 24  # magic, header offset, header length
+ALIGN = 64
+MATRIX_TABLES = ('Transforms', 'AlignableTransforms')
+CHILDREN_TABLE = 'ChildrenPositions'
+
+
+def is_snapshot(path):
+    """ True if path is a compiled snapshot rather than a SQLite DB """
+    with open(path, 'rb') as f:
+        return f.read(len(MAGIC)) == MAGIC
+
+
+def int_array(values):
+    """ int32 when the values fit, int64 otherwise """
+    a = np.asarray(values, dtype=np.int64)
+    if len(a) and (a.min() < -2**31 or a.max() >= 2**31):
+        return a
+    return a.astype(np.int32)
+
+
+def column_kind(values, declared):
+    """ int, real or text, from the values SQLite returns, or the declared type of an empty column """
+    kinds = set(type(v) for v in values if v is not None)
+    if not kinds:
+        declared = (declared or '').upper()
+        if 'INT' in declared:
+            return 'int'
+        if 'REAL' in declared or 'FLOA' in declared or 'DOUB' in declared:
+            return 'real'
+        return 'text'
+    if kinds <= set([int]):
+        return 'int'
+    if kinds <= set([int, float]):
+        return 'real'
+    return 'text'
+
+
+class StringTable():
+    """ interns text values into one utf-8 blob """
+    def __init__(self):
+        self.ids = {}
+        self.data = bytearray()
+        self.offsets = [0]
+
+    def intern(self, value):
+        if value is None:
+            return -1
+        value = value if isinstance(value, str) else str(value)
+        k = self.ids.get(value)
+        if k is None:
+            k = len(self.offsets) - 1
+            self.ids[value] = k
+            self.data += value.encode('utf-8')
+            self.offsets.append(len(self.data))
+        return k
+
+    def arrays(self):
+        return (np.frombuffer(bytes(self.data), dtype=np.uint8), np.asarray(self.offsets, dtype=np.int64))
+
+
+def compile_table(db, table_name, strings, arrays):
+    """ adds the arrays of one table, returns its header entry """
+    info = [(r[1], r[2]) for r in db.execute('PRAGMA table_info("%s")' % table_name)]
+    names = [name for (name, _) in info]
+    order = ' ORDER BY id' if 'id' in names else ''
+    rows = db.execute('SELECT * FROM "%s"%s' % (table_name, order)).fetchall()
+    ids = [r[names.index('id')] for r in rows] if 'id' in names else list(range(1, len(rows) + 1))
+    arrays['%s.id' % table_name] = int_array(ids)
+    first = ids[0] if ids and ids[-1] - ids[0] == len(ids) - 1 else None
+
+    columns = []
+    matrix = table_name in MATRIX_TABLES and all(f in names for f in ROW_FIELDS)
+    if matrix:
+        fields = [names.index(f) for f in ROW_FIELDS]
+        arrays['%s.rows' % table_name] = np.array([[r[k] for k in fields] for r in rows],
+                                                  dtype=np.float64).reshape(-1, 12)
+    for (k, (name, declared)) in enumerate(info):
+        if name == 'id':
+            columns.append((name, 'id'))
+            continue
+        if matrix and name in ROW_FIELDS:
+            columns.append((name, 'matrix'))
+            continue
+        values = [r[k] for r in rows]
+        kind = column_kind(values, declared)
+        key = '%s.%s' % (table_name, name)
+        if kind == 'text':
+            arrays[key] = int_array([strings.intern(v) for v in values])
+        else:
+            nulls = np.array([v is None for v in values], dtype=bool)
+            filled = [0 if v is None else v for v in values]
+            arrays[key] = np.asarray(filled, dtype=np.int64 if kind == 'int' else np.float64)
+            if nulls.any():
+                arrays[key + '.null'] = nulls
+        columns.append((name, kind))
+    return {'rows': len(rows), 'first': first, 'columns': columns}
+
+
+def compile_children(db, arrays):
+    """ ChildrenPositions as CSR: offsets per parent table, rows column-wise """
+    rows = db.execute('SELECT id, parentTable, parentId, childTable, childId, position FROM %s '
+                      'ORDER BY parentTable, parentId, position' % CHILDREN_TABLE).fetchall()
+    cols = np.array(rows, dtype=np.int64).reshape(-1, 6)
+    parents = []
+    for parent_table in np.unique(cols[:, 1]).tolist():
+        rows_of_table = np.flatnonzero(cols[:, 1] == parent_table)
+        counts = np.bincount(cols[rows_of_table, 2])
+        offsets = np.zeros(len(counts) + 1, dtype=np.int64)
+        np.cumsum(counts, out=offsets[1:])
+        arrays['children.%d' % parent_table] = offsets + rows_of_table[0]
+        parents.append(parent_table)
+    arrays['children.id'] = int_array(cols[:, 0])
+    arrays['children.table'] = int_array(cols[:, 3])
+    arrays['children.child'] = int_array(cols[:, 4])
+    arrays['children.position'] = int_array(cols[:, 5])
+    return {'rows': len(cols), 'parent_tables': parents}
+
+
+def write_snapshot(path, arrays, header):
+    """ writes the arrays and the header, through a temporary file """
+    tmp = path + '.tmp'
+    specs = {}
+    with open(tmp, 'wb') as f:
+        f.write(b'\0' * PREAMBLE)
+        for (name, a) in arrays.items():
+            a = np.ascontiguousarray(a)
+            f.write(b'\0' * (-f.tell() % ALIGN))
+            specs[name] = {'dtype': a.dtype.str, 'shape': list(a.shape), 'offset': f.tell()}
+            f.write(a.tobytes())
+        header['arrays'] = specs
+        blob = json.dumps(header).encode('utf-8')
+        offset = f.tell()
+        f.write(blob)
+        f.seek(0)
+        f.write(MAGIC + np.array([offset, len(blob)], dtype='<u8').tobytes())
+    os.replace(tmp, path)
+
+
+def compile_snapshot(db_path, path):
+    """ compiles the SQLite geometry db_path into the snapshot file path """
+    if not os.path.isfile(db_path):
+        raise IOError('could not find the input DB file %s' % db_path)
+    start = time.time()
+    db = sqlite3.connect('file:%s?mode=ro' % db_path, uri=True)
+    tables = db.execute("SELECT name, sql FROM sqlite_master WHERE type='table' "
+                        "AND name NOT LIKE 'sqlite_%' ORDER BY name").fetchall()
+    strings = StringTable()
+    arrays = {}
+    header = {'version': VERSION, 'source': os.path.abspath(db_path),
+              'schema': [sql for (_, sql) in tables], 'tables': {}}
+    for (table_name, _) in tables:
+        if table_name == CHILDREN_TABLE:
+            header['children'] = compile_children(db, arrays)
+        else:
+            header['tables'][table_name] = compile_table(db, table_name, strings, arrays)
+    root = db.execute('SELECT volId, volTable FROM RootVolume').fetchone()
+    header['root'] = list(root) if root else None
+    (arrays['strings.data'], arrays['strings.offsets']) = strings.arrays()
+    header['strings'] = len(strings.ids)
+    db.close()
+    write_snapshot(path, arrays, header)
+    return {'tables': len(header['tables']), 'rows': sum(t['rows'] for t in header['tables'].values()),
+            'children': header.get('children', {}).get('rows', 0), 'strings': len(strings.ids),
+            'bytes': os.path.getsize(path), 'seconds': round(time.time() - start, 3)}
+
+
+class SnapshotRow():
+    """ a table row read from a snapshot, used like the mapped ORM objects:
+    columns are attributes, as_dict() returns them all
+    """
+    def __init__(self, table_name, columns, values):
+        self.__tablename__ = table_name
+        self._columns = columns
+        for (name, value) in zip(columns, values):
+            setattr(self, name, value)
+
+    def as_dict(self):
+        return {c: getattr(self, c) for c in self._columns}
+
+    def __repr__(self):
+        return self.as_dict().__str__()
+
+
+class Snapshot():
+    """ read only view of a compiled snapshot, every array is a slice of one numpy.memmap """
+    def __init__(self, path):
+        with open(path, 'rb') as f:
+            preamble = f.read(PREAMBLE)
+        if preamble[:len(MAGIC)] != MAGIC:
+            raise ValueError('%s is not a geometry snapshot' % path)
+        (offset, length) = np.frombuffer(preamble[len(MAGIC):], dtype='<u8').tolist()
+        self.path = path
+        self.buffer = np.memmap(path, dtype=np.uint8, mode='r')
+        self.header = json.loads(bytes(self.buffer[offset:offset + length]).decode('utf-8'))
+        if self.header['version'] != VERSION:
+            raise ValueError('%s is a version %s snapshot, expected %s' % (path, self.header['version'], VERSION))
+        self.arrays = {}
+        for (name, spec) in self.header['arrays'].items():
+            dtype = np.dtype(spec['dtype'])
+            first = spec['offset']
+            last = first + int(np.prod(spec['shape'])) * dtype.itemsize
+            self.arrays[name] = self.buffer[first:last].view(dtype).reshape(spec['shape'])
+        self.tables = self.header['tables']
+        self.schema = self.header['schema']
+        self.root = tuple(self.header['root']) if self.header['root'] else None
+        self.children_offsets = {}
+        for parent_table in self.header.get('children', {}).get('parent_tables', []):
+            self.children_offsets[parent_table] = self.arrays['children.%d' % parent_table]
+        self.strings = {}  # string id -> decoded text
+        self.accessors = {}  # table name -> column names and getters
+
+    def __len__(self):
+        return sum(t['rows'] for t in self.tables.values())
+
+    def string(self, k):
+        """ text of an interned string id, None for -1 """
+        if k < 0:
+            return None
+        text = self.strings.get(k)
+        if text is None:
+            (first, last) = self.arrays['strings.offsets'][k:k + 2].tolist()
+            text = bytes(self.arrays['strings.data'][first:last]).decode('utf-8')
+            self.strings[k] = text
+        return text
+
+    def column(self, table_name, column):
+        """ the raw array of a column, text columns hold string ids """
+        return self.arrays['%s.%s' % (table_name, column)]
+
+    def ids(self, table_name):
+        return self.arrays['%s.id' % table_name]
+
+    def row_index(self, table_name, row_id):
+        """ position of a row in the column arrays, KeyError if there is no such row """
+        info = self.tables[table_name]
+        if info['first'] is not None:
+            i = row_id - info['first']
+            if 0 <= i < info['rows']:
+                return i
+        else:
+            ids = self.ids(table_name)
+            i = int(np.searchsorted(ids, row_id))
+            if i < len(ids) and ids[i] == row_id:
+                return i
+        raise KeyError('%s has no row %s' % (table_name, row_id))
+
+    def table_accessors(self, table_name):
+        """ column names and a getter (row index -> python value) per column """
+        if table_name not in self.accessors:
+            names = []
+            getters = []
+            for (name, kind) in self.tables[table_name]['columns']:
+                names.append(name)
+                getters.append(self.getter(table_name, name, kind))
+            self.accessors[table_name] = (tuple(names), getters)
+        return self.accessors[table_name]
+
+    def getter(self, table_name, name, kind):
+        if kind == 'id':
+            ids = self.ids(table_name)
+            return lambda i: int(ids[i])
+        if kind == 'matrix':
+            rows = self.arrays['%s.rows' % table_name]
+            k = ROW_FIELDS.index(name)
+            return lambda i: float(rows[i, k])
+        values = self.column(table_name, name)
+        if kind == 'text':
+            return lambda i: self.string(int(values[i]))
+        nulls = self.arrays.get('%s.%s.null' % (table_name, name))
+        if nulls is None:
+            return lambda i: values[i].item()
+        return lambda i: None if nulls[i] else values[i].item()
+
+    def row(self, table_name, row_id):
+        """ SnapshotRow of a table row """
+        i = self.row_index(table_name, row_id)
+        (names, getters) = self.table_accessors(table_name)
+        return SnapshotRow(table_name, names, [get(i) for get in getters])
+
+    def one(self, table_name):
+        """ the first row of a table, eg. RootVolume """
+        return self.row(table_name, int(self.ids(table_name)[0]))
+
+    def transform_rows(self, table_name):
+        """ (N, 12) transforms of a Transforms or AlignableTransforms table, by row index """
+        return self.arrays['%s.rows' % table_name]
+
+    def children_range(self, node_id, node_table):
+        """ first and last row of the children of a volume in the children arrays """
+        offsets = self.children_offsets.get(node_table)
+        if offsets is None or node_id + 1 >= len(offsets):
+            return (0, 0)
+        return (int(offsets[node_id]), int(offsets[node_id + 1]))
+
+    def children(self, node_id, node_table):
+        """ same tuples as gm2json.get_children_of_this_vol, ordered by position """
+        (first, last) = self.children_range(node_id, node_table)
+        if first == last:
+            return []
+        return list(zip(self.arrays['children.id'][first:last].tolist(), [node_id] * (last - first),
+                        self.arrays['children.table'][first:last].tolist(),
+                        self.arrays['children.child'][first:last].tolist(),
+                        self.arrays['children.position'][first:last].tolist()))
+
+    def parents(self, node_id, node_table):
+        """ (parentTable, parentId) of the children rows that place a node, a scan of the children arrays """
+        rows = np.flatnonzero((self.arrays['children.child'] == node_id) &
+                              (self.arrays['children.table'] == node_table))
+        out = []
+        for row in rows.tolist():
+            for (parent_table, offsets) in self.children_offsets.items():
+                if offsets[0] <= row < offsets[-1]:
+                    out.append((parent_table, int(np.searchsorted(offsets, row, 'right')) - 1))
+                    break
+        return out
+
+    def info(self):
+        """ row counts and sizes, for --info """
+        return {'source': self.header['source'], 'bytes': len(self.buffer),
+                'tables': {name: t['rows'] for (name, t) in sorted(self.tables.items())},
+                'children': self.header.get('children', {}).get('rows', 0), 'strings': self.header['strings'],
+                'arrays': len(self.arrays)}
+
+
+if __name__ == '__main__':
+    PARSER = argparse.ArgumentParser(description='Compiles a GeoModel SQLite geometry into a memory-mapped snapshot.')
+    PARSER.add_argument('input', help='SQLite geometry file, or a snapshot with --info')
+    PARSER.add_argument('-o', '--output', help='snapshot file, default: the input file name with a .snap extension')
+    PARSER.add_argument('--info', action='store_true', help='print the tables of a snapshot')
+    ARGS = PARSER.parse_args()
+
+    if ARGS.info:
+        print(json.dumps(Snapshot(ARGS.input).info(), indent=2))
+        sys.exit()
+    OUTPUT = ARGS.output or os.path.splitext(ARGS.input)[0] + '.snap'
+    print('compiled %s:' % OUTPUT, compile_snapshot(ARGS.input, OUTPUT))
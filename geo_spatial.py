@@ -0,0 +1,338 @@
+"""
+Point location in the flattened geometry: which volume is at x, y, z.
+
+SpatialIndex is built from the documents written by gm2json (read back
+with geo_sinks.read_documents). The local extent of every volume's shape
+is turned into a world axis aligned box with the volume's transform.
+
+The volume tree itself is the bounding volume hierarchy: the documents
+come in depth first order, so the mother of a volume is the last volume
+before it with a smaller depth. Every mother gets a uniform grid of cells
+over the boxes of its daughters (like the smart voxels of Geant4), with
+every daughter listed in the cells its box overlaps. A batch of points
+goes down the tree together, one level per numpy step: find the cell of
+the mother, test the daughters listed there, continue in the daughters
+that contain the point.
+
+A point is tested in the local frame of the volume: Box, Tube, Tubs,
+Cons and Trd exactly, the other shapes against their local extent, ie. an
+oriented box around the shape. As in Geant4, a point is only found in a
+volume if it is inside all the ancestors of the volume too.
+
+    index = SpatialIndex.from_file('atlas_geo.ndjson.gz')
+    vols = index.deepest(points)             # (N,) volume numbers, -1 where there is none
+    (pts, vols) = index.containing(points)   # all (point, volume) pairs, outermost first
+    index.volume(vols[0])                    # document number, name, tags, depth
+"""
+
+import time
+import argparse
+from operator import itemgetter
+
+import numpy as np
+
+import geo_transforms
+import geo_sinks
+
+TWO_PI = 2.0 * np.pi
+TOLERANCE = 1e-6  # mm, points this close to a surface are inside
+MAX_CELLS = 64  # cells along one axis of the grid of a mother
+CELLS_PER_DAUGHTER = 4  # limits the total number of cells of a mother
+BATCH = 65536  # points going down the tree together
+EXTENT_FIELDS = itemgetter('xmin', 'ymin', 'zmin', 'xmax', 'ymax', 'zmax')
+
+# narrow phase tests
+OBB = 0  # the local extent
+CONS = 1  # Tube, Tubs and Cons
+TRD = 2
+
+
+def narrow_params(doc):
+    """ narrow phase test and its 7 parameters for a document """
+    shape = doc.get('shape')
+    p = doc.get('shape_params') or {}
+    try:
+        if shape == 'Tube':
+            return (CONS, (p['RMin'], p['RMin'], p['RMax'], p['RMax'], p['ZHalfLength'], 0.0, TWO_PI))
+        if shape == 'Tubs':
+            return (CONS, (p['RMin'], p['RMin'], p['RMax'], p['RMax'], p['ZHalfLength'], p['SPhi'], p['DPhi']))
+        if shape == 'Cons':
+            return (CONS, (p['RMin1'], p['RMin2'], p['RMax1'], p['RMax2'], p['DZ'], p['SPhi'], p['DPhi']))
+        if shape == 'Trd':
+            return (TRD, (p['XHalfLength1'], p['XHalfLength2'], p['YHalfLength1'], p['YHalfLength2'],
+                          p['ZHalfLength'], 0.0, 0.0))
+    except KeyError:
+        pass
+    return (OBB, (0.0,) * 7)
+
+
+def inside_cons(local, params):
+    """ local points against (rmin1, rmin2, rmax1, rmax2, dz, sphi, dphi) """
+    (rmin1, rmin2, rmax1, rmax2, dz, sphi, dphi) = params.T
+    (x, y, z) = local.T
+    t = (z + dz) / (2.0 * dz)
+    r = np.hypot(x, y)
+    ok = (r >= rmin1 + (rmin2 - rmin1) * t - TOLERANCE) & (r <= rmax1 + (rmax2 - rmax1) * t + TOLERANCE)
+    partial = dphi < TWO_PI - 1e-9
+    if partial.any():
+        phi = np.mod(np.arctan2(y, x) - sphi, TWO_PI)
+        ok &= ~partial | (phi <= dphi + 1e-9) | (r <= TOLERANCE)
+    return ok
+
+
+def inside_trd(local, params):
+    """ local points against (x1, x2, y1, y2, dz) """
+    (x1, x2, y1, y2, dz, _, _) = params.T
+    (x, y, z) = local.T
+    t = (z + dz) / (2.0 * dz)
+    return (np.abs(x) <= x1 + (x2 - x1) * t + TOLERANCE) & (np.abs(y) <= y1 + (y2 - y1) * t + TOLERANCE)
+
+
+def mothers(depths):
+    """ the mother of every volume in depth first order, -1 for the top ones """
+    out = np.empty(len(depths), dtype=np.int64)
+    stack = []
+    for (i, depth) in enumerate(depths):
+        while stack and depths[stack[-1]] >= depth:
+            stack.pop()
+        out[i] = stack[-1] if stack else -1
+        stack.append(i)
+    return out
+
+
+class SpatialIndex():
+    """ the volume tree with a grid of the daughters in every mother.
+    docs - the flattened volume documents, the ones without an extent are skipped
+    """
+    def __init__(self, docs):
+        rows = []
+        extents = []
+        kinds = []
+        params = []
+        self.doc_numbers = []
+        self.names = []
+        self.tags = []
+        self.shapes = []
+        depths = []
+        self.skipped = 0
+        for (number, doc) in enumerate(docs):
+            extent = doc.get('extent')
+            if not extent:
+                self.skipped += 1
+                continue
+            rows.append(doc['transform'])
+            extents.append(EXTENT_FIELDS(extent))
+            (kind, par) = narrow_params(doc)
+            kinds.append(kind)
+            params.append(par)
+            self.doc_numbers.append(number)
+            self.names.append(doc.get('name'))
+            self.tags.append(doc.get('tags'))
+            self.shapes.append(doc.get('shape'))
+            depths.append(doc.get('depth', 0))
+        n = len(rows)
+        mats = geo_transforms.from_rows(np.asarray(rows, dtype=np.float64).reshape(n, 12))
+        inverse = geo_transforms.inverse(mats)
+        self.rot = np.ascontiguousarray(mats[:, :3, :3])
+        self.shift = np.ascontiguousarray(mats[:, :3, 3])
+        self.inv_rot = np.ascontiguousarray(inverse[:, :3, :3])
+        self.inv_shift = np.ascontiguousarray(inverse[:, :3, 3])
+        extents = np.asarray(extents, dtype=np.float64).reshape(n, 6)
+        self.local_lo = extents[:, :3] - TOLERANCE
+        self.local_hi = extents[:, 3:] + TOLERANCE
+        self.kind = np.asarray(kinds, dtype=np.int8)
+        self.params = np.asarray(params, dtype=np.float64).reshape(n, 7)
+        self.depth = np.asarray(depths, dtype=np.int32)
+
+        # world box: transformed center, half sizes through |rotation|
+        center = (extents[:, :3] + extents[:, 3:]) / 2.0
+        half = (extents[:, 3:] - extents[:, :3]) / 2.0
+        world_center = geo_transforms.apply(mats, center) if n else np.zeros((0, 3))
+        world_half = np.einsum('nij,nj->ni', np.abs(mats[:, :3, :3]), half)
+        self.lo = world_center - world_half - TOLERANCE
+        self.hi = world_center + world_half + TOLERANCE
+        self.build()
+
+    @classmethod
+    def from_file(cls, path):
+        """ index of an NDJSON output of gm2json """
+        return cls(geo_sinks.read_documents(path))
+
+    def __len__(self):
+        return len(self.depth)
+
+    def build(self):
+        """ grids of the daughters of every mother, the top volumes are
+        the daughters of a virtual mother with number len(self)
+        """
+        n = len(self)
+        mother = mothers(self.depth)
+        mother[mother < 0] = n
+        self.has_daughters = np.bincount(mother, minlength=n + 1) > 0
+
+        # the grid of a mother covers the boxes of its daughters,
+        # the cells are about half the mean size of a daughter
+        order = np.argsort(mother, kind='stable')
+        count = np.bincount(mother, minlength=n + 1)
+        start = np.cumsum(count) - count
+        with_daughters = np.flatnonzero(count)
+        self.grid_lo = np.zeros((n + 1, 3))
+        span = np.zeros((n + 1, 3))
+        size = np.ones((n + 1, 3))
+        if n:
+            first = start[with_daughters]
+            self.grid_lo[with_daughters] = np.minimum.reduceat(self.lo[order], first, axis=0)
+            span[with_daughters] = np.maximum.reduceat(self.hi[order], first, axis=0) - self.grid_lo[with_daughters]
+            size[with_daughters] = (np.add.reduceat((self.hi - self.lo)[order], first, axis=0) /
+                                    count[with_daughters, None])
+        cells = np.clip(np.floor(2.0 * span / np.maximum(size, 1e-9)), 1, MAX_CELLS)
+        total = cells.prod(axis=1)
+        shrink = np.minimum(1.0, (np.maximum(count, 1) * CELLS_PER_DAUGHTER / total) ** (1.0 / 3.0))
+        self.grid_cells = np.maximum(1, np.floor(cells * shrink[:, None])).astype(np.int64)
+        self.grid_scale = np.where(span > 0, self.grid_cells / np.where(span > 0, span, 1.0), 0.0)
+        total = self.grid_cells.prod(axis=1) * (count > 0)
+        self.grid_base = np.cumsum(total) - total
+
+        # every daughter goes into the cells its box overlaps
+        m = mother
+        first_cell = self.cell_of(self.lo, m)
+        last_cell = self.cell_of(self.hi, m)
+        extent = last_cell - first_cell + 1
+        entries = extent.prod(axis=1)
+        offset = np.arange(entries.sum()) - np.repeat(np.cumsum(entries) - entries, entries)
+        (nx, ny) = (np.repeat(extent[:, 0], entries), np.repeat(extent[:, 1], entries))
+        ix = np.repeat(first_cell[:, 0], entries) + offset % nx
+        iy = np.repeat(first_cell[:, 1], entries) + (offset // nx) % ny
+        iz = np.repeat(first_cell[:, 2], entries) + offset // (nx * ny)
+        daughter = np.repeat(np.arange(n), entries)
+        cell = self.cell_index(ix, iy, iz, m[daughter])
+        by_cell = np.argsort(cell, kind='stable')
+        self.cell_volumes = daughter[by_cell]
+        self.cell_start = np.zeros(total.sum() + 1, dtype=np.int64)
+        np.cumsum(np.bincount(cell, minlength=total.sum()), out=self.cell_start[1:])
+        # one row per mother and per volume, a pair needs a single gather
+        self.grid = np.hstack([self.grid_lo, self.grid_scale, self.grid_cells, self.grid_base[:, None]])
+        self.frame = np.hstack([self.inv_rot.reshape(n, 9), self.inv_shift, self.local_lo, self.local_hi])
+
+    def cell_of(self, points, m):
+        """ (ix, iy, iz) in the grid of mothers m, clipped to the grid """
+        c = np.floor((points - self.grid_lo[m]) * self.grid_scale[m]).astype(np.int64)
+        return np.clip(c, 0, self.grid_cells[m] - 1)
+
+    def cell_index(self, ix, iy, iz, m):
+        cells = self.grid_cells[m]
+        return self.grid_base[m] + (iz * cells[:, 1] + iy) * cells[:, 0] + ix
+
+    def daughters(self, points, p, m):
+        """ (point, daughter) pairs of the daughters of mothers m listed in the cell of the point """
+        g = self.grid.take(m, axis=0)
+        q = points.take(p, axis=0)
+        cx = np.floor((q[:, 0] - g[:, 0]) * g[:, 3])
+        cy = np.floor((q[:, 1] - g[:, 1]) * g[:, 4])
+        cz = np.floor((q[:, 2] - g[:, 2]) * g[:, 5])
+        inside = np.flatnonzero((cx >= 0) & (cx < g[:, 6]) & (cy >= 0) & (cy < g[:, 7]) &
+                                (cz >= 0) & (cz < g[:, 8]))
+        g = g.take(inside, axis=0)
+        cell = (g[:, 9] + (cz.take(inside) * g[:, 7] + cy.take(inside)) * g[:, 6] + cx.take(inside)).astype(np.int64)
+        first = self.cell_start.take(cell)
+        count = self.cell_start.take(cell + 1) - first
+        pos = np.arange(count.sum()) - np.repeat(np.cumsum(count) - count, count) + np.repeat(first, count)
+        return (np.repeat(p.take(inside), count), self.cell_volumes.take(pos))
+
+    def narrow(self, points, pp, vv):
+        """ keeps the pairs where the point is inside the shape """
+        f = self.frame.take(vv, axis=0)
+        q = points.take(pp, axis=0)
+        (x, y, z) = (q[:, 0], q[:, 1], q[:, 2])
+        lx = f[:, 0] * x + f[:, 1] * y + f[:, 2] * z + f[:, 9]
+        ly = f[:, 3] * x + f[:, 4] * y + f[:, 5] * z + f[:, 10]
+        lz = f[:, 6] * x + f[:, 7] * y + f[:, 8] * z + f[:, 11]
+        ok = ((lx >= f[:, 12]) & (lx <= f[:, 15]) & (ly >= f[:, 13]) & (ly <= f[:, 16]) &
+              (lz >= f[:, 14]) & (lz <= f[:, 17]))
+        kind = self.kind.take(vv)
+        for (k, test) in ((CONS, inside_cons), (TRD, inside_trd)):
+            sel = np.flatnonzero(ok & (kind == k))
+            if len(sel):
+                local = np.stack([lx.take(sel), ly.take(sel), lz.take(sel)], axis=1)
+                ok[sel] = test(local, self.params.take(vv.take(sel), axis=0))
+        ok = np.flatnonzero(ok)
+        return (pp.take(ok), vv.take(ok))
+
+    def containing(self, points):
+        """ all (point, volume) pairs with the point inside the volume,
+        sorted by point and, for a point, from the outermost volume in
+        """
+        points = np.asarray(points, dtype=np.float64).reshape(-1, 3)
+        out_p = []
+        out_v = []
+        for start in range(0, len(points), BATCH):
+            (pp, vv) = self.locate(points[start:start + BATCH])
+            out_p.append(pp + start)
+            out_v.append(vv)
+        if not out_p:
+            return (np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.int64))
+        return (np.concatenate(out_p), np.concatenate(out_v))
+
+    def locate(self, points):
+        """ containing pairs of one batch, by point and depth """
+        n = len(self)
+        p = np.arange(len(points) if n else 0)
+        m = np.full(len(p), n)
+        out_p = [p[:0]]
+        out_v = [m[:0]]
+        while len(p):
+            (p, m) = self.narrow(points, *self.daughters(points, p, m))
+            out_p.append(p)
+            out_v.append(m)
+            keep = np.flatnonzero(self.has_daughters[m])
+            (p, m) = (p[keep], m[keep])
+        (pp, vv) = (np.concatenate(out_p), np.concatenate(out_v))
+        order = np.argsort(pp, kind='stable')
+        return (pp[order], vv[order])
+
+    def deepest(self, points):
+        """ (N,) the deepest volume containing each point, -1 where there is none """
+        points = np.asarray(points, dtype=np.float64).reshape(-1, 3)
+        best = np.full(len(points), -1, dtype=np.int64)
+        for start in range(0, len(points), BATCH):
+            (pp, vv) = self.locate(points[start:start + BATCH])
+            if len(pp):
+                last = np.append(pp[1:] != pp[:-1], True)
+                best[pp[last] + start] = vv[last]
+        return best
+
+    def volume(self, i):
+        """ document number, name, tags and depth of an indexed volume """
+        return {'doc': self.doc_numbers[i], 'name': self.names[i], 'tags': self.tags[i],
+                'depth': int(self.depth[i])}
+
+
+if __name__ == '__main__':
+    PARSER = argparse.ArgumentParser(description='Locates points in the flattened geometry.')
+    PARSER.add_argument('input', help='NDJSON output of gm2json (.gz and .zst too)')
+    PARSER.add_argument('--point', nargs=3, type=float, action='append', default=[], metavar=('X', 'Y', 'Z'),
+                        help='print the volumes containing this point, can be repeated')
+    PARSER.add_argument('--points', help='.npy file with an (N, 3) array, prints the deepest volume of each')
+    PARSER.add_argument('--benchmark', type=int, default=0,
+                        help='time the lookup of this many random points inside the world box')
+    ARGS = PARSER.parse_args()
+
+    START = time.time()
+    INDEX = SpatialIndex.from_file(ARGS.input)
+    print('indexed %d volumes (%d without extent) in %.2f s' % (len(INDEX), INDEX.skipped, time.time() - START))
+
+    if ARGS.point:
+        (PP, VV) = INDEX.containing(np.array(ARGS.point))
+        for (p, v) in zip(PP, VV):
+            print(ARGS.point[p], INDEX.volume(v))
+    if ARGS.points:
+        POINTS = np.load(ARGS.points)
+        for (p, v) in zip(POINTS, INDEX.deepest(POINTS)):
+            print(p.tolist(), INDEX.volume(v) if v >= 0 else None)
+    if ARGS.benchmark:
+        POINTS = np.random.uniform(INDEX.lo.min(axis=0), INDEX.hi.max(axis=0), (ARGS.benchmark, 3))
+        START = time.time()
+        FOUND = INDEX.deepest(POINTS)
+        ELAPSED = time.time() - START
+        print('%d points in %.3f s, %.0f points/s, %d inside a volume' %
+              (len(POINTS), ELAPSED, len(POINTS) / ELAPSED, (FOUND >= 0).sum()))
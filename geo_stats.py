@@ -0,0 +1,192 @@
+"""
+Run statistics and logging of the command line tools.
+
+RunStats keeps counters and per stage timers, prints progress samples
+while the run goes on and makes the JSON summary printed at exit. Timers
+are cumulative seconds and can nest, eg. transform is part of traversal.
+Counters and timers are ThreadCounters: every thread adds to its own dict,
+so the stages of a pipeline count without a lock, and reads sum them.
+setup_logging() configures the root logger, quiet (warnings only) unless
+verbose, as text or as one JSON object per line.
+"""
+
+import io
+import sys
+import json
+import time
+import pstats
+import logging
+import cProfile
+import threading
+from collections import defaultdict
+
+
+class ThreadCounters():
+    """ named counters, each thread adding to its own: counters[name] += n
+    changes the count of the calling thread, totals() sums all the threads.
+    names - counters present in the totals even when nothing was added
+    """
+    def __init__(self, names=(), factory=int):
+        self.names = tuple(names)
+        self.factory = factory
+        self.local = threading.local()
+        self.parts = []
+        self.lock = threading.Lock()
+
+    def own(self):
+        """ the counts of the calling thread """
+        try:
+            return self.local.part
+        except AttributeError:
+            part = self.local.part = defaultdict(self.factory)
+            with self.lock:
+                self.parts.append(part)
+            return part
+
+    def __getitem__(self, name):
+        return self.own()[name]
+
+    def __setitem__(self, name, value):
+        self.own()[name] = value
+
+    def totals(self):
+        """ dict of the counts summed over the threads """
+        out = dict((name, self.factory()) for name in self.names)
+        with self.lock:
+            parts = [dict(part) for part in self.parts]
+        for part in parts:
+            for (name, n) in part.items():
+                out[name] = out.get(name, self.factory()) + n
+        return out
+
+    def clear(self):
+        with self.lock:
+            for part in self.parts:
+                part.clear()
+
+
+class Timer():
+    """ context manager adding the time spent inside to a RunStats timer """
+    def __init__(self, stats, name):
+        self.stats = stats
+        self.name = name
+        self.start = None
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        self.stats.timers.own()[self.name] += time.perf_counter() - self.start
+        return False
+
+
+class RunStats():
+    """ progress - seconds between progress samples, 0 for none
+    progress_counter - the counter whose rate the samples show
+    stream - where the samples go, stderr by default
+    """
+    def __init__(self, progress=0, progress_counter='docs', stream=None):
+        self.start = time.time()
+        self.counters = ThreadCounters()
+        self.timers = ThreadCounters(factory=float)
+        self.progress = progress
+        self.progress_counter = progress_counter
+        self.stream = stream
+        self.next_sample = self.start + progress if progress > 0 else None
+        self.last_sample = (self.start, 0)
+
+    def count(self, name, n=1):
+        self.counters.own()[name] += n
+
+    def add_time(self, name, seconds):
+        self.timers.own()[name] += seconds
+
+    def timer(self, name):
+        return Timer(self, name)
+
+    def tick(self):
+        """ called as the progress counter grows, prints a sample when one is due """
+        if self.next_sample is not None and time.time() >= self.next_sample:
+            self.sample()
+
+    def sample(self):
+        now = time.time()
+        done = self.counters.totals().get(self.progress_counter, 0)
+        (last_time, last_done) = self.last_sample
+        line = {'progress': self.progress_counter, 'done': done, 'seconds': round(now - self.start, 3),
+                'rate': round((done - last_done) / (now - last_time), 1) if now > last_time else None,
+                'mean_rate': round(done / (now - self.start), 1) if now > self.start else None}
+        print(json.dumps(line), file=self.stream or sys.stderr, flush=True)
+        self.last_sample = (now, done)
+        self.next_sample = now + self.progress
+
+    def snapshot(self):
+        """ picklable counters and timers, eg. of a worker process """
+        return {'counters': self.counters.totals(), 'timers': self.timers.totals()}
+
+    def merge(self, snapshot):
+        for (name, n) in snapshot['counters'].items():
+            self.counters[name] += n
+        for (name, seconds) in snapshot['timers'].items():
+            self.timers[name] += seconds
+
+    def reset(self):
+        self.counters.clear()
+        self.timers.clear()
+
+    def summary(self, **extra):
+        """ the JSON-serializable summary of the run, extra entries are added as they are """
+        elapsed = time.time() - self.start
+        (counters, timers) = (self.counters.totals(), self.timers.totals())
+        done = counters.get(self.progress_counter, 0)
+        out = {'seconds': round(elapsed, 3),
+               'rate': round(done / elapsed, 1) if elapsed > 0 else None,
+               'counters': dict(sorted(counters.items())),
+               'timers': dict((k, round(v, 6)) for (k, v) in sorted(timers.items()))}
+        out.update(extra)
+        return out
+
+
+class JsonFormatter(logging.Formatter):
+    """ one JSON object per log record, fields passed with extra= are kept """
+    RECORD_FIELDS = set(vars(logging.LogRecord('', 0, '', 0, '', (), None))) | set(['message', 'asctime'])
+
+    def format(self, record):
+        entry = {'time': self.formatTime(record), 'level': record.levelname, 'logger': record.name,
+                 'message': record.getMessage()}
+        for (k, v) in vars(record).items():
+            if k not in self.RECORD_FIELDS:
+                entry[k] = v
+        if record.exc_info:
+            entry['exception'] = self.formatException(record.exc_info)
+        return json.dumps(entry, default=str)
+
+
+def setup_logging(verbosity=0, json_format=False, stream=None):
+    """ warnings only by default, -v info, -vv debug, to stderr """
+    handler = logging.StreamHandler(stream or sys.stderr)
+    if json_format:
+        handler.setFormatter(JsonFormatter())
+    else:
+        handler.setFormatter(logging.Formatter('%(asctime)s %(levelname)s %(message)s'))
+    root = logging.getLogger()
+    root.handlers = [handler]
+    root.setLevel(max(logging.WARNING - 10 * verbosity, logging.DEBUG))
+
+
+def start_profile():
+    profiler = cProfile.Profile()
+    profiler.enable()
+    return profiler
+
+
+def stop_profile(profiler, path, top=25):
+    """ writes the cProfile stats to path (for pstats or snakeviz) and
+    returns the top functions by cumulative time as text
+    """
+    profiler.disable()
+    profiler.dump_stats(path)
+    out = io.StringIO()
+    pstats.Stats(profiler, stream=out).sort_stats('cumulative').print_stats(top)
+    return out.getvalue()
@@ -0,0 +1,207 @@
+#!/usr/bin/env python
+"""
+Synthetic GeoModel geometry DBs, for testing and benchmarking without the
+real ATLAS geometry:
+    geo_synth.py synth.db --depth 5 --fanout 6 --sharing 0.5 --serial 0.2 --copies 16
+
+The DB has the GeoModel schema. Every volume above the last level gets
+fanout children, each one optionally preceded by a NameTag and by a
+Transform or AlignableTransform. A child is an already made volume of the
+same level with probability sharing (the geometry becomes a DAG, as the
+real one is), and with probability serial it is placed copies times by a
+GeoSerialTransformer named by a GeoSerialDenominator. Shapes are Box, Tube,
+Tubs, Cons, Trd and Pcon with random dimensions.
+"""
+
+import os
+import math
+import time
+import random
+import sqlite3
+import argparse
+
+SCHEMA = [
+    'CREATE TABLE GeoNodesTypes(id integer primary key, nodeType varchar, tableName varchar)',
+    'CREATE TABLE RootVolume(id integer primary key, volId integer, volTable integer)',
+    'CREATE TABLE ChildrenPositions(id integer primary key, parentId integer, parentTable integer, '
+    'parentCopyNumber integer, position integer, childTable integer, childId integer, childCopyNumber integer)',
+    'CREATE TABLE PhysVols(id integer primary key, logvol integer)',
+    'CREATE TABLE FullPhysVols(id integer primary key, logvol integer)',
+    'CREATE TABLE LogVols(id integer primary key, name varchar, shape integer, material integer)',
+    'CREATE TABLE Materials(id integer primary key, name varchar, density real, elements varchar)',
+    'CREATE TABLE Shapes(id integer primary key, type varchar, parameters varchar)',
+    'CREATE TABLE SerialDenominators(id integer primary key, baseName varchar)',
+    'CREATE TABLE Functions(id integer primary key, expression varchar)',
+    'CREATE TABLE SerialTransformers(id integer primary key, funcId integer, volId integer, volTable integer, '
+    'copies integer)',
+    'CREATE TABLE Transforms(id integer primary key, xx real, xy real, xz real, yx real, yy real, yz real, '
+    'zx real, zy real, zz real, dx real, dy real, dz real)',
+    'CREATE TABLE AlignableTransforms(id integer primary key, xx real, xy real, xz real, yx real, yy real, '
+    'yz real, zx real, zy real, zz real, dx real, dy real, dz real)',
+    'CREATE TABLE NameTags(id integer primary key, name varchar)',
+]
+NODE_TYPES = [(1, 'GeoPhysVol', 'PhysVols'), (2, 'GeoFullPhysVol', 'FullPhysVols'), (3, 'GeoLogVol', 'LogVols'),
+              (4, 'GeoMaterial', 'Materials'), (5, 'GeoShape', 'Shapes'),
+              (6, 'GeoSerialDenominator', 'SerialDenominators'), (7, 'GeoSerialTransformer', 'SerialTransformers'),
+              (8, 'Function', 'Functions'), (9, 'GeoTransform', 'Transforms'),
+              (10, 'GeoAlignableTransform', 'AlignableTransforms'), (11, 'GeoNameTag', 'NameTags')]
+TABLE_IDS = dict((name, table_id) for (table_id, _, name) in NODE_TYPES)
+MATERIALS = [('Air', 0.0012, 'N=0.76;O=0.24'), ('Iron', 7.87, 'Fe=1'), ('Lead', 11.35, 'Pb=1'),
+             ('LiquidArgon', 1.396, 'Ar=1'), ('Copper', 8.96, 'Cu=1'), ('Scintillator', 1.032, 'C=0.92;H=0.08'),
+             ('Aluminium', 2.7, 'Al=1'), ('Silicon', 2.33, 'Si=1')]
+FUNCTIONS = ['Pow(TranslateZ3D(%g),X)', 'RotateZ3D(%g*X) * TranslateX3D(1000)',
+             'Pow(RotateZ3D(%g),X) * TranslateY3D(50)']
+
+
+class GeometryGenerator():
+    """ depth - levels of volumes below the world volume
+    fanout - children of every volume above the last level
+    sharing - probability a child is an already made volume of its level
+    serial - probability a child is placed by a GeoSerialTransformer
+    copies - copies of a serial transformer
+    tags - probability a child is preceded by a NameTag
+    alignable - probability a child's transform is an AlignableTransform
+    full - probability a new volume is a FullPhysVol
+    """
+    def __init__(self, depth=4, fanout=4, sharing=0.5, serial=0.1, copies=8, tags=0.5, alignable=0.1,
+                 full=0.1, seed=1):
+        self.depth = depth
+        self.fanout = fanout
+        self.sharing = sharing
+        self.serial = serial
+        self.copies = copies
+        self.tags = tags
+        self.alignable = alignable
+        self.full = full
+        self.random = random.Random(seed)
+        self.rows = dict((table_name, []) for (_, _, table_name) in NODE_TYPES)
+        for table_name in ('GeoNodesTypes', 'RootVolume', 'ChildrenPositions'):
+            self.rows[table_name] = []
+        self.levels = {}  # remaining depth -> [(table id, volume id)]
+        self.documents = {}  # (table id, volume id) -> documents below the volume
+
+    def add(self, table_name, *values):
+        """ appends a row, returns its id """
+        rows = self.rows[table_name]
+        rows.append((len(rows) + 1,) + values)
+        return len(rows)
+
+    def shape(self, scale):
+        r = self.random.uniform
+        kind = self.random.choice(['Box', 'Tube', 'Tubs', 'Cons', 'Trd', 'Pcon'])
+        if kind == 'Box':
+            params = 'XHalfLength=%g;YHalfLength=%g;ZHalfLength=%g' % (r(.2, 1) * scale, r(.2, 1) * scale,
+                                                                     r(.2, 1) * scale)
+        elif kind in ('Tube', 'Tubs'):
+            params = 'RMin=%g;RMax=%g;ZHalfLength=%g' % (r(0, .3) * scale, r(.5, 1) * scale, r(.2, 1) * scale)
+            if kind == 'Tubs':
+                params += ';SPhi=%g;DPhi=%g' % (r(0, math.pi), r(.5, 2 * math.pi))
+        elif kind == 'Cons':
+            params = ('RMin1=%g;RMin2=%g;RMax1=%g;RMax2=%g;DZ=%g;SPhi=0;DPhi=%g' %
+                      (r(0, .3) * scale, r(0, .3) * scale, r(.5, 1) * scale, r(.5, 1) * scale, r(.2, 1) * scale,
+                       2 * math.pi))
+        elif kind == 'Trd':
+            params = ('XHalfLength1=%g;XHalfLength2=%g;YHalfLength1=%g;YHalfLength2=%g;ZHalfLength=%g' %
+                      tuple(r(.2, 1) * scale for _ in range(5)))
+        else:
+            planes = sorted(r(-1, 1) * scale for _ in range(3))
+            params = 'SPhi=0;DPhi=%g;NZPlanes=3' % (2 * math.pi)
+            for z in planes:
+                params += ';ZPos=%g;ZRmin=%g;ZRmax=%g' % (z, r(0, .3) * scale, r(.5, 1) * scale)
+        return self.add('Shapes', kind, params)
+
+    def transform(self):
+        """ a random rotation Rz(a) Rx(b) and translation """
+        (a, b) = (self.random.uniform(0, 2 * math.pi), self.random.uniform(0, math.pi))
+        (ca, sa, cb, sb) = (math.cos(a), math.sin(a), math.cos(b), math.sin(b))
+        rot = (ca, -sa * cb, sa * sb, sa, ca * cb, -ca * sb, 0.0, sb, cb)
+        shift = tuple(self.random.uniform(-100, 100) for _ in range(3))
+        if self.random.random() < self.alignable:
+            return (TABLE_IDS['AlignableTransforms'], self.add('AlignableTransforms', *(rot + shift)))
+        return (TABLE_IDS['Transforms'], self.add('Transforms', *(rot + shift)))
+
+    def child(self, parent, position, table_id, child_id):
+        self.add('ChildrenPositions', parent[1], parent[0], 0, position, table_id, child_id, 0)
+        return position + 1
+
+    def volume(self, level, name=None):
+        """ (table id, id) of a volume with level levels below it, made or shared """
+        made = self.levels.get(level)
+        if made and self.random.random() < self.sharing:
+            return self.random.choice(made)
+        scale = 10.0 * 4 ** level
+        logvol = self.add('LogVols', name or 'LV%d_%d' % (level, len(self.rows['LogVols']) + 1), self.shape(scale),
+                          self.random.randint(1, len(MATERIALS)))
+        table_name = 'FullPhysVols' if name is None and self.random.random() < self.full else 'PhysVols'
+        key = (TABLE_IDS[table_name], self.add(table_name, logvol))
+        documents = 0
+        position = 0
+        for k in range(self.fanout if level > 0 else 0):
+            if self.random.random() < self.tags:
+                position = self.child(key, position, TABLE_IDS['NameTags'],
+                                      self.add('NameTags', 'Tag%d_%d' % (level, len(self.rows['NameTags']) + 1)))
+            position = self.child(key, position, *self.transform())
+            below = self.volume(level - 1)
+            if self.random.random() < self.serial:
+                denominator = self.add('SerialDenominators', 'Copy%d_' % (len(self.rows['SerialDenominators']) + 1))
+                position = self.child(key, position, TABLE_IDS['SerialDenominators'], denominator)
+                function = self.random.choice(FUNCTIONS) % self.random.uniform(0.05, 0.5)
+                serial = self.add('SerialTransformers', self.add('Functions', function), below[1], below[0],
+                                  self.copies)
+                position = self.child(key, position, TABLE_IDS['SerialTransformers'], serial)
+                documents += self.copies * (1 + self.documents[below])
+            else:
+                position = self.child(key, position, below[0], below[1])
+                documents += 1 + self.documents[below]
+        self.documents[key] = documents
+        self.levels.setdefault(level, []).append(key)
+        return key
+
+    def generate(self):
+        """ makes all the rows, the world volume is PhysVols 1 """
+        for (i, (name, density, elements)) in enumerate(MATERIALS):
+            self.add('Materials', name, density, elements)
+        for row in NODE_TYPES:
+            self.rows['GeoNodesTypes'].append(row)
+        world = self.volume(self.depth, 'World')
+        self.rows['RootVolume'].append((1, world[1], world[0]))
+        return world
+
+    def write(self, path):
+        """ generates the geometry into a new SQLite file, returns its stats """
+        start = time.time()
+        world = self.generate()
+        if os.path.exists(path):
+            os.remove(path)
+        db = sqlite3.connect(path)
+        for statement in SCHEMA:
+            db.execute(statement)
+        for (table_name, rows) in self.rows.items():
+            if rows:
+                db.executemany('INSERT INTO %s VALUES (%s)' % (table_name, ', '.join('?' * len(rows[0]))), rows)
+        db.commit()
+        db.close()
+        stats = dict((table_name, len(rows)) for (table_name, rows) in sorted(self.rows.items()))
+        stats['documents'] = self.documents[world]
+        stats['bytes'] = os.path.getsize(path)
+        stats['seconds'] = round(time.time() - start, 3)
+        return stats
+
+
+if __name__ == '__main__':
+    PARSER = argparse.ArgumentParser(description='Writes a synthetic GeoModel geometry DB.')
+    PARSER.add_argument('output', help='SQLite file to write')
+    PARSER.add_argument('--depth', type=int, default=4, help='levels of volumes below the world volume')
+    PARSER.add_argument('--fanout', type=int, default=4, help='children of every volume')
+    PARSER.add_argument('--sharing', type=float, default=0.5, help='probability a child is a shared volume')
+    PARSER.add_argument('--serial', type=float, default=0.1, help='probability a child is a serial transformer')
+    PARSER.add_argument('--copies', type=int, default=8, help='copies of a serial transformer')
+    PARSER.add_argument('--tags', type=float, default=0.5, help='probability a child has a NameTag')
+    PARSER.add_argument('--alignable', type=float, default=0.1, help='probability of an AlignableTransform')
+    PARSER.add_argument('--full', type=float, default=0.1, help='probability a volume is a FullPhysVol')
+    PARSER.add_argument('--seed', type=int, default=1, help='random seed')
+    ARGS = PARSER.parse_args()
+
+    GENERATOR = GeometryGenerator(ARGS.depth, ARGS.fanout, ARGS.sharing, ARGS.serial, ARGS.copies, ARGS.tags,
+                                  ARGS.alignable, ARGS.full, ARGS.seed)
+    print('written %s:' % ARGS.output, GENERATOR.write(ARGS.output))
@@ -0,0 +1,397 @@
+#!/usr/bin/env python
+"""
+NameTag path index of an export: which documents are under Tile/Barrel.
+
+The documents gm2json writes are numbered in document (depth first)
+order. Every document has the NameTag path of its volume (tags), and the
+documents under one path are a few runs of consecutive numbers, one per
+run of sibling subtrees with that path. TagIndexBuilder puts the paths
+into a trie as the documents are written. Every trie node keeps the
+[start, end) ranges of the documents under its path (prefix) and of the
+documents whose path is exactly its path (exact).
+
+Paths are steps separated by '/'. In patterns a step can be a glob
+(Module*, Module[12]) and ** matches any number of steps:
+    index = TagIndex.load('atlas.tags')
+    index.prefix('Tile/Barrel')          # (K, 2) ranges of everything under Tile/Barrel
+    index.exact('Tile/Barrel')           # the volumes tagged Tile/Barrel themselves
+    index.query('Tile/*/Module3')        # wildcard, merged ranges of all the matching paths
+    index.query('**/TileEndcapNeg')      # a tag anywhere in the path
+    index.children('')                   # NameTags below the root volume, in document order
+    index.doc_ids(ranges)                # their Elasticsearch _ids
+
+gm2json writes the index with --tag-index-out, and re-exports only the
+matching volumes with --tag-index and --tag-query. From the command line:
+    geo_tagindex.py atlas.tags --query 'Tile/*/Module3'
+    geo_tagindex.py atlas_geo.ndjson.gz --children Tile
+"""
+
+import json
+import time
+import zipfile
+import argparse
+from fnmatch import fnmatchcase
+
+import numpy as np
+
+import geo_sinks
+import geo_reindex
+
+EMPTY = np.zeros((0, 2), dtype=np.int64)
+GLOB_CHARS = set('*?[')
+
+
+def split_path(path):
+    """ steps of a 'A/B/C' path, or of a list of steps """
+    if isinstance(path, str):
+        return [step for step in path.split('/') if step]
+    return list(path)
+
+
+def path_matches(pattern, tags, partial=False):
+    """ True if the NameTag path tags matches a pattern, with partial also if
+    a longer path starting with tags could match it
+    """
+    return _matches(split_path(pattern), list(tags), partial)
+
+
+def _matches(steps, tags, partial):
+    if not tags:
+        return partial or all(step == '**' for step in steps)
+    if not steps:
+        return False
+    if steps[0] == '**':
+        return _matches(steps[1:], tags, partial) or _matches(steps, tags[1:], partial)
+    return fnmatchcase(tags[0], steps[0]) and _matches(steps[1:], tags[1:], partial)
+
+
+def extend_ranges(ranges, i):
+    """ adds document i to a list of [start, end) ranges, documents come in increasing order """
+    if ranges and ranges[-1][1] == i:
+        ranges[-1][1] = i + 1
+    else:
+        ranges.append([i, i + 1])
+
+
+def merge_ranges(ranges):
+    """ union of (K, 2) [start, end) ranges, sorted and without overlaps """
+    if len(ranges) == 0:
+        return EMPTY
+    ranges = ranges[np.argsort(ranges[:, 0], kind='stable')]
+    ends = np.maximum.accumulate(ranges[:, 1])
+    first = np.ones(len(ranges), dtype=bool)
+    first[1:] = ranges[1:, 0] > ends[:-1]
+    starts = np.flatnonzero(first)
+    lasts = np.append(starts[1:] - 1, len(ranges) - 1)
+    return np.stack([ranges[starts, 0], ends[lasts]], axis=1)
+
+
+def csr_ranges(lists):
+    """ (offsets, ranges) of the range lists of all trie nodes """
+    offsets = np.zeros(len(lists) + 1, dtype=np.int64)
+    offsets[1:] = np.cumsum([len(r) for r in lists])
+    ranges = np.array([r for rr in lists for r in rr], dtype=np.int64).reshape(-1, 2)
+    return (offsets, ranges)
+
+
+class TagIndexBuilder():
+    """ adds the documents of an export, in document order, to the trie """
+    def __init__(self):
+        self.names = ['']  # node -> its step, node 0 is the root volume
+        self.parents = [-1]
+        self.children = [{}]  # node -> {step: node}
+        self.prefix = [[]]  # node -> [start, end) ranges of the documents under its path
+        self.exact = [[]]
+        self.ids = []  # document -> path id (the _id)
+        self.depths = []
+        self.nodes = []  # document -> node of its path
+
+    def __len__(self):
+        return len(self.depths)
+
+    def add(self, tags, depth, path_id=0):
+        """ adds the next document, returns its number """
+        i = len(self.depths)
+        node = 0
+        extend_ranges(self.prefix[0], i)
+        for tag in tags:
+            child = self.children[node].get(tag)
+            if child is None:
+                child = len(self.names)
+                self.children[node][tag] = child
+                self.names.append(tag)
+                self.parents.append(node)
+                self.children.append({})
+                self.prefix.append([])
+                self.exact.append([])
+            node = child
+            extend_ranges(self.prefix[node], i)
+        extend_ranges(self.exact[node], i)
+        self.ids.append(path_id)
+        self.depths.append(depth)
+        self.nodes.append(node)
+        return i
+
+    def add_document(self, doc):
+        """ adds a gm2json document """
+        return self.add(doc['tags'], doc['depth'], int(doc['_id'], 16) if '_id' in doc else 0)
+
+    def index(self, options=None):
+        """ the TagIndex of the documents added so far """
+        return TagIndex(self.names, self.parents, csr_ranges(self.prefix), csr_ranges(self.exact),
+                        self.ids, self.depths, self.nodes, options)
+
+
+class TagIndex():
+    """ the NameTag path trie, queries return (K, 2) arrays of [start, end) document numbers.
+    options are the gm2json options of the export, None if not known.
+    """
+    def __init__(self, names, parents, prefix, exact, ids, depths, nodes, options=None):
+        self.names = list(names)
+        self.parents = np.asarray(parents, dtype=np.int32)
+        (self.prefix_offsets, self.prefix_ranges) = prefix
+        (self.exact_offsets, self.exact_ranges) = exact
+        self.ids = np.asarray(ids, dtype=np.uint64)
+        self.depths = np.asarray(depths, dtype=np.int32)
+        self.nodes = np.asarray(nodes, dtype=np.int32)
+        self.options = options
+        self.children_of = [{} for _ in self.names]
+        self.named = {}  # step -> nodes with that step, for ** followed by a plain step
+        for (node, parent) in enumerate(self.parents.tolist()):
+            if parent >= 0:
+                self.children_of[parent][self.names[node]] = node
+                self.named.setdefault(self.names[node], []).append(node)
+        # preorder number of every node and of its last descendant, for ancestor tests
+        self.first = np.zeros(len(self.names), dtype=np.int64)
+        self.last = np.zeros(len(self.names), dtype=np.int64)
+        order = 0
+        stack = [(0, False)]
+        while stack:
+            (node, done) = stack.pop()
+            if done:
+                self.last[node] = order - 1
+                continue
+            self.first[node] = order
+            order += 1
+            stack.append((node, True))
+            stack.extend((child, False) for child in self.children_of[node].values())
+        self._ends = None
+
+    def __len__(self):
+        return len(self.depths)
+
+    @classmethod
+    def from_documents(cls, docs, options=None):
+        builder = TagIndexBuilder()
+        for doc in docs:
+            if doc.get('_op_type') != 'delete':
+                builder.add_document(doc)
+        return builder.index(options)
+
+    @classmethod
+    def from_file(cls, path):
+        """ index of an NDJSON output of gm2json """
+        return cls.from_documents(geo_sinks.read_documents(path))
+
+    @classmethod
+    def load(cls, path):
+        with np.load(path) as data:
+            (blob, offsets) = (data['names.data'].tobytes(), data['names.offsets'].tolist())
+            names = [blob[offsets[k]:offsets[k + 1]].decode('utf-8') for k in range(len(offsets) - 1)]
+            return cls(names, data['parents'], (data['prefix.offsets'], data['prefix.ranges']),
+                       (data['exact.offsets'], data['exact.ranges']), data['ids'], data['depths'], data['nodes'],
+                       json.loads(str(data['options'])))
+
+    def save(self, path):
+        data = bytearray()
+        offsets = [0]
+        for name in self.names:
+            data += name.encode('utf-8')
+            offsets.append(len(data))
+        with open(path, 'wb') as f:
+            np.savez_compressed(f, **{'names.data': np.frombuffer(bytes(data), dtype=np.uint8),
+                                      'names.offsets': np.asarray(offsets, dtype=np.int64),
+                                      'parents': self.parents,
+                                      'prefix.offsets': self.prefix_offsets, 'prefix.ranges': self.prefix_ranges,
+                                      'exact.offsets': self.exact_offsets, 'exact.ranges': self.exact_ranges,
+                                      'ids': self.ids, 'depths': self.depths, 'nodes': self.nodes,
+                                      'options': np.array(json.dumps(self.options))})
+
+    @property
+    def ends(self):
+        """ for every document, the number after its last descendant """
+        if self._ends is None:
+            self._ends = geo_reindex.subtree_ends(self.depths)
+        return self._ends
+
+    def find(self, path):
+        """ trie node of a path, -1 if no document has it """
+        node = 0
+        for step in split_path(path):
+            node = self.children_of[node].get(step, -1)
+            if node < 0:
+                return -1
+        return node
+
+    def path(self, node):
+        """ the steps of a trie node """
+        steps = []
+        while node > 0:
+            steps.append(self.names[node])
+            node = int(self.parents[node])
+        return steps[::-1]
+
+    def node_ranges(self, node, exact=False):
+        if node < 0:
+            return EMPTY
+        if exact:
+            return self.exact_ranges[self.exact_offsets[node]:self.exact_offsets[node + 1]]
+        return self.prefix_ranges[self.prefix_offsets[node]:self.prefix_offsets[node + 1]]
+
+    def prefix(self, path):
+        """ the documents under a path, the volume with that path included """
+        return self.node_ranges(self.find(path))
+
+    def exact(self, path):
+        """ the documents whose tags are the path """
+        return self.node_ranges(self.find(path), exact=True)
+
+    def match(self, pattern):
+        """ the trie nodes whose path matches a pattern, in trie order """
+        steps = split_path(pattern)
+        found = set()
+        seen = set()
+        todo = [(0, 0)]
+        while todo:
+            (node, k) = todo.pop()
+            if (node, k) in seen:
+                continue
+            seen.add((node, k))
+            if k == len(steps):
+                found.add(node)
+                continue
+            step = steps[k]
+            children = self.children_of[node]
+            if step == '**' and k + 1 < len(steps) and not GLOB_CHARS.intersection(steps[k + 1]) \
+                    and steps[k + 1] != '**':
+                (first, last) = (self.first[node], self.last[node])
+                todo.extend((other, k + 2) for other in self.named.get(steps[k + 1], ())
+                            if first < self.first[other] <= last)
+            elif step == '**':
+                todo.append((node, k + 1))
+                todo.extend((child, k) for child in children.values())
+            elif GLOB_CHARS.intersection(step):
+                todo.extend((child, k + 1) for (name, child) in children.items() if fnmatchcase(name, step))
+            elif step in children:
+                todo.append((children[step], k + 1))
+        return sorted(found)
+
+    def query(self, pattern, exact=False):
+        """ merged ranges of the documents under (or exactly at, with exact) all paths matching a pattern """
+        steps = split_path(pattern)
+        while steps and steps[-1] == '**':
+            steps.pop()  # everything below the paths before it, in both modes
+            exact = False
+        if not any(step == '**' or GLOB_CHARS.intersection(step) for step in steps):
+            return self.node_ranges(self.find(steps), exact)
+        nodes = self.match(steps)
+        if not nodes:
+            return EMPTY
+        return merge_ranges(np.concatenate([self.node_ranges(node, exact) for node in nodes]))
+
+    def children(self, path):
+        """ (step, number of documents) of the paths one step below path, in document order """
+        node = self.find(path)
+        if node < 0:
+            return []
+        out = []
+        for child in self.children_of[node].values():
+            ranges = self.node_ranges(child)
+            out.append((int(ranges[0, 0]), self.names[child], self.count(ranges)))
+        return [(name, count) for (_, name, count) in sorted(out)]
+
+    @staticmethod
+    def count(ranges):
+        return int((ranges[:, 1] - ranges[:, 0]).sum()) if len(ranges) else 0
+
+    @staticmethod
+    def documents(ranges):
+        """ the document numbers of ranges """
+        if len(ranges) == 0:
+            return np.zeros(0, dtype=np.int64)
+        return np.concatenate([np.arange(start, end) for (start, end) in ranges.tolist()])
+
+    def doc_ids(self, ranges):
+        """ the _ids of the documents of ranges """
+        return [geo_reindex.doc_id(int(i)) for i in self.ids[self.documents(ranges)]]
+
+    def tops(self, ranges):
+        """ the document numbers of ranges that are not below another one of them """
+        ends = self.ends
+        out = []
+        covered = 0  # end of the subtree of the last top document
+        for (start, end) in ranges.tolist():
+            i = max(start, covered)
+            while i < end:
+                out.append(i)
+                covered = int(ends[i])
+                i = covered
+        return np.asarray(out, dtype=np.int64)
+
+    def tags(self, i):
+        """ the NameTag path of document i """
+        return self.path(int(self.nodes[i]))
+
+    def stats(self):
+        return {'documents': len(self), 'paths': len(self.names), 'prefix_ranges': len(self.prefix_ranges),
+                'exact_ranges': len(self.exact_ranges)}
+
+
+class RangeSelection():
+    """ membership tests of document numbers in merged ranges """
+    def __init__(self, ranges):
+        self.starts = np.ascontiguousarray(ranges[:, 0])
+        self.stops = np.ascontiguousarray(ranges[:, 1])
+
+    def __contains__(self, i):
+        k = int(np.searchsorted(self.starts, i, 'right')) - 1
+        return k >= 0 and i < self.stops[k]
+
+    def overlaps(self, start, end):
+        """ True if any selected document is in [start, end) """
+        k = int(np.searchsorted(self.stops, start, 'right'))
+        return k < len(self.starts) and self.starts[k] < end
+
+
+if __name__ == '__main__':
+    PARSER = argparse.ArgumentParser(description='Queries the NameTag path index of a gm2json export.')
+    PARSER.add_argument('input', help='index written by gm2json --tag-index-out, or its NDJSON output')
+    PARSER.add_argument('-o', '--output', help='save the index of an NDJSON input to this file')
+    PARSER.add_argument('--query', action='append', default=[], metavar='PATTERN',
+                        help='documents under the paths matching PATTERN, eg. Tile/*/Module3 or **/TileBarrel')
+    PARSER.add_argument('--exact', action='store_true', help='only the documents tagged with the path itself')
+    PARSER.add_argument('--children', action='append', default=[], metavar='PATH',
+                        help='NameTags one step below PATH, "" for the root volume')
+    PARSER.add_argument('--ids', action='store_true', help='print the _ids of the --query documents')
+    ARGS = PARSER.parse_args()
+
+    START = time.time()
+    if zipfile.is_zipfile(ARGS.input):
+        INDEX = TagIndex.load(ARGS.input)
+    else:
+        INDEX = TagIndex.from_file(ARGS.input)
+    print(json.dumps(dict(INDEX.stats(), seconds=round(time.time() - START, 3))))
+    if ARGS.output:
+        INDEX.save(ARGS.output)
+
+    for PATTERN in ARGS.query:
+        START = time.perf_counter()
+        RANGES = INDEX.query(PATTERN, ARGS.exact)
+        ELAPSED = time.perf_counter() - START
+        OUT = {'query': PATTERN, 'documents': INDEX.count(RANGES), 'ranges': RANGES.tolist(),
+               'microseconds': round(ELAPSED * 1e6, 1)}
+        if ARGS.ids:
+            OUT['ids'] = INDEX.doc_ids(RANGES)
+        print(json.dumps(OUT))
+    for PATH in ARGS.children:
+        print(json.dumps({'children': PATH, 'tags': INDEX.children(PATH)}))
@@ -0,0 +1,295 @@
+"""
+GeoModel transforms as 4x4 homogeneous float64 matrices.
+
+The DB rows (Transforms, AlignableTransforms) store a rotation
+    xx, xy, xz
+    yx, yy, yz
+    zx, zy, zz
+and a translation dx, dy, dz. The flat (12,) layout used in the documents
+is [xx, xy, xz, yx, yy, yz, zx, zy, zz, dx, dy, dz].
+
+A volume's world transform is parent_world @ local, where local is the
+product of the transforms that precede the volume among its siblings.
+"""
+
+import numpy as np
+
+ROW_FIELDS = ('xx', 'xy', 'xz', 'yx', 'yy', 'yz', 'zx', 'zy', 'zz', 'dx', 'dy', 'dz')
+
+
+def identity():
+    """ 4x4 identity """
+    return np.eye(4)
+
+
+def from_row(row):
+    """ 4x4 matrix from 12 numbers in the document layout """
+    m = np.eye(4)
+    m[:3, :3] = np.asarray(row[:9], dtype=np.float64).reshape(3, 3)
+    m[:3, 3] = row[9:12]
+    return m
+
+
+def from_item(item):
+    """ 4x4 matrix from a Transforms or AlignableTransforms row """
+    return from_row([getattr(item, f) for f in ROW_FIELDS])
+
+
+def from_rows(rows):
+    """ (N, 4, 4) matrices from an (N, 12) array """
+    rows = np.asarray(rows, dtype=np.float64).reshape(-1, 12)
+    mats = np.zeros((len(rows), 4, 4))
+    mats[:, :3, :3] = rows[:, :9].reshape(-1, 3, 3)
+    mats[:, :3, 3] = rows[:, 9:]
+    mats[:, 3, 3] = 1.0
+    return mats
+
+
+def to_row(m):
+    """ the 12 numbers of the document layout as a list """
+    return m[:3, :3].ravel().tolist() + m[:3, 3].tolist()
+
+
+def to_rows(mats):
+    """ (N, 12) array in the document layout from (N, 4, 4) matrices """
+    mats = np.asarray(mats).reshape(-1, 4, 4)
+    return np.concatenate((mats[:, :3, :3].reshape(-1, 9), mats[:, :3, 3]), axis=1)
+
+
+def product(mats):
+    """ left to right product of a sequence of 4x4 matrices """
+    out = np.eye(4)
+    for m in mats:
+        out = out @ m
+    return out
+
+
+def place(parent, locals_):
+    """ world transforms of a whole sibling group in one matmul.
+    parent is (4, 4) or (N, 4, 4), locals_ is (N, 4, 4)
+    """
+    return np.matmul(parent, locals_)
+
+
+def apply(mats, points):
+    """ transforms (N, 3) points with (4, 4) or (N, 4, 4) matrices """
+    points = np.asarray(points, dtype=np.float64)
+    if mats.ndim == 2:
+        return points @ mats[:3, :3].T + mats[:3, 3]
+    return np.einsum('nij,nj->ni', mats[:, :3, :3], points) + mats[:, :3, 3]
+
+
+def inverse(mats):
+    """ inverse of rigid transforms, (4, 4) or (N, 4, 4) """
+    rot_t = np.swapaxes(mats[..., :3, :3], -1, -2)
+    out = np.zeros_like(mats)
+    out[..., :3, :3] = rot_t
+    out[..., :3, 3] = -np.einsum('...ij,...j->...i', rot_t, mats[..., :3, 3])
+    out[..., 3, 3] = 1.0
+    return out
+
+
+#----------------------------------------------------------------------
+# GeoSerialTransformer functions
+#
+# The Functions table stores the transform function of a serial transformer
+# as an expression of the copy number X = 0, 1, ..., copies - 1, eg.
+#     Pow(TranslateZ3D(30), X)
+#     RotateZ3D(0.1963*X) * TranslateX3D(2000)
+#     Transform3D(1,0,0,0,1,0,0,0,1,0,0,-500) * Pow(RotateZ3D(0.3927), X+0.5)
+# Supported are numbers, X, + - * / and parentheses, Sin Cos Tan Sqrt Exp Abs,
+# TranslateX3D TranslateY3D TranslateZ3D RotateX3D RotateY3D RotateZ3D,
+# Transform3D with the 12 numbers of the document layout, the product of
+# transforms, and Pow(T, f): the rotation angle and the translation of T
+# scaled by f, as in GeoXF::Pow. T must not depend on X.
+
+SCALAR_FUNCTIONS = {'sin': np.sin, 'cos': np.cos, 'tan': np.tan, 'sqrt': np.sqrt, 'exp': np.exp,
+                    'abs': np.abs}
+
+
+class Xf():
+    """ a batch of transforms, one per copy, as the value of an expression """
+    def __init__(self, mats):
+        self.mats = mats
+
+
+def translations(vectors):
+    """ (N, 4, 4) translations from (N, 3) vectors """
+    mats = np.tile(np.eye(4), (len(vectors), 1, 1))
+    mats[:, :3, 3] = vectors
+    return mats
+
+
+def rotations(axis, angles):
+    """ (N, 4, 4) rotations by angles around a unit axis (Rodrigues) """
+    angles = np.asarray(angles, dtype=np.float64)
+    (x, y, z) = axis
+    k = np.array([[0.0, -z, y], [z, 0.0, -x], [-y, x, 0.0]])
+    mats = np.tile(np.eye(4), (len(angles), 1, 1))
+    mats[:, :3, :3] += np.sin(angles)[:, None, None] * k + (1.0 - np.cos(angles))[:, None, None] * (k @ k)
+    return mats
+
+
+def axis_angle(rot):
+    """ unit axis and angle of a 3x3 rotation """
+    angle = np.arccos(np.clip((np.trace(rot) - 1.0) / 2.0, -1.0, 1.0))
+    if angle < 1e-12:
+        return (np.array([0.0, 0.0, 1.0]), 0.0)
+    if np.pi - angle < 1e-6:
+        sym = (rot + np.eye(3)) / 2.0
+        axis = np.sqrt(np.clip(np.diag(sym), 0.0, None))
+        i = int(np.argmax(axis))
+        axis = sym[i] / axis[i]
+        return (axis / np.linalg.norm(axis), angle)
+    axis = np.array([rot[2, 1] - rot[1, 2], rot[0, 2] - rot[2, 0], rot[1, 0] - rot[0, 1]])
+    return (axis / (2.0 * np.sin(angle)), angle)
+
+
+def power(mat, exponents):
+    """ GeoXF::Pow: rotation angle and translation of mat scaled by each exponent """
+    exponents = np.asarray(exponents, dtype=np.float64)
+    (axis, angle) = axis_angle(mat[:3, :3])
+    mats = rotations(axis, angle * exponents)
+    mats[:, :3, 3] = exponents[:, None] * mat[:3, 3]
+    return mats
+
+
+class FunctionParser():
+    """ recursive descent parser and evaluator of serial transformer functions """
+    TOKENS = '()*/+-,'
+
+    def __init__(self, expression, copies):
+        self.tokens = self.tokenize(expression)
+        self.pos = 0
+        self.x = np.arange(copies, dtype=np.float64)
+
+    @classmethod
+    def tokenize(cls, expression):
+        tokens = []
+        i = 0
+        while i < len(expression):
+            c = expression[i]
+            if c.isspace():
+                i += 1
+            elif c in cls.TOKENS:
+                tokens.append(c)
+                i += 1
+            elif c.isdigit() or c == '.':
+                j = i
+                while j < len(expression) and (expression[j].isdigit() or expression[j] in '.eE' or
+                                               (expression[j] in '+-' and expression[j - 1] in 'eE')):
+                    j += 1
+                tokens.append(float(expression[i:j]))
+                i = j
+            elif c.isalpha() or c == '_':
+                j = i
+                while j < len(expression) and (expression[j].isalnum() or expression[j] in '_:'):
+                    j += 1
+                tokens.append(expression[i:j])
+                i = j
+            else:
+                raise ValueError('unexpected %r in function %r' % (c, expression))
+        return tokens
+
+    def peek(self):
+        return self.tokens[self.pos] if self.pos < len(self.tokens) else None
+
+    def take(self, expected=None):
+        token = self.peek()
+        if expected is not None and token != expected:
+            raise ValueError('expected %r, got %r' % (expected, token))
+        self.pos += 1
+        return token
+
+    def parse(self):
+        value = self.expr()
+        if self.peek() is not None:
+            raise ValueError('unexpected %r' % self.peek())
+        return value
+
+    def expr(self):
+        value = self.term()
+        while self.peek() in ('+', '-'):
+            op = self.take()
+            other = self.term()
+            if isinstance(value, Xf) or isinstance(other, Xf):
+                raise ValueError('transforms can only be multiplied')
+            value = value + other if op == '+' else value - other
+        return value
+
+    def term(self):
+        value = self.unary()
+        while self.peek() in ('*', '/'):
+            op = self.take()
+            other = self.unary()
+            if isinstance(value, Xf) and isinstance(other, Xf) and op == '*':
+                value = Xf(np.matmul(value.mats, other.mats))
+            elif isinstance(value, Xf) or isinstance(other, Xf):
+                raise ValueError('transforms can only be multiplied by transforms')
+            else:
+                value = value * other if op == '*' else value / other
+        return value
+
+    def unary(self):
+        if self.peek() == '-':
+            self.take()
+            value = self.unary()
+            if isinstance(value, Xf):
+                raise ValueError('a transform can not be negated')
+            return -value
+        return self.primary()
+
+    def primary(self):
+        token = self.take()
+        if isinstance(token, float):
+            return np.full(len(self.x), token)
+        if token == '(':
+            value = self.expr()
+            self.take(')')
+            return value
+        if token == 'X':
+            return self.x.copy()
+        if not isinstance(token, str):
+            raise ValueError('unexpected %r' % token)
+        name = token.split('::')[-1]
+        self.take('(')
+        args = [self.expr()]
+        while self.peek() == ',':
+            self.take()
+            args.append(self.expr())
+        self.take(')')
+        return self.call(name, args)
+
+    def call(self, name, args):
+        if name.lower() in SCALAR_FUNCTIONS:
+            return SCALAR_FUNCTIONS[name.lower()](args[0])
+        n = len(self.x)
+        if name in ('TranslateX3D', 'TranslateY3D', 'TranslateZ3D'):
+            vectors = np.zeros((n, 3))
+            vectors[:, 'XYZ'.index(name[9])] = args[0]
+            return Xf(translations(vectors))
+        if name in ('RotateX3D', 'RotateY3D', 'RotateZ3D'):
+            axis = np.zeros(3)
+            axis['XYZ'.index(name[6])] = 1.0
+            return Xf(rotations(axis, args[0]))
+        if name == 'Transform3D':
+            if len(args) != 12:
+                raise ValueError('Transform3D needs 12 numbers')
+            return Xf(from_rows(np.stack(args, axis=1)))
+        if name == 'Pow':
+            if not isinstance(args[0], Xf) or isinstance(args[1], Xf):
+                raise ValueError('Pow needs a transform and a function')
+            if n == 0:
+                return Xf(np.zeros((0, 4, 4)))
+            if not (args[0].mats == args[0].mats[0]).all():
+                raise ValueError('the transform of Pow depends on X')
+            return Xf(power(args[0].mats[0], args[1]))
+        raise ValueError('unknown function %s' % name)
+
+
+def serial_transforms(expression, copies):
+    """ (copies, 4, 4) transforms of a serial transformer function """
+    value = FunctionParser(expression, copies).parse()
+    if not isinstance(value, Xf):
+        raise ValueError('function %r is not a transform' % expression)
+    return value.mats
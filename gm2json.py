@@ -1,18 +1,18 @@
 #!/anaconda/bin/python
 
-### declarative autoload method ###
-# short-way:
-# - using autoload
-# - using the declarative way
-#
-# refs:
-# - http://www.blog.pythonlibrary.org/2010/09/10/sqlalchemy-connecting-to-pre-existing-databases/
-
 # use: gm2json.py -i geometry_atlas_20Apr17.db
+# the SQLAlchemy declarative mapping of --orm is in geo_orm.py
 
 """
 child table has id and position. it is not a regular table.
 
+From Python:
+    import gm2json
+    geometry = gm2json.open_geometry('geometry_atlas_20Apr17.db', max_depth=5)
+    docs = list(geometry.documents())
+    geometry.close()  # one geometry is open at a time
+Importing the module reads no arguments and opens nothing. SQLAlchemy is
+imported for --orm only, Elasticsearch by the es sink.
 """
 
 
@@ -22,222 +22,265 @@ import json
 import sys
 import os
 import copy
-import pprint
+import time
 import logging
-
-from sqlalchemy import create_engine
-from sqlalchemy.ext.declarative import declarative_base
-from sqlalchemy.orm import sessionmaker
-
-from elasticsearch import Elasticsearch, helpers, exceptions as es_exceptions
+import zipfile
+import fnmatch
+import tempfile
+import sqlite3
+import subprocess
+import multiprocessing
+from array import array
+from collections import OrderedDict
+
+import numpy as np
+
+import geo_transforms
+import geo_sinks
+import geo_shapes
+import geo_snapshot
+import geo_reindex
+import geo_stats
+import geo_tagindex
+import geo_normalize
+import geo_pipeline
+import geo_mass
+import geo_db
 
 PARSER = argparse.ArgumentParser(description='This code indexes geo info into ES.')
-PARSER.add_argument('-i', '--input', help='Input file name', required=True)
-ARGS = PARSER.parse_args()
-
-## show values ##
-print("Input file: %s" % ARGS.input)
-DB_PATH = ARGS.input
-
-
-if not os.path.isfile(DB_PATH):
-    logging.warning("could not find the input DB file!! Exiting...")
-    sys.exit()
-ENGINE = create_engine('sqlite:///%s' % DB_PATH, echo=False)
-BASE = declarative_base(ENGINE)
-
-es = Elasticsearch([{'host':'atlas-kibana.mwt2.org', 'port':9200}],timeout=60)
-docs_to_store=[]
+PARSER.add_argument('-i', '--input', required=True,
+                    help='Input file name, a SQLite geometry or a snapshot compiled by geo_snapshot.py')
+PARSER.add_argument('-s', '--sink', choices=geo_sinks.SINKS, default='es',
+                    help='where the documents go: Elasticsearch, an NDJSON file or stdout')
+PARSER.add_argument('-o', '--output', help='output file of the ndjson sink, .gz or .zst to compress')
+PARSER.add_argument('--compress', choices=['gzip', 'zstd'], help='compression of the ndjson sink')
+PARSER.add_argument('--normalize', action='store_true',
+                    help='write materials and shapes once as reference documents, volumes refer to them by id')
+PARSER.add_argument('--mass', action='store_true',
+                    help='add the mass (kg, with everything below), own_mass and net_volume of every volume')
+PARSER.add_argument('-p', '--preload', action='store_true',
+                    help='read the lookup tables and the children index into memory once '
+                    'instead of one query per node')
+PARSER.add_argument('--orm', action='store_true',
+                    help='read the DB through the SQLAlchemy ORM instead of prepared sqlite3 statements')
+PARSER.add_argument('--no-index-copy', action='store_true',
+                    help='read the DB as it is, not from a working copy with the ChildrenPositions indexes')
+PARSER.add_argument('--sqlite-cache-mb', type=int, default=geo_db.CACHE_MB, metavar='MB',
+                    help='page cache of every SQLite connection')
+PARSER.add_argument('--sqlite-mmap-mb', type=int, default=geo_db.MMAP_MB, metavar='MB',
+                    help='memory mapped part of the SQLite file')
+PARSER.add_argument('-d', '--max-depth', type=int, default=20, help='maximum depth to traverse')
+PARSER.add_argument('--tag-prefix', help='only export volumes under this NameTag path, eg. Tile/Barrel')
+PARSER.add_argument('--start-vol', action='append', default=[], metavar='[TABLE:]ID',
+                    help='export only below this PhysVol id (FullPhysVols:ID for a FullPhysVol), can be repeated')
+PARSER.add_argument('--start-logvol', action='append', default=[], metavar='NAME',
+                    help='export only below the volumes with this LogVol name, eg. TileEndcapNeg')
+PARSER.add_argument('--start-tag', action='append', default=[], metavar='PATTERN',
+                    help='export only below the volumes with this NameTag path, eg. Tile/Barrel or **/Module3')
+PARSER.add_argument('--include', action='append', default=[], metavar='PATTERN',
+                    help='only export the volumes under NameTag paths matching PATTERN (and the ones on the way)')
+PARSER.add_argument('--exclude', action='append', default=[], metavar='PATTERN',
+                    help='drop the volumes under NameTag paths matching PATTERN')
+PARSER.add_argument('--exclude-logvol', action='append', default=[], metavar='GLOB',
+                    help='drop the volumes whose LogVol name matches GLOB, with everything they contain')
+PARSER.add_argument('--branch-depth', action='append', default=[], metavar='PATTERN=DEPTH',
+                    help='maximum depth of the volumes under NameTag paths matching PATTERN, eg. Tile/**=4')
+PARSER.add_argument('--skip-material', action='append', default=[],
+                    help='do not export volumes of this material and their content, can be repeated')
+PARSER.add_argument('-w', '--workers', type=int, default=1,
+                    help='number of processes flattening subtrees in parallel')
+PARSER.add_argument('--pipeline', action='store_true',
+                    help='overlap the DB reads, the document building and the sink writes in an asyncio pipeline')
+PARSER.add_argument('--pipeline-batch', type=int, default=1000, metavar='N',
+                    help='volumes per pipeline batch, one bulk request each with the es sink')
+PARSER.add_argument('--pipeline-queue', type=int, default=8, metavar='N',
+                    help='batches waiting between two pipeline stages')
+PARSER.add_argument('--split-depth', type=int, default=0,
+                    help='with --workers, the subtree of every volume at this depth is one task')
+PARSER.add_argument('--es-host', default='atlas-kibana.mwt2.org:9200', help='Elasticsearch host:port')
+PARSER.add_argument('--chunk-docs', type=int, default=1000, help='max documents in one bulk request')
+PARSER.add_argument('--chunk-mb', type=float, default=10, help='max size of one bulk request in MB')
+PARSER.add_argument('--es-threads', type=int, default=4, help='number of bulk requests in flight')
+PARSER.add_argument('--dead-letter', default='dead_letter.ndjson',
+                    help='file for the documents Elasticsearch rejected')
+PARSER.add_argument('--cache-size', type=int, default=1000000,
+                    help='max number of volume records kept in the subtree cache, 0 disables it')
+PARSER.add_argument('--manifest-out', metavar='FILE',
+                    help='write the ids and content hashes of the exported volumes, for a later --diff-from')
+PARSER.add_argument('--diff-from', metavar='OLD',
+                    help='only store the volumes that changed since OLD, a --manifest-out file or an older '
+                    'DB or snapshot, and delete the ones that are gone')
+PARSER.add_argument('--tag-index-out', metavar='FILE',
+                    help='write the NameTag path index of the exported documents (see geo_tagindex.py)')
+PARSER.add_argument('--tag-index', metavar='FILE', help='NameTag path index of an earlier full export')
+PARSER.add_argument('--tag-query', metavar='PATTERN',
+                    help='only re-export the volumes under the --tag-index paths matching PATTERN, eg. Tile/*/Module3')
+PARSER.add_argument('-v', '--verbose', action='count', default=0,
+                    help='-v logs the progress of the stages, -vv every node and document')
+PARSER.add_argument('--log-json', action='store_true', help='log one JSON object per line')
+PARSER.add_argument('--stats', metavar='FILE', help='also write the JSON summary of the run to FILE')
+PARSER.add_argument('--progress', type=float, default=0, metavar='SECONDS',
+                    help='print the number of documents and the rate every SECONDS')
+PARSER.add_argument('--profile', metavar='FILE', help='run under cProfile and write its stats to FILE')
+
+ARGS = None  # the options, from the command line or open_geometry
+DOC_STREAM = sys.stdout  # where the stdout sink writes, before the printout is sent to stderr
+LOG_NODES = False  # the per node and per document log
+STATS = geo_stats.RunStats()
+
+DB_PATH = None  # the input file
+SNAPSHOT = None  # geo_snapshot.Snapshot when the input is a compiled snapshot
+DB = None  # geo_db.GeometryDB of a SQLite input, unless --orm
+ORM = None  # the geo_orm module, imported for --orm only
+SESSION = None  # geo_orm session of --orm
+ROOT = None  # the root volume
+
+SINK = None  # one of geo_sinks, created when the traversal starts
 
 # debug containers
 NOTEXPANDED = set()  # store the GeoModel objects which are not expanded
 
-#------------------------------------------------------------------------
-
-
-class MyBaseClass(object):
-    """ a general node object can be from any table."""
-    __table__ = None
-    def as_dict(self):
-        """returns a dictionary of all the columns and values
-        eg {'id': 3798, 'name': u'BLM Module'}
-        """
-        return {c.name: getattr(self, c.name) for c in self.__table__.columns}
+# lookup tables read once in --preload mode
+PRELOAD_TABLES = ['GeoNodesTypes', 'LogVols', 'Materials', 'Shapes', 'Transforms',
+                  'AlignableTransforms', 'NameTags', 'PhysVols', 'FullPhysVols',
+                  'SerialTransformers', 'Functions', 'SerialDenominators']
+PRELOADED = {}  # tableName -> {id: item}
+NODE_TYPE_TABLES = {}  # nodeType -> tableName, filled by preload_tables
+QUERY_STATS = geo_stats.ThreadCounters(('issued', 'avoided'))  # the --pipeline threads count apart
+CHILDREN_INDEX = None  # ChildrenIndex, built in --preload mode
+SUBTREE_CACHE = None  # SubtreeCache, disabled with --cache-size 0
+WORKER_PRUNE = None  # pruning predicate in --workers processes
+TRANSFORM_MATRICES = {}  # (tableName, id) -> 4x4 matrix of a transform row
+SERIAL_TRANSFORMS = {}  # (function id, copies) -> (copies, 4, 4) transforms
+SHAPES = None  # geo_shapes.ShapeParser, each Shapes row is parsed once
+REINDEX = None  # geo_reindex.Reindex, stable document ids and the --diff-from comparison
+PLACED = []  # documents placed by prune_unchanged, waiting for generate_document
+TAG_INDEX = None  # geo_tagindex.TagIndexBuilder of --tag-index-out
+QUERY_INDEX = None  # geo_tagindex.TagIndex of --tag-index
+STARTS = None  # placements of the --start-* volumes, None to export from the root volume
+SELECTED = []  # document numbers placed by prune_tag_query, None for a volume on the way
+MASS = None  # geo_mass.MassAggregator of --mass
+OPENED = None  # the Geometry of open_geometry, until it is closed
 
-### Utility tables ###
+#------------------------------------------------------------------------
 
 
-class GeoNodesType(BASE, MyBaseClass):
-    """ there are 11 node types
-    id:1 nodeType:GeoPhysVol tableName:PhysVols
-    id:2 nodeType:GeoFullPhysVol tableName:FullPhysVols
-    ...
-    id:11 nodeType:GeoNameTag tableName:NameTags
+class Transf():
+    """ used for folding all the transforms.
+    Holds a 4x4 homogeneous matrix, see geo_transforms.
+    The matrix is never modified in place so copies can share it.
     """
-    nodeType = None
-    tableName = None
-    __tablename__ = 'GeoNodesTypes'
-    __table_args__ = {'autoload': True}
-
-class RootVolume(BASE, MyBaseClass):
-    """docstring for ."""
-    __tablename__ = 'RootVolume'
-    __table_args__ = {'autoload': True}
-
-
-class ChildPos(BASE, MyBaseClass):
-    """docstring for ."""
-    parentId = None
-    __tablename__ = 'ChildrenPositions'
-    __table_args__ = {'autoload': True}
-
-
-
-
-### GeoModel objects tables ###
-
-class PhysVol(BASE, MyBaseClass):
-    """ from table 1. only points to a logvol"""
-    logvol = None
-    __tablename__ = 'PhysVols'
-    __table_args__ = {'autoload': True}
-    def __repr__(self):
-        return self.as_dict().__str__()
-
-class LogVol(BASE, MyBaseClass):
-    """ from table 3. """
-    name = None
-    shape = None
-    material = None
-    __tablename__ = 'LogVols'
-    __table_args__ = {'autoload': True}
-
-
-class Material(BASE, MyBaseClass):
-    """from table 4"""
-    name = None
-    __tablename__ = 'Materials'
-    __table_args__ = {'autoload': True}
+    def __init__(self, m=None):
+        if m is None:
+            m = geo_transforms.identity()
+        self.m = m
 
+    def add_transform(self, rt):
+        """ appends a child transform (a Transf or a Transforms/AlignableTransforms row) """
+        self.m = self.m @ transform_matrix(rt)
 
-class Shape(BASE, MyBaseClass):
-    """from table 5."""
-    type = None  # string like box, cylinder etc.
-    parameters = None # string that needs parsing.
-    __tablename__ = 'Shapes'
-    __table_args__ = {'autoload': True}
+    def matrix(self):
+        """ returning rotation matrix and translation """
+        return geo_transforms.to_row(self.m)
 
 
-class SerialDenominator(BASE, MyBaseClass):
-    """docstring for ."""
-    __tablename__ = 'SerialDenominators'
-    __table_args__ = {'autoload': True}
+def transform_matrix(rt):
+    """ 4x4 matrix of a Transf or of a transform row, rows are converted once """
+    if isinstance(rt, Transf):
+        return rt.m
+    key = (rt.__tablename__, rt.id)
+    if key not in TRANSFORM_MATRICES:
+        TRANSFORM_MATRICES[key] = geo_transforms.from_item(rt)
+    return TRANSFORM_MATRICES[key]
 
 
-class Function(BASE, MyBaseClass):
-    """docstring for ."""
-    __tablename__ = 'Functions'
-    __table_args__ = {'autoload': True}
+def place(parent, locals_):
+    """ geo_transforms.place, timed as the transform stage """
+    with STATS.timer('transform'):
+        return geo_transforms.place(parent, locals_)
 
 
-class SerialTransformer(BASE, MyBaseClass):
-    """docstring for ."""
-    __tablename__ = 'SerialTransformers'
-    __table_args__ = {'autoload': True}
+def stack_transforms(records):
+    """ (N, 4, 4) array of the transforms of records """
+    if not records:
+        return np.zeros((0, 4, 4))
+    return np.stack([rec[2].m for rec in records])
 
 
-class AlignableTransform(BASE, MyBaseClass):
-    """in table 10. only these 12 variables and id
-      xx, xy, xz, yx, yy, yz, zx, zy, zz
-      dx, dy, dz
+class ChildrenIndex():
+    """ ChildrenPositions in compressed sparse row layout.
+    Rows are sorted by (parentTable, parentId, position) and stored column-wise.
+    For a parent the children are rows offsets[parentTable][parentId] up to
+    offsets[parentTable][parentId + 1].
     """
-    __tablename__ = 'AlignableTransforms'
-    __table_args__ = {'autoload': True}
-    def __repr__(self):
-        return [self.xx, self.xy, self.xz, self.yx, self.yy, self.yz, self.zx, self.zy, self.zz, self.dx, self.dy, self.dz].__str__()
-
-
-class NameTags(BASE, MyBaseClass):
-    """docstring for ."""
-    __tablename__ = 'NameTags'
-    __table_args__ = {'autoload': True}
-    def __repr__(self):
-        return self.as_dict().__str__()
-
-class FullPhysVols(BASE, MyBaseClass):
-    """ points to a log_vol. comes from table 2."""
-    logvol = None
-    __tablename__ = 'FullPhysVols'
-    __table_args__ = {'autoload': True}
-    def __repr__(self):
-        return self.as_dict().__str__()
-
-
-class Transforms(BASE, MyBaseClass):
-    """in table 9. only these 12 variables and id
-       xx, xy, xz, yx, yy, yz, zx, zy, zz
-       dx, dy, dz
+    def __init__(self, res):
+        self.ids = array('q')
+        self.child_tables = array('q')
+        self.child_ids = array('q')
+        self.positions = array('q')
+        counts = {}  # parentTable -> {parentId: number of children}
+        for (row_id, parent_table, parent_id, child_table, child_id, position) in res:
+            self.ids.append(row_id)
+            self.child_tables.append(child_table)
+            self.child_ids.append(child_id)
+            self.positions.append(position)
+            table_counts = counts.setdefault(parent_table, {})
+            table_counts[parent_id] = table_counts.get(parent_id, 0) + 1
+
+        self.offsets = {}
+        start = 0
+        for parent_table in sorted(counts):
+            table_counts = counts[parent_table]
+            offsets = array('q', [0]) * (max(table_counts) + 2)
+            for parent_id in range(len(offsets) - 1):
+                offsets[parent_id] = start
+                start += table_counts.get(parent_id, 0)
+            offsets[-1] = start
+            self.offsets[parent_table] = offsets
+        logging.info('children index: %d rows for %d parents', len(self.ids), sum(len(c) for c in counts.values()))
+
+    def children(self, node_id, node_table):
+        """ same tuples as get_children_of_this_vol, ordered by position """
+        offsets = self.offsets.get(node_table)
+        if offsets is None or node_id + 1 >= len(offsets):
+            return []
+        first = offsets[node_id]
+        last = offsets[node_id + 1]
+        return [(self.ids[i], node_id, self.child_tables[i], self.child_ids[i], self.positions[i])
+                for i in range(first, last)]
+
+
+def get_children_rows(lsession):
+    """ (id, parentTable, parentId, childTable, childId, position) of all the
+    ChildrenPositions rows, sorted by (parentTable, parentId, position)
     """
-    __tablename__ = 'Transforms'
-    __table_args__ = {'autoload': True}
-    def __repr__(self):
-        return [self.xx, self.xy, self.xz, self.yx, self.yy, self.yz, self.zx, self.zy, self.zz, self.dx, self.dy, self.dz].__str__()
-
-#----------------------------------------------------------------------
-class Transf():
-    """ used for folding all the transforms """
-    def __init__(self):
-        self.xx = 1.0
-        self.xy = 0.0
-        self.xz = 0.0
-
-        self.yx = 0.0
-        self.yy = 1.0
-        self.yz = 0.0
-
-        self.zx = 0.0
-        self.zy = 0.0
-        self.zz = 1.0
-
-        self.dx = 0.0
-        self.dy = 0.0
-        self.dz = 0.0
-    def add_transform(self, rt):
-        s11 = self.xx * rt.xx + self.yx * rt.xy + self.zx * rt.xz
-        s12 = self.xy * rt.xx + self.yy * rt.xy + self.zy * rt.xz
-        s13 = self.xz * rt.xx + self.yz * rt.xy + self.zz * rt.xz
-
-        s21 = self.xx * rt.yx + self.yx * rt.yy + self.zx * rt.yz
-        s22 = self.xy * rt.yx + self.yy * rt.yy + self.zy * rt.yz
-        s23 = self.xz * rt.yx + self.yz * rt.yy + self.zz * rt.yz
-
-        s31 = self.xx * rt.zx + self.yx * rt.zy + self.zx * rt.zz
-        s32 = self.xy * rt.zx + self.yy * rt.zy + self.zy * rt.zz
-        s33 = self.xz * rt.zx + self.yz * rt.zy + self.zz * rt.zz
-
-        self.xx = s11
-        self.xy = s12
-        self.xz = s13
-        self.yx = s21
-        self.yy = s22
-        self.yz = s23
-        self.zx = s31
-        self.zy = s32
-        self.zz = s33
-
-        self.dx += rt.dx
-        self.dy += rt.dy
-        self.dz += rt.dz
+    QUERY_STATS['issued'] += 1
+    if DB is not None:
+        return DB.children_rows()
+    child = ORM.ChildPos
+    return lsession.query(child.id, child.parentTable, child.parentId, child.childTable, child.childId,
+                          child.position) \
+                   .order_by(child.parentTable, child.parentId, child.position).all()
+
+
+def open_db(path):
+    """ geo_db.GeometryDB of the input, read from a working copy with the
+    ChildrenPositions indexes unless --no-index-copy or the copy can't be written
+    """
+    if not ARGS.no_index_copy:
+        try:
+            path = geo_db.with_indexes(path)
+        except (OSError, sqlite3.Error) as e:
+            logging.warning("reading %s without the ChildrenPositions indexes: %s", path, e)
+    return geo_db.GeometryDB(path, ARGS.sqlite_cache_mb, ARGS.sqlite_mmap_mb)
 
-    def matrix(self):
-        """ returning rotation matrix only """
-        return [self.xx, self.xy, self.xz, self.yx, self.yy, self.yz, self.zx, self.zy, self.zz, self.dx, self.dy, self.dz]
 
 def load_session():
-    """docstring for ."""
-    # metadata = BASE.metadata
-    lsession = sessionmaker(bind=ENGINE)
-    return lsession()
+    """ geo_orm session on the input, for --orm. SQLAlchemy is imported here, not before. """
+    global ORM
+    import geo_orm
+    ORM = geo_orm
+    return geo_orm.open_session(DB_PATH)
 
 
 def dumpTable(lsession, table):
@@ -251,45 +294,115 @@ def dumpTable(lsession, table):
     return items
 
 
+def preload_tables(lsession, table_names=None):
+    """ reads the lookup tables once into id-keyed dicts.
+    After this get_item_from_table and the GeoNodesType lookups
+    are resolved from memory for these tables.
+    """
+    if table_names is None:
+        table_names = PRELOAD_TABLES
+    for table_name in table_names:
+        if DB is not None:
+            rows = DB.table(table_name)
+        else:
+            rows = lsession.query(get_class_by_tablename(table_name)).all()
+        PRELOADED[table_name] = {u.id: u for u in rows}
+        QUERY_STATS['issued'] += 1
+        logging.info('preloaded %d rows from %s', len(PRELOADED[table_name]), table_name)
+    if 'GeoNodesTypes' in PRELOADED:
+        for u in PRELOADED['GeoNodesTypes'].values():
+            NODE_TYPE_TABLES[u.nodeType] = u.tableName
+
+
 def get_item_from_table(tableName, itemId):
     # print "tableName:", tableName, "- itemId:", itemId # debug
+    if tableName in PRELOADED:
+        QUERY_STATS['avoided'] += 1
+        return PRELOADED[tableName][itemId]
+    if SNAPSHOT is not None:
+        QUERY_STATS['avoided'] += 1
+        return SNAPSHOT.row(tableName, itemId)
+    if DB is not None:
+        QUERY_STATS['issued'] += 1
+        return DB.row(tableName, itemId)
     tableClass = get_class_by_tablename(tableName)
     res = SESSION.query(tableClass).filter(tableClass.id == itemId).one()
+    QUERY_STATS['issued'] += 1
     return res
 
 
+def get_shape_row(shape_id):
+    """ type and parameters of a Shapes row """
+    shape = get_item_from_table('Shapes', shape_id)
+    return (shape.type, shape.parameters)
+
+
+def get_transform_row(transform_id):
+    """ 4x4 matrix of a Transforms row, used by Shift shapes """
+    return transform_matrix(get_item_from_table('Transforms', transform_id))
+
+
+SHAPES = geo_shapes.ShapeParser(get_shape_row, get_transform_row)
+
+
 def get_item_from_NodeType(nodeType, itemId):
     tableName = get_table_name_from_NodeType(nodeType)
     item = get_item_from_table(tableName, itemId)
     return item
 
 
-def get_type_and_item(table_id, item_id):
+def get_type_and_item(table_id, item_id, items=None):
     """ for a given tableID and itemID returns
-    nodeType and the item itself
+    nodeType and the item itself, from items if it is there
     """
-    table_name = get_tablename_from_tableid(table_id)
     node_type = get_nodetype_from_tableid(table_id)
-    item = get_item_from_table(table_name, item_id)
+    item = items.get((table_id, item_id)) if items else None
+    if item is None:
+        item = get_item_from_table(get_tablename_from_tableid(table_id), item_id)
     return (node_type, item)
 
 
+def prefetch_items(children):
+    """ {(table id, item id): item} of the children rows, read with one
+    statement per table, when the DB is read with geo_db and not preloaded
+    """
+    if DB is None or len(children) < 2:
+        return None
+    ids = {}  # table id -> item ids
+    for child in children:
+        ids.setdefault(child[2], []).append(child[3])
+    items = {}
+    for (table_id, item_ids) in ids.items():
+        table_name = get_tablename_from_tableid(table_id)
+        if table_name in PRELOADED or len(item_ids) < 2:
+            continue
+        QUERY_STATS['issued'] += 1
+        for (item_id, item) in DB.rows(table_name, item_ids).items():
+            items[(table_id, item_id)] = item
+    return items
+
+
 def get_tablename_from_tableid(table_id):
     """ for a given tableID returns tableName """
-    res = SESSION.query(GeoNodesType).filter(GeoNodesType.id == table_id).one()
-    return res.tableName
+    return get_item_from_table('GeoNodesTypes', table_id).tableName
 
 
 def get_table_name_from_NodeType(node_type):
     """ something """
-    res = SESSION.query(GeoNodesType).filter(GeoNodesType.nodeType == node_type).one()
+    if node_type in NODE_TYPE_TABLES:
+        QUERY_STATS['avoided'] += 1
+        return NODE_TYPE_TABLES[node_type]
+    if DB is not None:
+        QUERY_STATS['issued'] += 1
+        return DB.where('GeoNodesTypes', 'nodeType', [node_type])[0].tableName
+    res = SESSION.query(ORM.GeoNodesType).filter(ORM.GeoNodesType.nodeType == node_type).one()
+    QUERY_STATS['issued'] += 1
     return res.tableName
 
 
 def get_nodetype_from_tableid(tableId):
     """ something """
-    res = SESSION.query(GeoNodesType).filter(GeoNodesType.id == tableId).one()
-    return res.nodeType
+    return get_item_from_table('GeoNodesTypes', tableId).nodeType
 
 
 
@@ -301,7 +414,14 @@ def get_nodetype_from_tableid(tableId):
 
 def get_children_of_this_vol(node_id, node_table):
     """ get volume children and their positions """
-    ret = SESSION.query(ChildPos).filter(ChildPos.parentId == node_id).all()
+    if CHILDREN_INDEX is not None:
+        QUERY_STATS['avoided'] += 1
+        return CHILDREN_INDEX.children(node_id, node_table)
+    if DB is not None:
+        QUERY_STATS['issued'] += 1
+        return DB.children(node_id, node_table)
+    ret = SESSION.query(ORM.ChildPos).filter(ORM.ChildPos.parentId == node_id).order_by(ORM.ChildPos.position).all()
+    QUERY_STATS['issued'] += 1
     res = []
     for child in ret:
         if child.parentTable == node_table: # only if parent table was PhysVols
@@ -309,122 +429,876 @@ def get_children_of_this_vol(node_id, node_table):
     return [(u.id, u.parentId, u.childTable, u.childId, u.position,) for u in res]
 
 
-def getPhysVolChildrenExpanded(parentId, jsonOut=False):
-    """ get volume children, expanded view """
+class SubtreeCache():
+    """ LRU cache of expanded subtrees keyed by (table id, volume id).
+    A value is (levels, records) where records are relative to the cached volume
+    and their transforms to their parent volumes, see expand_subtree. The size is counted in records, subtrees larger
+    than max_records are never cached.
+    """
+    def __init__(self, max_records=1000000):
+        self.max_records = max_records
+        self.entries = OrderedDict()
+        self.records = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.too_big = set()  # keys of subtrees that were too large to keep
+
+    def get(self, key, levels):
+        """ returns the records of at most levels depth or None """
+        entry = self.entries.get(key)
+        if entry is None or entry[0] < levels:
+            self.misses += 1
+            return None
+        self.hits += 1
+        self.entries.move_to_end(key)
+        if entry[0] == levels:
+            return entry[1]
+        return [rec for rec in entry[1] if rec[0] < levels]
+
+    def put(self, key, levels, records):
+        if len(records) > self.max_records:
+            self.too_big.add(key)
+            return
+        old = self.entries.pop(key, None)
+        if old is not None:
+            self.records -= len(old[1])
+        self.entries[key] = (levels, records)
+        self.records += len(records)
+        while self.records > self.max_records:
+            (_, (_, evicted)) = self.entries.popitem(last=False)
+            self.records -= len(evicted)
+            self.evictions += 1
+
+    def stats(self):
+        return {'entries': len(self.entries), 'records': self.records, 'hits': self.hits,
+                'misses': self.misses, 'evictions': self.evictions}
+
+
+def expand_subtree(table_id, node, levels):
+    """ returns all the volumes under node, at most levels deep.
+    Records are (depth, tags, transform, item) relative to node: depth 0 are its
+    children, tags only contain the NameTags set inside the subtree and transform
+    is the local transform of the volume in its parent volume, the last record
+    one level up before it. place_records() makes the world transforms of them.
+    """
+    if SUBTREE_CACHE is not None:
+        records = SUBTREE_CACHE.get((table_id, node.id), levels)
+        if records is not None:
+            return records
+    return list(Traversal(table_id, node, levels - 1))
+
 
-    # get the list of children of this volume
-    children = get_children_of_phys_vol(parentId)
+def shift_records(records, depth, tags):
+    """ records relative to a volume as records of its parent, the local transforms stay """
+    return [(rec[0] + depth, tags + rec[1], rec[2], rec[3]) for rec in records]
 
-    childrenDict = {}
-    childrenDict['physVolId'] = parentId
-    childrenDict['children'] = {}
 
+def place_records(world, records):
+    """ world transforms of expand_subtree records of a volume placed at world.
+    Every record gets its parent's world transform times its local transform,
+    one matmul per level, so the floats are those of a traversal that is not
+    served from the cache.
+    """
+    locals_ = stack_transforms(records)
+    worlds = np.empty_like(locals_)
+    levels = {}  # depth -> ([record index], [index of the parent record])
+    last = {}  # depth -> index of the last record of that depth so far
+    for (i, rec) in enumerate(records):
+        (indices, parents) = levels.setdefault(rec[0], ([], []))
+        indices.append(i)
+        parents.append(last.get(rec[0] - 1))
+        last[rec[0]] = i
+    with STATS.timer('transform'):
+        for depth in sorted(levels):
+            (indices, parents) = levels[depth]
+            parent = world if depth == 0 else worlds[parents]
+            worlds[indices] = geo_transforms.place(parent, locals_[indices])
+    return worlds
+
+
+def sibling_group(children):
+    """ resolves the children of a volume and the local transforms of its volumes.
+    Returns ([(position, node_type, item)], (N, 4, 4) array) where row k is the
+    product of the transforms preceding the k-th PhysVol/FullPhysVol child.
+    A GeoSerialTransformer is resolved into one GeoSerialCopy entry per copy,
+    its item is (volume table id, volume, expanded volume item), and a row
+    for every copy with the copy's transform applied.
+    """
+    resolved = []
+    locals_ = []
+    pending = []
+    items = prefetch_items(children)
     for child in children:
-        id = child[0]
-        parentId = child[1]
-        childTable = child[2]
-        childId = child[3]
-        position = child[4]
+        (node_type, node) = get_type_and_item(child[2], child[3], items)
+        if node_type == "GeoAlignableTransform" or node_type == "GeoTransform":
+            pending.append(transform_matrix(node))
+        elif node_type == "GeoPhysVol" or node_type == "GeoFullPhysVol":
+            with STATS.timer('transform'):
+                locals_.append(geo_transforms.product(pending)[None])
+            pending = []
+        elif node_type == "GeoSerialTransformer":
+            try:
+                (vol_table, vol, mats) = serial_transformer_volume(node)
+            except (ValueError, KeyError) as e:
+                logging.warning("GeoSerialTransformer %s not expanded: %s", node.id, e)
+                resolved.append((child[4], node_type, node))
+                continue
+            vol_item = get_physvol_item(vol)
+            for _ in range(len(mats)):
+                resolved.append((child[4], "GeoSerialCopy", (vol_table, vol, vol_item)))
+            with STATS.timer('transform'):
+                locals_.append(geo_transforms.place(geo_transforms.product(pending), mats))
+            pending = []
+            continue
+        resolved.append((child[4], node_type, node))
+    if not locals_:
+        return (resolved, np.zeros((0, 4, 4)))
+    return (resolved, np.concatenate(locals_))
 
-        typeAndItem = get_type_and_item(childTable, childId)
-        logging.debug("item: " + typeAndItem.__repr__())  # debug
 
-        nodeType = typeAndItem[0]
-        nodeItem = typeAndItem[1]
+def serial_transformer_volume(node):
+    """ (volume table id, volume, (copies, 4, 4) transforms) of a GeoSerialTransformer.
+    The function is evaluated once for all copies and kept per (function, copies).
+    """
+    item_dict = node.as_dict()
+    func_id = item_dict.get('funcId', item_dict.get('func'))
+    vol_id = item_dict.get('volId', item_dict.get('vol'))
+    vol_table = item_dict.get('volTable') or 1
+    copies = item_dict.get('copies')
+    if copies is None:
+        raise ValueError('number of copies unknown')
+    key = (func_id, copies)
+    if key not in SERIAL_TRANSFORMS:
+        function = get_item_from_table('Functions', func_id).as_dict()
+        expression = function.get('expression')
+        if expression is None:
+            expression = [v for (k, v) in function.items() if k != 'id'][0]
+        with STATS.timer('transform'):
+            SERIAL_TRANSFORMS[key] = geo_transforms.serial_transforms(expression, copies)
+    vol = get_item_from_table(get_tablename_from_tableid(vol_table), vol_id)
+    return (vol_table, vol, SERIAL_TRANSFORMS[key])
+
+
+def prune_tag_prefix(prefix):
+    """ pruning predicate for Traversal: keeps only the volumes whose
+    NameTag path is on the way to, or below, prefix (eg. 'Tile/Barrel')
+    """
+    wanted = [t for t in prefix.split('/') if t]
 
-        # childrenDict['children'] = {}
-        childrenDict['children'][position] = {}
-        childrenDict['children'][position]['type'] = nodeType
-        childrenDict['children'][position]['object'] = nodeItem.as_dict()
+    def prune(record):
+        tags = record[1]
+        n = min(len(tags), len(wanted))
+        return list(tags[:n]) != wanted[:n]
+    return prune
 
-    if jsonOut:
-        return json.dumps(childrenDict)
-    return childrenDict
 
+def prune_material(names):
+    """ pruning predicate for Traversal: drops volumes made of these materials
+    together with everything they contain
+    """
+    names = set(names)
 
-def get_all_nodes(node, tags, current_transform, current_depth, max_depth):
-    """ Main function that starts traverse. Not recursively callable """
+    def prune(record):
+        return record[3]['logvol']['object']['material']['name'] in names
+    return prune
 
-    print("*" * current_depth, end=' ')
-    print("node - ", node.__tablename__, node.as_dict())
-    #print("node-  id:", node.id, "\ttable:", node.volTable)
 
-    if current_depth==0 or node.__tablename__ == 'PhysVols': #root node
-        children = get_children_of_this_vol(node.id, 1)
-    else:
-        if node.__tablename__=='FullPhysVols':
-            children = get_children_of_this_vol(node.id, 2) 
-            
+def prune_unchanged(prune=None):
+    """ pruning predicate of --diff-from: makes and places the document of every
+    volume, skips the volumes whose document and subtree did not change since
+    the baseline. prune is applied first.
+    """
+    def check(record):
+        if prune is not None and prune(record):
+            return True
+        (depth, tags, transform, item) = record
+        doc = make_document(item, depth, tags, transform)
+        status = REINDEX.place(doc, volume_key(item))
+        if status == geo_reindex.SKIPPED:
+            return True
+        PLACED.append((doc, status))
+        return False
+    return check
+
+
+def prune_tag_query(index, ranges, prune=None):
+    """ pruning predicate of --tag-query: follows the document numbers of the
+    export the index was made from, skips the subtrees without a selected
+    document. The volumes on the way are visited but not stored.
+    prune is the one of that export, the volumes it drops are not numbered.
+    """
+    selection = geo_tagindex.RangeSelection(ranges)
+    ends = index.ends
+    cursor = [0]
+
+    def check(record):
+        if prune is not None and prune(record):
+            return True
+        i = cursor[0]
+        if i >= len(ends):
+            logging.error("more volumes than in the tag index, was it made from this DB?")
+            return True
+        if i in selection:
+            cursor[0] = i + 1
+            SELECTED.append(i)
+            return False
+        if selection.overlaps(i, int(ends[i])):
+            cursor[0] = i + 1
+            SELECTED.append(None)
+            return False
+        cursor[0] = int(ends[i])
+        return True
+    return check
+
+
+def prune_include(patterns):
+    """ pruning predicate for Traversal: keeps the volumes under the NameTag paths
+    matching one of the patterns and the volumes on the way to them
+    """
+    steps = [geo_tagindex.split_path(pattern) + ['**'] for pattern in patterns]
 
-    if not children:
-        print("no children. Returns...")
-        return
-    else:
-        print("got:", len(children), "children")
+    def prune(record):
+        return not any(geo_tagindex.path_matches(s, record[1], partial=True) for s in steps)
+    return prune
 
-    folded_transform = copy.copy(current_transform)
 
-    for child in children:
-        # id = child[0]  unused ?
-        #parentId = child[1]  unused ?
-        child_table = child[2]
-        child_id = child[3]
-        position = child[4]
+def prune_exclude(patterns):
+    """ pruning predicate for Traversal: drops the volumes under the NameTag paths matching a pattern """
+    steps = [geo_tagindex.split_path(pattern) + ['**'] for pattern in patterns]
 
-        (node_type, node) = get_type_and_item(child_table, child_id)
+    def prune(record):
+        return any(geo_tagindex.path_matches(s, record[1]) for s in steps)
+    return prune
 
 
-        print(" pos:", position, 'tags:', tags, end=' ')
-        print("type: " + node_type.__repr__()  + "   item:" + node.__repr__())
+def prune_logvol(globs):
+    """ pruning predicate for Traversal: drops the volumes whose LogVol name matches
+    one of the globs, together with everything they contain
+    """
+    def prune(record):
+        name = record[3]['logvol']['object']['name']
+        return any(fnmatch.fnmatchcase(name, g) for g in globs)
+    return prune
 
-        if node_type == "GeoNameTag":
-            tags[current_depth] = node.name
-            continue
 
-        if node_type == "GeoAlignableTransform" or node_type == "GeoTransform":
-            folded_transform.add_transform(node)
-            continue
+def prune_branch_depth(limits):
+    """ pruning predicate for Traversal: limits is [(pattern, depth)], the volumes under
+    NameTag paths matching the pattern are only visited down to the depth
+    """
+    limits = [(geo_tagindex.split_path(pattern) + ['**'], depth) for (pattern, depth) in limits]
 
-        if node_type == "GeoPhysVol" or node_type == "GeoFullPhysVol":
-            #get_phys_vol_children(node, tags, current_transform, current_depth+1, max_depth)
-            phys_vol_expanded = get_physvol_item(node)
-            generate_document(phys_vol_expanded, current_depth, tags, folded_transform)
-            
-            #print(node.as_dict())
-
-            if current_depth < max_depth:
-                get_all_nodes(node, tags, folded_transform, current_depth+1, max_depth)
-            if current_depth+1 in tags: # can't leave them hanging
-                del tags[current_depth+1]
-            continue
+    def prune(record):
+        return any(record[0] > depth and geo_tagindex.path_matches(s, record[1]) for (s, depth) in limits)
+    return prune
+
+
+def parse_branch_depth(value):
+    """ (pattern, depth) of a --branch-depth PATTERN=DEPTH """
+    (pattern, _, depth) = value.rpartition('=')
+    if not pattern or not depth.isdigit():
+        PARSER.error('--branch-depth takes PATTERN=DEPTH, not %r' % value)
+    return (pattern, int(depth))
+
+
+def get_row_dict(table_name, row_id):
+    """ a row as a dict, for geo_reindex.SubtreeHasher """
+    return get_item_from_table(table_name, row_id).as_dict()
+
+
+def baseline_manifest(path):
+    """ the --diff-from manifest: a saved one, or made by exporting an older DB
+    or snapshot with the same options into the null sink
+    """
+    if zipfile.is_zipfile(path):
+        return geo_reindex.Manifest.load(path)
+    (fd, manifest_path) = tempfile.mkstemp(suffix='.npz')
+    os.close(fd)
+    cmd = [sys.executable, os.path.abspath(__file__), '-i', path, '-s', 'null', '-d', str(ARGS.max_depth),
+           '--cache-size', str(ARGS.cache_size), '--manifest-out', manifest_path]
+    if ARGS.preload:
+        cmd.append('-p')
+    if ARGS.orm:
+        cmd.append('--orm')
+    if ARGS.mass:
+        cmd.append('--mass')
+    if ARGS.tag_prefix:
+        cmd += ['--tag-prefix', ARGS.tag_prefix]
+    for name in ARGS.skip_material:
+        cmd += ['--skip-material', name]
+    logging.info('making the baseline manifest of %s', path)
+    try:
+        subprocess.check_call(cmd, stdout=subprocess.DEVNULL)
+        return geo_reindex.Manifest.load(manifest_path)
+    finally:
+        os.remove(manifest_path)
+
+
+def export_options():
+    """ the options a manifest is only comparable under """
+    options = {'max_depth': ARGS.max_depth, 'tag_prefix': ARGS.tag_prefix,
+               'skip_material': sorted(ARGS.skip_material)}
+    for name in ('mass', 'start_vol', 'start_logvol', 'start_tag', 'include', 'exclude', 'exclude_logvol',
+                 'branch_depth'):
+        if getattr(ARGS, name):
+            options[name] = getattr(ARGS, name)
+    return options
+
+
+class Traversal():
+    """ iterator over the flattened volumes below a PhysVol or FullPhysVol.
+    Yields (depth, tags, transform, item) records in the same order the
+    recursive traversal used to generate documents, but keeps its own stack
+    so the depth is not limited by the Python recursion limit.
+
+    max_depth - volumes deeper than this are not visited
+    prune - callable(record) returning True skips the volume and its subtree
+    transform, tags, depth - placement of the starting volume's children
+    fill_cache - store the subtrees of visited volumes in the subtree cache
+
+    Every frame on the stack keeps the world transform of its volume, and the
+    world transforms of all its daughters are computed with one matmul when
+    the frame is entered. Subtrees found in the cache are only placed again.
+    Every frame also collects its records relative to its own volume, with
+    their local transforms, and these are cached when the frame is done, unless
+    they grew over the cache size. Placing them again folds the transforms in
+    the same order, so cached and uncached subtrees give the same floats.
+
+    Iteration can be stopped at any time. state() returns a picklable
+    snapshot of the stack that Traversal.resume() continues from.
+    """
+    def __init__(self, table_id, node, max_depth=20, prune=None, transform=None, tags=(), depth=0,
+                 fill_cache=True):
+        self.max_depth = max_depth
+        self.prune = prune
+        # a pruned subtree is incomplete so it can't be cached
+        self.fill_cache = fill_cache and SUBTREE_CACHE is not None and prune is None
+        self.stack = []
+        if node is not None:
+            if transform is None:
+                transform = Transf()
+            self.push_volume(table_id, node.id, depth, tuple(tags), transform.m, ())
+
+    def __iter__(self):
+        return self
+
+    def push_volume(self, table_id, vol_id, depth, tags, world, parent_tags):
+        """ children of vol_id will be visited at depth, world is the volume's transform.
+        parent_tags are the tags of this volume in the parent frame.
+        """
+        key = (table_id, vol_id)
+        collect = None
+        if self.fill_cache and key not in SUBTREE_CACHE.too_big:
+            collect = []
+        self.stack.append({'kind': 'vol', 'table': table_id, 'id': vol_id, 'index': 0, 'volume': 0,
+                           'depth': depth, 'tags': tags, 'tag': None, 'denominator': None, 'serial': 0,
+                           'world': world,
+                           'parent_tags': parent_tags, 'collect': collect})
+
+    def push_cached(self, key, levels, records, depth, tags, world):
+        """ records from the subtree cache, placed at depth under tags and world """
+        self.stack.append({'kind': 'cached', 'key': key, 'levels': levels, 'index': 0, 'depth': depth,
+                           'tags': tags, 'world': world, 'skip': None, 'records': records,
+                           'placed': place_records(world, records)})
+
+    def state(self):
+        """ picklable snapshot of the traversal. Subtrees being collected
+        for the cache at that moment are not cached after a resume.
+        """
+        frames = []
+        for frame in self.stack:
+            frames.append({k: copy.copy(v) for k, v in frame.items()
+                           if k not in ('children', 'locals', 'worlds', 'records', 'placed', 'collect')})
+        return {'max_depth': self.max_depth, 'fill_cache': self.fill_cache, 'frames': frames}
+
+    @classmethod
+    def resume(cls, state, prune=None):
+        """ continues a traversal from a state() snapshot """
+        trav = cls(None, None, state['max_depth'], prune, fill_cache=state['fill_cache'])
+        for frame in state['frames']:
+            frame = {k: copy.copy(v) for k, v in frame.items()}
+            if frame['kind'] == 'vol':
+                frame['collect'] = None
+            trav.stack.append(frame)
+        return trav
+
+    def __next__(self):
+        start = time.perf_counter()
+        try:
+            return self.next_record()
+        finally:
+            STATS.add_time('traversal', time.perf_counter() - start)
+
+    def next_record(self):
+        while self.stack:
+            frame = self.stack[-1]
+            if frame['kind'] == 'cached':
+                record = self.next_cached(frame)
+            else:
+                record = self.next_child(frame)
+            if record is not None:
+                return record
+        raise StopIteration
+
+    def next_cached(self, frame):
+        """ places the next cached record, None when nothing to yield yet """
+        if 'records' not in frame:  # resumed
+            (table_id, vol_id) = frame['key']
+            node = get_item_from_table(get_tablename_from_tableid(table_id), vol_id)
+            frame['records'] = expand_subtree(table_id, node, frame['levels'])
+            frame['placed'] = place_records(frame['world'], frame['records'])
+        records = frame['records']
+        while frame['index'] < len(records):
+            (depth, tags, _, item) = records[frame['index']]
+            placed = frame['placed'][frame['index']]
+            frame['index'] += 1
+            if frame['skip'] is not None:
+                if depth > frame['skip']:
+                    continue
+                frame['skip'] = None
+            record = (frame['depth'] + depth, frame['tags'] + tags, Transf(placed), item)
+            if self.prune is not None and self.prune(record):
+                frame['skip'] = depth
+                continue
+            return record
+        self.stack.pop()
+        return None
+
+    def next_child(self, frame):
+        """ processes children of the frame until one volume is found """
+        if 'children' not in frame:
+            (frame['children'], frame['locals']) = sibling_group(
+                get_children_of_this_vol(frame['id'], frame['table']))
+            frame['worlds'] = place(frame['world'], frame['locals'])
+        children = frame['children']
+        current_depth = frame['depth']
+        while frame['index'] < len(children):
+            (position, node_type, node) = children[frame['index']]
+            frame['index'] += 1
+            STATS.count('nodes.' + node_type)
+            if LOG_NODES:
+                logging.debug("%s pos: %s tag: %s type: %r   item: %r", "*" * current_depth, position,
+                              frame['tag'], node_type, node)
+
+            if node_type == "GeoNameTag":
+                frame['tag'] = node.name
+                frame['denominator'] = None
+                continue
+
+            if node_type == "GeoSerialDenominator":
+                # names the following volumes baseName0, baseName1, ...
+                frame['tag'] = None
+                frame['denominator'] = node.baseName
+                frame['serial'] = 0
+                continue
+
+            if node_type == "GeoAlignableTransform" or node_type == "GeoTransform":
+                continue  # already folded by sibling_group
+
+            if node_type in ("GeoPhysVol", "GeoFullPhysVol", "GeoSerialCopy"):
+                volume = frame['volume']
+                frame['volume'] += 1
+                if node_type == "GeoSerialCopy":
+                    (table_id, node, item) = node
+                else:
+                    table_id = get_tableid_from_node(node)
+                    item = get_physvol_item(node)
+                if frame['denominator'] is not None:
+                    tag = (frame['denominator'] + str(frame['serial']),)
+                    frame['serial'] += 1
+                elif frame['tag'] is not None:
+                    tag = (frame['tag'],)
+                else:
+                    tag = ()
+                world = frame['worlds'][volume]
+                record = (current_depth, frame['tags'] + tag, Transf(world), item)
+                if self.prune is not None and self.prune(record):
+                    return None
+                local = Transf(frame['locals'][volume])
+                self.collect(frame, [(0, tag, local, item)])
+                if current_depth < self.max_depth:
+                    self.descend(frame, table_id, node, record, tag)
+                return record
 
-        #else:
-        #    continue
-        # if (node_type == "GeoSerialDenominator"):
-        #     nodeItemExpanded = get_physvol_item(node)
-        #elif (node_type == "GeoSerialTransformer"):
-        #    (volId, nodeItemExpanded) = getSerialTransformerItemExpanded(node)
-        # nodeItemExpanded = get_all_nodes_recurse(volId, depth-1, nodeItemExpanded['vol'])
-        else:
-            # print "WARNING!! node type", nodeType, "not expanded"
             NOTEXPANDED.add(node_type)
-            #node_item_expanded = node.as_dict()
 
-    return
+        self.stack.pop()
+        self.finish(frame)
+        return None
+
+    def collect(self, frame, records):
+        """ adds records relative to the frame's volume to its collection """
+        if frame['collect'] is None:
+            return
+        frame['collect'].extend(records)
+        if len(frame['collect']) > SUBTREE_CACHE.max_records:
+            SUBTREE_CACHE.too_big.add((frame['table'], frame['id']))
+            frame['collect'] = None
+
+    def finish(self, frame):
+        """ caches the collected subtree of a finished frame and hands it to the parent """
+        levels = self.max_depth - frame['depth'] + 1
+        collected = frame['collect']
+        if collected is not None:
+            SUBTREE_CACHE.put((frame['table'], frame['id']), levels, collected)
+        if not self.stack or self.stack[-1]['kind'] != 'vol':
+            return
+        parent = self.stack[-1]
+        if collected is None:
+            if parent['collect'] is not None:
+                SUBTREE_CACHE.too_big.add((parent['table'], parent['id']))
+                parent['collect'] = None
+            return
+        self.collect(parent, shift_records(collected, 1, frame['parent_tags']))
+
+    def descend(self, frame, table_id, node, record, tag):
+        """ schedules the subtree of a volume that was just yielded """
+        (depth, tags, transform, _) = record
+        levels = self.max_depth - depth
+        key = (table_id, node.id)
+        records = None
+        if SUBTREE_CACHE is not None:
+            records = SUBTREE_CACHE.get(key, levels)
+        if records is not None:
+            self.collect(frame, shift_records(records, 1, tag))
+            self.push_cached(key, levels, records, depth + 1, tags, transform.m)
+        else:
+            self.push_volume(table_id, node.id, depth + 1, tags, transform.m, tag)
+
+
+def get_tableid_from_node(node):
+    """ GeoNodesTypes id of the table a PhysVol or FullPhysVol comes from """
+    return 2 if node.__tablename__ == 'FullPhysVols' else 1
+
+
+def volume_key(item):
+    """ (table id, volume id) of a get_physvol_item dict """
+    return (2 if item['table'] == 'FullPhysVols' else 1, item['id'])
+
+
+def get_all_nodes(node, tags, current_transform, current_depth, max_depth, prune=None):
+    """ Main function that starts traverse. Not recursively callable.
+    Generates a document for every volume the Traversal yields.
+    """
+
+    logging.info("%s node - %s %s", "*" * current_depth, node.__tablename__, node.as_dict())
+
+    table_id = get_tableid_from_node(node)
+    for (depth, tag_list, transform, item) in Traversal(table_id, node, max_depth, prune, current_transform,
+                                                        tags.values(), current_depth):
+        generate_document(item, depth, tag_list, transform)
+
+def get_all_items(table_name):
+    """ all the rows of a table """
+    if table_name in PRELOADED:
+        QUERY_STATS['avoided'] += 1
+        return list(PRELOADED[table_name].values())
+    if SNAPSHOT is not None:
+        QUERY_STATS['avoided'] += 1
+        return [SNAPSHOT.row(table_name, i) for i in SNAPSHOT.ids(table_name).tolist()]
+    QUERY_STATS['issued'] += 1
+    if DB is not None:
+        return DB.table(table_name)
+    return SESSION.query(get_class_by_tablename(table_name)).all()
+
+
+def get_items_where(table_name, column, values):
+    """ the rows of a table whose column has one of the values """
+    values = set(values)
+    if table_name in PRELOADED or SNAPSHOT is not None:
+        return [u for u in get_all_items(table_name) if getattr(u, column) in values]
+    QUERY_STATS['issued'] += 1
+    if DB is not None:
+        return DB.where(table_name, column, values)
+    table_class = get_class_by_tablename(table_name)
+    return SESSION.query(table_class).filter(getattr(table_class, column).in_(values)).all()
+
+
+def get_tableid_from_nodetype(node_type):
+    """ GeoNodesTypes id of a node type """
+    for u in get_all_items('GeoNodesTypes'):
+        if u.nodeType == node_type:
+            return u.id
+    return None
+
+
+def get_parents_of_this_vol(node_id, node_table):
+    """ (parentTable, parentId) of the volumes that have the node as a child """
+    if SNAPSHOT is not None:
+        QUERY_STATS['avoided'] += 1
+        return SNAPSHOT.parents(node_id, node_table)
+    if DB is not None:
+        QUERY_STATS['issued'] += 1
+        return DB.parents(node_id, node_table)
+    res = SESSION.query(ORM.ChildPos.parentTable, ORM.ChildPos.parentId) \
+                 .filter(ORM.ChildPos.childId == node_id, ORM.ChildPos.childTable == node_table).all()
+    QUERY_STATS['issued'] += 1
+    return [(parent_table, parent_id) for (parent_table, parent_id) in res]
+
+
+def get_ancestors(keys):
+    """ (table id, volume id) of the volumes above the volumes keys, these included.
+    A volume placed by a serial transformer is below the parents of the transformer.
+    """
+    serial_table = get_tableid_from_nodetype('GeoSerialTransformer')
+    serials = {}  # (volTable, volId) -> SerialTransformers ids placing copies of it
+    for u in get_all_items('SerialTransformers'):
+        row = u.as_dict()
+        serials.setdefault((row.get('volTable') or 1, row.get('volId', row.get('vol'))), []).append(row['id'])
+    seen = set(keys)
+    todo = list(keys)
+    while todo:
+        key = todo.pop()
+        placing = [key] + [(serial_table, st_id) for st_id in serials.get(key, ())]
+        for (child_table, child_id) in placing:
+            for parent in get_parents_of_this_vol(child_id, child_table):
+                if parent not in seen:
+                    seen.add(parent)
+                    todo.append(parent)
+    return seen
+
+
+def find_volumes(logvol_names):
+    """ (table id, volume id) of the PhysVols and FullPhysVols with one of the LogVol names """
+    logvols = [u.id for u in get_items_where('LogVols', 'name', logvol_names)]
+    keys = []
+    if logvols:
+        for (table_id, table_name) in ((1, 'PhysVols'), (2, 'FullPhysVols')):
+            keys += [(table_id, u.id) for u in get_items_where(table_name, 'logvol', logvols)]
+    return keys
+
+
+def parse_volume(value):
+    """ (table id, volume id) of a --start-vol [TABLE:]ID, TABLE is a table name or id """
+    (table, _, vol_id) = value.rpartition(':')
+    tables = {'': 1, 'PhysVols': 1, 'FullPhysVols': 2, '1': 1, '2': 2}
+    if table not in tables or not vol_id.isdigit():
+        PARSER.error('--start-vol takes [PhysVols:|FullPhysVols:]ID, not %r' % value)
+    return (tables[table], int(vol_id))
+
+
+def child_records(key, depth, tags, transform):
+    """ the records of the children of a volume placed at depth, as the full traversal makes them """
+    node = get_item_from_table(get_tablename_from_tableid(key[0]), key[1])
+    return Traversal(key[0], node, depth + 1, None, transform, tags, depth + 1, fill_cache=False)
+
+
+def find_starts(is_start, expand, max_depth):
+    """ the placements of the volumes is_start accepts, in document order.
+    Going down from the root volume, only the children of the volumes expand
+    accepts are read, so the world transforms, tags and ids of the starts are
+    those of the full export at the cost of their ancestor chains.
+    A placement is the (depth, tags, transform, item) record and the
+    geo_reindex.PathIds frame the ids below it continue from.
+    """
+    root = (ROOT.volTable, ROOT.volId)
+    starts = []
+    stack = [(geo_reindex.PathIds(), child_records(root, -1, (), Transf()))]
+    while stack:
+        (paths, records) = stack[-1]
+        record = next(records, None)
+        if record is None:
+            stack.pop()
+            continue
+        (depth, tags, transform, item) = record
+        if is_start(record):
+            starts.append((record, paths.frame(depth)))
+            paths.assign(depth, tags, item['logvol']['object']['name'])
+            continue
+        path_id = paths.assign(depth, tags, item['logvol']['object']['name'])
+        if depth < max_depth and expand(record):
+            stack.append((geo_reindex.PathIds(len(tags), depth, path_id),
+                          child_records(volume_key(item), depth, tags, transform)))
+    return starts
+
+
+def start_placements(max_depth):
+    """ placements of the --start-vol, --start-logvol and --start-tag volumes """
+    targets = set(parse_volume(value) for value in ARGS.start_vol)
+    if ARGS.start_logvol:
+        targets.update(find_volumes(ARGS.start_logvol))
+    ancestors = get_ancestors(targets) if targets else set()
+    patterns = [geo_tagindex.split_path(pattern) for pattern in ARGS.start_tag]
+
+    def is_start(record):
+        if volume_key(record[3]) in targets:
+            return True
+        return any(geo_tagindex.path_matches(p, record[1]) for p in patterns)
+
+    def expand(record):
+        if volume_key(record[3]) in ancestors:
+            return True
+        return any(geo_tagindex.path_matches(p, record[1], partial=True) for p in patterns)
+    return find_starts(is_start, expand, max_depth)
+
+
+def subtree_records(start, max_depth, prune=None):
+    """ the records of a start placement and of everything below it """
+    (record, frame) = start
+    (depth, tags, transform, item) = record
+    if prune is not None and prune(record):
+        return
+    yield record
+    if depth < max_depth:
+        (table_id, vol_id) = volume_key(item)
+        node = get_item_from_table(get_tablename_from_tableid(table_id), vol_id)
+        for rec in Traversal(table_id, node, max_depth, prune, transform, tags, depth + 1):
+            yield rec
+
+
+def get_subtree_nodes(start, max_depth, prune=None):
+    """ documents of a start placement and of everything below it """
+    REINDEX.start(start[1])
+    for (depth, tags, transform, item) in subtree_records(start, max_depth, prune):
+        generate_document(item, depth, tags, transform)
+
+
+def world_volume():
+    """ the PhysVol or FullPhysVol the RootVolume row points to """
+    return get_item_from_table(get_tablename_from_tableid(ROOT.volTable), ROOT.volId)
+
+
+def export_volumes(prune=None):
+    """ the documents of the whole geometry, or of the start placements """
+    if STARTS is None:
+        get_all_nodes(world_volume(), {}, Transf(), 0, ARGS.max_depth, prune)
+        return
+    for start in STARTS:
+        get_subtree_nodes(start, ARGS.max_depth, prune)
+
+
+def export_records(prune=None):
+    """ (frame, record) of every volume export_volumes makes a document of, in
+    document order. frame is the geo_reindex.PathIds frame of a start placement,
+    None for the others.
+    """
+    if STARTS is None:
+        world = world_volume()
+        for record in Traversal(get_tableid_from_node(world), world, ARGS.max_depth, prune):
+            yield (None, record)
+        return
+    for start in STARTS:
+        frame = start[1]
+        for record in subtree_records(start, ARGS.max_depth, prune):
+            yield (frame, record)
+            frame = None
+
+
+def pipeline_documents(batch):
+    """ transform stage of --pipeline: the documents of a batch of export_records """
+    docs = []
+    for (frame, (depth, tags, transform, item)) in batch:
+        if frame is not None:
+            REINDEX.start(frame)
+        doc = make_document(item, depth, tags, transform)
+        REINDEX.place(doc, volume_key(item))
+        if LOG_NODES:
+            logging.debug("document %s", doc)
+        if TAG_INDEX is not None:
+            TAG_INDEX.add_document(doc)
+        docs.append(doc)
+    return docs
+
+
+def write_documents(docs):
+    """ writer stage of --pipeline: one bulk request with the es sink, which
+    several writers send at once, or the documents one by one in order
+    """
+    start = time.perf_counter()
+    if hasattr(SINK, 'write_batch'):
+        SINK.write_batch(docs)
+    else:
+        for doc in docs:
+            SINK.write(doc)
+    STATS.add_time('sink', time.perf_counter() - start)
+    STATS.count('docs', len(docs))
+    STATS.tick()
+
+
+def export_pipelined(prune=None):
+    """ export_volumes in a geo_pipeline.Pipeline, returns its summary.
+    The traversal reads the DB in a worker thread while the documents of
+    the batches before are made and written. SQLite connections belong to
+    the thread that opened them, so the session lets go of its connection
+    and the reader thread opens its own, as geo_db does for every thread.
+    STATS and QUERY_STATS keep the counts of every thread apart.
+    """
+    if SESSION is not None:
+        SESSION.close()
+    writers = ARGS.es_threads if hasattr(SINK, 'write_batch') else 1
+    pipeline = geo_pipeline.Pipeline(export_records(prune), pipeline_documents, write_documents,
+                                     ARGS.pipeline_batch, ARGS.pipeline_queue, writers)
+    return pipeline.run()
+
+
+def worker_init(db_path, prune):
+    """ each worker process opens its own read-only connection, or maps the snapshot.
+    Preloaded tables and the children index are inherited from the parent.
+    """
+    global SESSION, WORKER_PRUNE
+    WORKER_PRUNE = prune
+    if SNAPSHOT is not None:
+        return  # the snapshot pages are shared with the parent
+    if DB is not None:
+        DB.reopen()
+        return
+    SESSION = ORM.open_session(db_path, read_only=True)
+
+
+def flatten_task(task):
+    """ runs in a worker process: documents of all the volumes below one volume """
+    (table_id, vol_id, world, tags, depth, max_depth) = task
+    QUERY_STATS.clear()
+    NOTEXPANDED.clear()
+    STATS.reset()
+    node = get_item_from_table(get_tablename_from_tableid(table_id), vol_id)
+    docs = [(make_document(item, rec_depth, rec_tags, transform), volume_key(item))
+            for (rec_depth, rec_tags, transform, item)
+            in Traversal(table_id, node, max_depth, WORKER_PRUNE, Transf(world), tags, depth)]
+    return (docs, QUERY_STATS.totals(), set(NOTEXPANDED), STATS.snapshot())
+
+
+def get_all_nodes_parallel(node, max_depth, prune=None, workers=2, split_depth=0):
+    """ like get_all_nodes, but the subtrees of the volumes at split_depth are
+    flattened in a pool of worker processes. Results are merged in traversal
+    order. A worker starts from the world transform of its volume and folds
+    the transforms below it as the serial traversal does (see place_records),
+    so the documents are those of a serial run, floats included.
+    """
+    split_depth = min(split_depth, max_depth)
+    segments = []  # ('doc', record) or ('task', task)
+    for record in Traversal(get_tableid_from_node(node), node, split_depth, prune):
+        segments.append(('doc', record))
+        (depth, tags, transform, item) = record
+        if depth == split_depth and depth < max_depth:
+            (table_id, vol_id) = volume_key(item)
+            segments.append(('task', (table_id, vol_id, transform.m, tags, depth + 1, max_depth)))
+    tasks = [seg[1] for seg in segments if seg[0] == 'task']
+    logging.info('flattening %d subtrees with %d workers', len(tasks), workers)
+
+    ctx = multiprocessing.get_context('fork')
+    with ctx.Pool(workers, worker_init, (DB_PATH, prune)) as pool:
+        results = pool.imap(flatten_task, tasks)
+        for (kind, seg) in segments:
+            if kind == 'doc':
+                (depth, tags, transform, item) = seg
+                generate_document(item, depth, tags, transform)
+                continue
+            (docs, stats, not_expanded, run_stats) = next(results)
+            STATS.merge(run_stats)
+            for (doc, key) in docs:
+                store_document(doc, key)
+            for k in stats:
+                QUERY_STATS[k] += stats[k]
+            NOTEXPANDED.update(not_expanded)
 
-def get_phys_vol_children(node, tags, current_transform, current_depth=0, max_depth=1):
-    '''this should actually be recursive function'''
-    logvol_item = get_item_from_table('LogVols', node.id)
-    print(logvol_item)
-    #children = get_children_of_this_vol(node.id, node.logvol)
-    #print(len(children))
 
 def get_physvol_item(item):
     ''' returns physvol content with logvol replaced with it's content '''
     item_dict = item.as_dict()
     #print("item_dict:", item_dict)
     if not 'logvol' in item_dict:
-        print("Error! Item is not a GeoPhysVol!")
+        logging.error("Item is not a GeoPhysVol!")
         # print item_dict
         return
     child_id = item_dict['logvol']
@@ -432,6 +1306,7 @@ def get_physvol_item(item):
     item_dict['logvol'] = {}  # transform 'logvol' entry in a dict
     item_dict['logvol']['object'] = get_logvol_item(logvol_item)  # get logVol item expanded
     item_dict['logvol']['type'] = "GeoLogVol"
+    item_dict['table'] = item.__tablename__
     return item_dict
 
 def get_logvol_item(item):
@@ -442,7 +1317,7 @@ def get_logvol_item(item):
 
     item_dict = item.as_dict()
     if not 'shape' in item_dict:
-        print("Error! Item is not a GeoLogVol!")
+        logging.error("Item is not a GeoLogVol!")
         # print item_dict
         return
     # print "logvol item:", item_dict
@@ -455,6 +1330,7 @@ def get_logvol_item(item):
     shape_id = item_dict['shape']
     shape = get_item_from_NodeType('GeoShape', shape_id)
     item_dict['shape'] = shape.as_dict()
+    item_dict['shape']['parsed'] = SHAPES.parse(shape_id)  # typed parameters, extent, volume
     del item_dict['shape']['id']
     del item_dict['material']['id']
     return item_dict
@@ -463,46 +1339,88 @@ def getSerialTransformerItemExpanded(item):
     '''getSerialTransformerItemExpanded'''
     itemDict = item.as_dict()
     # print itemDict:", itemDict
-    if not 'func' in itemDict:
-        print("Error! Item is not a GeoSerialTransformer!")
+    if not 'func' in itemDict and not 'funcId' in itemDict:
+        logging.error("Item is not a GeoSerialTransformer!")
         # print itemDict
         return
+    (volTable, vol, transforms) = serial_transformer_volume(item)
     # get function expanded
-    funcId = itemDict['func']
-    function = getItemFromTable('Functions', funcId)
-    itemDict['func'] = {}  # transform 'func' entry in a dict
-    itemDict['func']['object'] = function.as_dict()
-    itemDict['func']['type'] = "Function"
-    # get physVol expanded
-    volId = itemDict['vol']
-    vol = getItemFromNodeType('GeoPhysVol', volId)
-    # TODO: this PhysVol should be checked for children, as well!!!
-    itemDict['vol'] = {}  # transform 'vol' entry in a dict
-    itemDict['vol']['object'] = get_physvol_item(vol)
-    itemDict['vol']['type'] = "GeoPhysVol"
-    return (volId, itemDict)
-
-
-
-def generate_document(item, depth, tags, transform):
+    funcKey = 'funcId' if 'funcId' in itemDict else 'func'
+    function = get_item_from_table('Functions', itemDict[funcKey])
+    itemDict[funcKey] = {}  # transform 'func' entry in a dict
+    itemDict[funcKey]['object'] = function.as_dict()
+    itemDict[funcKey]['type'] = "Function"
+    itemDict[funcKey]['transforms'] = geo_transforms.to_rows(transforms).tolist()
+    # get physVol expanded, its children come from the traversal
+    volKey = 'volId' if 'volId' in itemDict else 'vol'
+    itemDict[volKey] = {}  # transform 'vol' entry in a dict
+    itemDict[volKey]['object'] = get_physvol_item(vol)
+    itemDict[volKey]['type'] = get_nodetype_from_tableid(volTable)
+    return (vol.id, itemDict)
+
+
+
+def make_document(item, depth, tags, transform):
     """ this will produce full json doc to index """
-    print('-'*20)
+    start = time.perf_counter()
     doc = {}
     doc['depth'] = depth
-    doc['tags'] = [ v for v in tags.values() ]
+    doc['tags'] = list(tags)
     doc['transform'] = transform.matrix()
     sit = item['logvol']['object']
     doc['shape'] = sit['shape']['type']
     doc['dimensions'] = sit['shape']['parameters']
+    parsed = sit['shape']['parsed']
+    doc['shape_params'] = parsed['params']
+    doc['extent'] = geo_shapes.extent_fields(parsed['extent'])
+    doc['volume'] = parsed['volume']
     doc['material'] = sit['material']['name']
     doc['name'] = sit['name']
-    print(doc)
-    doc['_index'] = 'atlas_geo'
-    doc['_type'] = 'vol'
-    print('-'*20)
-    docs_to_store.append(doc)
-    if len(docs_to_store)>999:
-        store(docs_to_store)
+    if MASS is not None:
+        doc.update(MASS.fields(*volume_key(item)))
+    STATS.add_time('documents', time.perf_counter() - start)
+    return doc
+
+
+def generate_document(item, depth, tags, transform):
+    """ makes the document of a volume and queues it for storing.
+    With --diff-from the document was already made by prune_unchanged,
+    and unchanged documents are not stored again.
+    """
+    if PLACED:
+        (doc, status) = PLACED.pop()
+        if status != geo_reindex.SAME:
+            write_document(doc)
+        return
+    if SELECTED:
+        i = SELECTED.pop()
+        if i is not None:
+            # the _id of the full export, siblings skipped here would shift the path ids
+            doc = make_document(item, depth, tags, transform)
+            doc['_id'] = geo_reindex.doc_id(int(QUERY_INDEX.ids[i]))
+            write_document(doc)
+        return
+    store_document(make_document(item, depth, tags, transform), volume_key(item))
+
+
+def store_document(doc, key=None):
+    """ sets the stable id of a document of the volume key and hands it to the sink """
+    if REINDEX is not None and key is not None:
+        REINDEX.place(doc, key)
+    write_document(doc)
+
+
+def write_document(doc):
+    """ hands a document to the sink """
+    if LOG_NODES:
+        logging.debug("document %s", doc)
+    start = time.perf_counter()
+    SINK.write(doc)
+    STATS.add_time('sink', time.perf_counter() - start)
+    if TAG_INDEX is not None:
+        TAG_INDEX.add_document(doc)
+    STATS.count('docs')
+    STATS.tick()
 
 
 
@@ -533,37 +1451,13 @@ def dumpAllObjects(jsonOut=False, jsonFile=False):
 
     return out
 
-def store(docs):
-    """ bulk indexing """
-    print('storing', len(docs), 'volumes')
-    try:
-        res = helpers.bulk(es, docs, raise_on_exception=True, request_timeout=60)
-        #print("inserted:",res[0], '\tErrors:',res[1])
-    except es_exceptions.ConnectionError as e:
-        print('ConnectionError ', e)
-    except es_exceptions.TransportError as e:
-        print('TransportError ', e)
-    except helpers.BulkIndexError as e:
-        print(e[0])
-        for i in e[1]:
-            print(i)
-    except Exception as e:
-        print('Something seriously wrong happened.', e)
-    docs.clear()
-    print('done')
-
 def get_class_by_tablename(table_fullname):
     """Return class reference mapped to table.
     :param table_fullname: String with fullname of table.
     :return: Class reference or None.
     """
 
-    classItem = None
-
-    for c in BASE._decl_class_registry.values():
-        if hasattr(c, '__table__') and c.__table__.fullname == table_fullname:
-            classItem = c
-
+    classItem = ORM.class_by_tablename(table_fullname)
     if classItem:
         return classItem
     else:
@@ -571,58 +1465,301 @@ def get_class_by_tablename(table_fullname):
         sys.exit()
 
 
-if __name__ == "__main__":
-
-    SESSION = load_session()
-
-    # get the root PhysVol volume
-    ROOT = SESSION.query(RootVolume).one()
-    print("rootVol:", ROOT.as_dict())
-
-    get_all_nodes(ROOT, {}, Transf(), 0, 20)
-    store(docs_to_store)
-
-    # get a dict with all tables
-    #print "\nout [Python dict]:", dumpAllObjects() # to screen as Python dict
-    #print "\nout [JSON]:", dumpAllObjects(jsonOut=True) # to screen as JSON
-
-    #dumpAllObjects( jsonFile = args.output+".json" ) # to file as JSON
-
-    # get the children of the root PhysVol in the compact format
-    # print getPhysVolChildren(ROOT.id) # compact format, only tableId and
-    # childId
-
-    # print the children of the PhysVol with id=2
-    # print getPhysVolChildren(2) # compact format
-    # print getPhysVolChildrenExpanded(2) # expanded format
-
-    # pprint.pprint(getPhysVolChildrenExpanded(2))
-
-    # get the children of the root PhysVol in the expanded format
-    # print
-    # only one level of children
-
-    # pprint.pprint(all_children, depth=20, width=120)
-    #for w in all_children:
-    #    print(w)
-    # print get_all_nodes_recurse(ROOT.id, depth=2) # two levels of children
-    # pprint.pprint( get_all_nodes_recurse(ROOT.id, depth=3) ) #
-    # two levels of children
+def open_input(path):
+    """ opens the geometry to read: a snapshot, a SQLite DB through geo_db or,
+    with --orm, through a geo_orm session. Returns its root volume.
+    """
+    global DB_PATH, SNAPSHOT, DB, SESSION
+    if not os.path.isfile(path):
+        raise IOError('could not find the input DB file %s' % path)
+    DB_PATH = path
+    (SNAPSHOT, DB, SESSION) = (None, None, None)
+    if geo_snapshot.is_snapshot(path):
+        SNAPSHOT = geo_snapshot.Snapshot(path)
+        return SNAPSHOT.one('RootVolume')
+    if ARGS.orm:
+        SESSION = load_session()
+        return SESSION.query(ORM.RootVolume).one()
+    with STATS.timer('open'):
+        DB = open_db(path)
+    return DB.one('RootVolume')
+
+
+def prepare_traversal():
+    """ the lookup tables, the children index and the subtree cache, as ARGS asks for """
+    global CHILDREN_INDEX, SUBTREE_CACHE
+    if SNAPSHOT is not None:
+        # GeoNodesTypes is tiny and looked up for every child
+        PRELOADED['GeoNodesTypes'] = {i: SNAPSHOT.row('GeoNodesTypes', i)
+                                      for i in SNAPSHOT.ids('GeoNodesTypes').tolist()}
+        for u in PRELOADED['GeoNodesTypes'].values():
+            NODE_TYPE_TABLES[u.nodeType] = u.tableName
+        CHILDREN_INDEX = SNAPSHOT
+        logging.info('snapshot: %s', SNAPSHOT.info())
+    elif ARGS.preload:
+        with STATS.timer('preload'):
+            preload_tables(SESSION)
+            CHILDREN_INDEX = ChildrenIndex(get_children_rows(SESSION))
+    elif DB is not None:
+        preload_tables(SESSION, ['GeoNodesTypes'])
+    if ARGS.cache_size > 0:
+        SUBTREE_CACHE = SubtreeCache(ARGS.cache_size)
+
+
+def prune_options():
+    """ the pruning predicate of --tag-prefix, --skip-material, --include, --exclude,
+    --exclude-logvol and --branch-depth, None without them
+    """
+    predicates = []
+    if ARGS.tag_prefix:
+        predicates.append(prune_tag_prefix(ARGS.tag_prefix))
+    if ARGS.skip_material:
+        predicates.append(prune_material(ARGS.skip_material))
+    if ARGS.include:
+        predicates.append(prune_include(ARGS.include))
+    if ARGS.exclude:
+        predicates.append(prune_exclude(ARGS.exclude))
+    if ARGS.exclude_logvol:
+        predicates.append(prune_logvol(ARGS.exclude_logvol))
+    if ARGS.branch_depth:
+        predicates.append(prune_branch_depth([parse_branch_depth(value) for value in ARGS.branch_depth]))
+    if not predicates:
+        return None
+    return lambda record: any(p(record) for p in predicates)
+
+
+def reset_state():
+    """ forgets the rows, caches and counters of the geometry opened before """
+    global CHILDREN_INDEX, SUBTREE_CACHE, SHAPES, REINDEX, TAG_INDEX, QUERY_INDEX, STARTS, MASS
+    for container in (PRELOADED, NODE_TYPE_TABLES, NOTEXPANDED, TRANSFORM_MATRICES, SERIAL_TRANSFORMS):
+        container.clear()
+    del PLACED[:]
+    del SELECTED[:]
+    QUERY_STATS.clear()
+    (CHILDREN_INDEX, SUBTREE_CACHE, REINDEX, TAG_INDEX, QUERY_INDEX, STARTS, MASS) = (None,) * 7
+    SHAPES = geo_shapes.ShapeParser(get_shape_row, get_transform_row)
+
+
+class Geometry():
+    """ a geometry opened by open_geometry, usable until close() """
+    def __init__(self, path, root, prune=None):
+        self.path = path
+        self.root = root
+        self.prune = prune
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+        return False
+
+    def check(self):
+        if OPENED is not self:
+            raise ValueError('the geometry %s is closed' % self.path)
+
+    def row(self, table_name, row_id):
+        """ a row of a table, its columns are attributes, as_dict() returns them all """
+        self.check()
+        return get_item_from_table(table_name, row_id)
+
+    def children(self, vol_id, table_id=1):
+        """ (id, parentId, childTable, childId, position) of the children of a volume """
+        self.check()
+        return get_children_of_this_vol(vol_id, table_id)
+
+    def records(self):
+        """ (depth, tags, transform, item) of the exported volumes, in document order """
+        self.check()
+        for (_, record) in export_records(self.prune):
+            yield record
+
+    def documents(self, batch=1000):
+        """ the documents gm2json exports, with their stable _id """
+        self.check()
+        records = export_records(self.prune)
+        while True:
+            chunk = geo_pipeline.take(records, batch)
+            if not chunk:
+                return
+            for doc in pipeline_documents(chunk):
+                yield doc
+
+    def stats(self):
+        """ counters and seconds per stage so far """
+        return STATS.summary(queries=QUERY_STATS.totals())
+
+    def close(self):
+        """ closes the DB and forgets the rows and caches, another geometry can be opened """
+        global OPENED, SNAPSHOT, DB, SESSION
+        if OPENED is not self:
+            return
+        if DB is not None:
+            DB.close()
+        if SESSION is not None:
+            SESSION.close()
+        (SNAPSHOT, DB, SESSION) = (None, None, None)
+        reset_state()
+        OPENED = None
+
+
+def open_geometry(path, **options):
+    """ opens a SQLite geometry or a snapshot for use from Python:
+        geometry = gm2json.open_geometry('geometry_atlas_20Apr17.db', preload=True, max_depth=5)
+        for doc in geometry.documents():
+            ...
+        geometry.close()
+    options are the command line options by their argparse names, eg. orm=True,
+    cache_size=0, start_tag=['Tile/Barrel'], mass=True. Nothing is read from
+    sys.argv, printed or configured in logging. The traversal state is kept in
+    the module, so one geometry is open at a time: close it (or open it in a
+    with statement) before opening the next one.
+    """
+    global ARGS, STATS, ROOT, REINDEX, STARTS, MASS, OPENED
+    if OPENED is not None:
+        raise RuntimeError('%s is still open, close() it before opening %s' % (OPENED.path, path))
+    args = PARSER.parse_args(['-i', path, '-s', 'null'])
+    for (name, value) in options.items():
+        if not hasattr(args, name):
+            raise TypeError('open_geometry() got an unknown option %r' % name)
+        setattr(args, name, value)
+    ARGS = args
+    STATS = geo_stats.RunStats()
+    reset_state()
+    ROOT = open_input(path)
+    prepare_traversal()
+    REINDEX = geo_reindex.Reindex(None, None)
+    if ARGS.mass:
+        MASS = geo_mass.MassAggregator(get_row_dict, get_children_of_this_vol, SHAPES)
+    if ARGS.start_vol or ARGS.start_logvol or ARGS.start_tag:
+        STARTS = start_placements(ARGS.max_depth)
+    OPENED = Geometry(path, ROOT, prune_options())
+    return OPENED
 
-    # get output in JSON format, on the screen
-    # print get_all_nodes_recurse(ROOT.id, depth=3, jsonOut=True)
-    # # two levels of children
 
-    # get_all_nodes_recurse(ROOT.id, depth=3) # two levels of
-    # children
+if __name__ == "__main__":
+    ARGS = PARSER.parse_args()
 
-    print("nodes not expanded:", NOTEXPANDED)
+    if ARGS.sink == 'stdout':
+        # documents go to stdout, the printout to stderr
+        sys.stdout = sys.stderr
 
-    # nPhysVol = dumpTable(SESSION, PhysVol)
-    # print ('physVol',len(nPhysVol))
+    geo_stats.setup_logging(ARGS.verbose, ARGS.log_json)
+    LOG_NODES = logging.getLogger().isEnabledFor(logging.DEBUG)
+    STATS = geo_stats.RunStats(ARGS.progress)
 
-    # nLogVol = dumpTable(SESSION, LogVol)
-    # print ('logVol',len(nLogVol))
+    ## show values ##
+    logging.info("Input file: %s", ARGS.input)
+    if not os.path.isfile(ARGS.input):
+        logging.warning("could not find the input DB file!! Exiting...")
+        sys.exit()
 
-    # nLinks = dumpTable(SESSION, ChildPos)
-    # print ('links',len(nLinks))
+    if ARGS.tag_query and not ARGS.tag_index:
+        PARSER.error('--tag-query needs --tag-index')
+    if ARGS.tag_query and (ARGS.diff_from or ARGS.manifest_out or ARGS.tag_index_out):
+        PARSER.error('--tag-query exports only a part, it does not go with --diff-from, --manifest-out '
+                     'or --tag-index-out')
+    if ARGS.tag_index_out and ARGS.diff_from:
+        PARSER.error('--tag-index-out needs a full export, not --diff-from')
+    if ARGS.pipeline and (ARGS.diff_from or ARGS.tag_query or ARGS.workers > 1):
+        PARSER.error('--pipeline does not go with --diff-from, --tag-query or --workers')
+    if ARGS.pipeline and (ARGS.manifest_out or ARGS.mass) and ARGS.orm and not ARGS.preload \
+            and not geo_snapshot.is_snapshot(ARGS.input):
+        PARSER.error('--pipeline --orm with --manifest-out or --mass needs --preload or a snapshot, '
+                     'the DB session is read by the traversal thread only')
+
+    PROFILER = geo_stats.start_profile() if ARGS.profile else None
+    SUMMARY = {'input': ARGS.input}
+    ROOT = open_input(ARGS.input)
+    prepare_traversal()
+    logging.info("rootVol: %s", ROOT.as_dict())
+
+    PRUNE = prune_options()
+
+    if ARGS.start_vol or ARGS.start_logvol or ARGS.start_tag:
+        with STATS.timer('starts'):
+            STARTS = start_placements(ARGS.max_depth)
+        for (RECORD, _) in STARTS:
+            logging.info("start: depth %d tags %s %s %s", RECORD[0], '/'.join(RECORD[1]),
+                         RECORD[3]['table'], RECORD[3]['id'])
+        if not STARTS:
+            logging.warning("no volume to start from")
+        SUMMARY['starts'] = len(STARTS)
+
+    if ARGS.sink == 'stdout':
+        SINK = geo_sinks.StdoutSink(DOC_STREAM)
+        if ARGS.normalize:
+            SINK = geo_normalize.NormalizingSink(SINK)
+    else:
+        OPEN_SINK = geo_normalize.open_normalizing_sink if ARGS.normalize else geo_sinks.open_sink
+        SINK = OPEN_SINK(ARGS.sink, ARGS.output, ARGS.compress, host=ARGS.es_host,
+                                   chunk_docs=ARGS.chunk_docs, chunk_bytes=int(ARGS.chunk_mb * 1024 * 1024),
+                                   threads=ARGS.es_threads, dead_letter=ARGS.dead_letter)
+    HASHER = None
+    if ARGS.manifest_out or ARGS.diff_from:
+        HASHER = geo_reindex.SubtreeHasher(get_row_dict, get_children_of_this_vol)
+    REINDEX = geo_reindex.Reindex(HASHER, baseline_manifest(ARGS.diff_from) if ARGS.diff_from else None)
+    if ARGS.mass:
+        MASS = geo_mass.MassAggregator(get_row_dict, get_children_of_this_vol, SHAPES)
+    if ARGS.tag_index_out:
+        TAG_INDEX = geo_tagindex.TagIndexBuilder()
+    if REINDEX.baseline is not None:
+        if REINDEX.baseline.options != export_options():
+            logging.warning("--diff-from was exported with %s, not %s! Exiting...",
+                            REINDEX.baseline.options, export_options())
+            sys.exit()
+        if ARGS.workers > 1:
+            logging.warning("--diff-from runs in a single process")
+        export_volumes(prune_unchanged(PRUNE))
+        for deleted_id in REINDEX.deleted():
+            SINK.write({'_id': deleted_id, '_op_type': 'delete'})
+        SUMMARY['changes'] = dict(REINDEX.stats, deleted=len(REINDEX.deleted()))
+    elif ARGS.tag_query:
+        QUERY_INDEX = geo_tagindex.TagIndex.load(ARGS.tag_index)
+        if QUERY_INDEX.options != export_options():
+            logging.warning("--tag-index was exported with %s, not %s! Exiting...",
+                            QUERY_INDEX.options, export_options())
+            sys.exit()
+        if ARGS.workers > 1:
+            logging.warning("--tag-query runs in a single process")
+        RANGES = QUERY_INDEX.query(ARGS.tag_query)
+        logging.info("%s: %d documents in %d ranges", ARGS.tag_query, QUERY_INDEX.count(RANGES), len(RANGES))
+        if len(RANGES):
+            export_volumes(prune_tag_query(QUERY_INDEX, RANGES, PRUNE))
+        SUMMARY['tag_query'] = {'pattern': ARGS.tag_query, 'documents': QUERY_INDEX.count(RANGES),
+                                'ranges': len(RANGES)}
+    elif ARGS.pipeline:
+        SUMMARY['pipeline'] = export_pipelined(PRUNE)
+    elif ARGS.workers > 1 and STARTS is None:
+        get_all_nodes_parallel(world_volume(), ARGS.max_depth, PRUNE, ARGS.workers, ARGS.split_depth)
+    else:
+        if ARGS.workers > 1:
+            logging.warning("--start-* exports run in a single process")
+        export_volumes(PRUNE)
+    SUMMARY['sink'] = SINK.close()
+    if 'serialize_seconds' in SUMMARY['sink']:
+        STATS.add_time('serialization', SUMMARY['sink']['serialize_seconds'])
+    if ARGS.manifest_out:
+        REINDEX.manifest(export_options()).save(ARGS.manifest_out)
+        SUMMARY['manifest'] = ARGS.manifest_out
+    if TAG_INDEX is not None:
+        TAGS = TAG_INDEX.index(export_options())
+        TAGS.save(ARGS.tag_index_out)
+        SUMMARY['tag_index'] = dict(TAGS.stats(), path=ARGS.tag_index_out)
+
+    SUMMARY['queries'] = QUERY_STATS.totals()
+    if DB is not None:
+        SUMMARY['db'] = {'path': DB.path, 'statements': DB.statements}
+    SUMMARY['not_expanded'] = sorted(NOTEXPANDED)
+    if SUBTREE_CACHE is not None:
+        SUMMARY['subtree_cache'] = SUBTREE_CACHE.stats()
+    if MASS is not None:
+        SUMMARY['mass'] = MASS.stats()
+    if PROFILER is not None:
+        logging.warning("profile written to %s\n%s", ARGS.profile, geo_stats.stop_profile(PROFILER, ARGS.profile))
+        SUMMARY['profile'] = ARGS.profile
+    SUMMARY = STATS.summary(**SUMMARY)
+    print(json.dumps(SUMMARY))
+    if ARGS.stats:
+        with open(ARGS.stats, 'w') as stats_file:
+            json.dump(SUMMARY, stats_file, indent=1)
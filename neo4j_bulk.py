@@ -0,0 +1,358 @@
+#!/usr/bin/env python
+"""
+Bulk loading of a GeoModel SQLite geometry into Neo4j.
+
+Reads the DB directly and writes the nodes and relationships in large
+batches instead of one find/match/create round trip per entity (see
+atlas2neo4j_v2.Node):
+    neo4j_bulk.py -i geometry_atlas_20Apr17.db
+runs parameterized UNWIND ... MERGE queries, one per label or relationship
+type and batch, on the atlas2neo4j_v2 database;
+    neo4j_bulk.py -i geometry_atlas_20Apr17.db --csv import_dir
+writes CSV files for an offline initial load with neo4j-admin import and
+prints the command. With --pipeline the SQLite reads and the queries
+overlap in a geo_pipeline.Pipeline, --writers node batches in flight.
+
+Every row of a GeoModel table is a node, labeled with the table name
+without the plural s (PhysVol, LogVol, Shape, NameTag, ...), with the
+row id as volId and the other columns as properties. The root volume gets
+the RootVolume label too. Relationships:
+    CHILD {position}  PhysVol/FullPhysVol to their children (ChildrenPositions)
+    LOGVOL            PhysVol/FullPhysVol to LogVol
+    SHAPE, MATERIAL   LogVol to Shape and Material
+    FUNCTION, VOLUME  SerialTransformer to Function and to its PhysVol/FullPhysVol
+"""
+
+import os
+import csv
+import time
+import sqlite3
+import logging
+import argparse
+import threading
+from collections import defaultdict
+
+import geo_pipeline
+
+# foreign key columns, they become relationships: column -> (relationship, target table)
+REFERENCES = {
+    'PhysVols': {'logvol': ('LOGVOL', 'LogVols')},
+    'FullPhysVols': {'logvol': ('LOGVOL', 'LogVols')},
+    'LogVols': {'shape': ('SHAPE', 'Shapes'), 'material': ('MATERIAL', 'Materials')},
+    'SerialTransformers': {'funcId': ('FUNCTION', 'Functions'), 'func': ('FUNCTION', 'Functions')},
+}
+# SerialTransformers point to their volume with an id and a table id
+VOLUME_COLUMNS = (('volId', 'volTable'), ('vol', 'volTable'))
+CSV_TYPES = {'INTEGER': 'long', 'REAL': 'double'}
+
+
+def label_of(table_name):
+    """ node label of a table: PhysVols -> PhysVol """
+    return table_name[:-1] if table_name.endswith('s') else table_name
+
+
+def node_params(rows):
+    """ UNWIND rows of (volId, props) node rows """
+    return ({'volId': vol_id, 'props': props} for (vol_id, props) in rows)
+
+
+def chunked(rows, size):
+    """ lists of at most size rows """
+    batch = []
+    for row in rows:
+        batch.append(row)
+        if len(batch) >= size:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
+
+class GeometryReader():
+    """ nodes and relationships of a GeoModel SQLite file, read only """
+    def __init__(self, path):
+        if not os.path.isfile(path):
+            raise IOError('could not find the input DB file %s' % path)
+        # used by one thread at a time, but by the pipeline reader thread too
+        self.db = sqlite3.connect('file:%s?mode=ro' % path, uri=True, check_same_thread=False)
+        tables = set(r[0] for r in self.db.execute("SELECT name FROM sqlite_master WHERE type='table'"))
+        self.table_names = {}  # table id -> table name
+        for (table_id, table_name) in self.db.execute('SELECT id, tableName FROM GeoNodesTypes'):
+            if table_name in tables:
+                self.table_names[table_id] = table_name
+        self.root = self.db.execute('SELECT volId, volTable FROM RootVolume').fetchone()
+
+    def columns(self, table_name):
+        """ (name, declared type) of the columns of a table """
+        return [(r[1], (r[2] or '').upper()) for r in self.db.execute('PRAGMA table_info(%s)' % table_name)]
+
+    def properties(self, table_name):
+        """ columns stored as node properties """
+        skip = set(['id']) | set(REFERENCES.get(table_name, {}))
+        if table_name == 'SerialTransformers':
+            skip |= set(c for pair in VOLUME_COLUMNS for c in pair)
+        return [(name, kind) for (name, kind) in self.columns(table_name) if name not in skip]
+
+    def nodes(self, table_name):
+        """ yields (volId, {property: value}) of every row """
+        names = [name for (name, _) in self.properties(table_name)]
+        select = ', '.join(['id'] + names)
+        for row in self.db.execute('SELECT %s FROM %s' % (select, table_name)):
+            yield (row[0], dict((k, v) for (k, v) in zip(names, row[1:]) if v is not None))
+
+    def relationships(self):
+        """ yields (type, start table, end table, rows) groups, the rows
+        are an iterator of {'start': id, 'end': id, 'props': {...}}
+        """
+        for (table_name, refs) in sorted(REFERENCES.items()):
+            if table_name not in self.table_names.values():
+                continue
+            columns = set(name for (name, _) in self.columns(table_name))
+            for (column, (rel_type, target)) in sorted(refs.items()):
+                if column in columns:
+                    query = 'SELECT id, %s FROM %s WHERE %s IS NOT NULL' % (column, table_name, column)
+                    yield (rel_type, table_name, target, self.rows(query))
+            if table_name == 'SerialTransformers':
+                for (vol, vol_table) in VOLUME_COLUMNS:
+                    if vol in columns:
+                        for (ref_table,) in self.db.execute('SELECT DISTINCT %s FROM %s' % (vol_table, table_name)):
+                            query = 'SELECT id, %s FROM %s WHERE %s = %d' % (vol, table_name, vol_table, ref_table)
+                            yield ('VOLUME', table_name, self.table_names[ref_table], self.rows(query))
+                        break
+        pairs = self.db.execute('SELECT DISTINCT parentTable, childTable FROM ChildrenPositions').fetchall()
+        for (parent_table, child_table) in sorted(pairs):
+            query = ('SELECT parentId, childId, position FROM ChildrenPositions '
+                     'WHERE parentTable = %d AND childTable = %d ORDER BY parentId, position' %
+                     (parent_table, child_table))
+            yield ('CHILD', self.table_names[parent_table], self.table_names[child_table], self.rows(query))
+
+    def rows(self, query):
+        """ relationship rows of a query selecting start, end and optionally position """
+        for row in self.db.execute(query):
+            props = {'position': row[2]} if len(row) > 2 else {}
+            yield {'start': row[0], 'end': row[1], 'props': props}
+
+
+class CypherWriter():
+    """ UNWIND ... MERGE batches through py2neo
+    graph - py2neo GraphDatabaseService, eg. atlas2neo4j_v2.graph()
+    """
+    def __init__(self, graph, batch_size=10000):
+        from py2neo import neo4j
+        self.neo4j = neo4j
+        self.graph = graph
+        self.batch_size = batch_size
+        self.stats = defaultdict(int)
+        self.lock = threading.Lock()  # the pipeline runs queries from several threads
+
+    def count(self, counter, n=1):
+        with self.lock:
+            self.stats[counter] += n
+
+    def run(self, query, rows):
+        self.neo4j.CypherQuery(self.graph, query).run(rows=rows)
+        self.count('queries')
+
+    def batches(self, query, rows, counter):
+        batch = []
+        for row in rows:
+            batch.append(row)
+            if len(batch) >= self.batch_size:
+                self.run(query, batch)
+                self.count(counter, len(batch))
+                batch = []
+        if batch:
+            self.run(query, batch)
+            self.count(counter, len(batch))
+
+    def run_batches(self, batches):
+        """ writer stage of load_pipelined: runs (query, counter, rows) batches """
+        for (query, counter, rows) in batches:
+            self.run(query, rows)
+            self.count(counter, len(rows))
+
+    def start(self, labels):
+        """ MERGE needs the (label, volId) indexes to be fast """
+        for label in labels:
+            self.neo4j.CypherQuery(self.graph, 'CREATE INDEX ON :%s(volId)' % label).run()
+
+    def node_query(self, label):
+        return 'UNWIND {rows} AS row MERGE (n:%s {volId: row.volId}) SET n += row.props' % label
+
+    def nodes(self, label, table_name, rows, reader):
+        self.batches(self.node_query(label), node_params(rows), 'nodes')
+
+    def root(self, label, vol_id):
+        self.neo4j.CypherQuery(self.graph, 'MATCH (n:%s {volId: {volId}}) SET n:RootVolume' % label).run(
+            volId=vol_id)
+
+    def relationship_query(self, rel_type, start_label, end_label):
+        key = ' {position: row.props.position}' if rel_type == 'CHILD' else ''
+        return ('UNWIND {rows} AS row '
+                'MATCH (a:%s {volId: row.start}) MATCH (b:%s {volId: row.end}) '
+                'MERGE (a)-[r:%s%s]->(b)' % (start_label, end_label, rel_type, key))
+
+    def relationships(self, rel_type, start_label, end_label, rows):
+        self.batches(self.relationship_query(rel_type, start_label, end_label), rows, 'relationships')
+
+    def close(self):
+        return dict(self.stats)
+
+
+class CsvWriter():
+    """ node and relationship files for neo4j-admin import """
+    def __init__(self, directory):
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+        self.directory = directory
+        self.node_files = []
+        self.rel_files = []
+        self.stats = defaultdict(int)
+
+    def open(self, name):
+        path = os.path.join(self.directory, name)
+        return (path, open(path, 'w', newline=''))
+
+    def start(self, labels):
+        pass
+
+    def nodes(self, label, table_name, rows, reader):
+        properties = reader.properties(table_name)
+        header = ['volId:ID(%s)' % label]
+        header += ['%s:%s' % (name, CSV_TYPES[kind]) if kind in CSV_TYPES else name for (name, kind) in properties]
+        header.append(':LABEL')
+        root = reader.root[0] if reader.root and reader.table_names.get(reader.root[1]) == table_name else None
+        (path, f) = self.open('nodes_%s.csv' % label)
+        with f:
+            out = csv.writer(f)
+            out.writerow(header)
+            for (vol_id, props) in rows:
+                labels = label + ';RootVolume' if vol_id == root else label
+                out.writerow([vol_id] + [props.get(name, '') for (name, _) in properties] + [labels])
+                self.stats['nodes'] += 1
+        self.node_files.append(path)
+
+    def root(self, label, vol_id):
+        pass  # written with the node
+
+    def relationships(self, rel_type, start_label, end_label, rows):
+        header = [':START_ID(%s)' % start_label, ':END_ID(%s)' % end_label, ':TYPE']
+        if rel_type == 'CHILD':
+            header.append('position:int')
+        (path, f) = self.open('rels_%s_%s_%s.csv' % (rel_type, start_label, end_label))
+        with f:
+            out = csv.writer(f)
+            out.writerow(header)
+            for row in rows:
+                line = [row['start'], row['end'], rel_type]
+                if rel_type == 'CHILD':
+                    line.append(row['props']['position'])
+                out.writerow(line)
+                self.stats['relationships'] += 1
+        self.rel_files.append(path)
+
+    def command(self):
+        """ the neo4j-admin command loading the files into an empty database """
+        args = ['neo4j-admin', 'import', '--id-type=INTEGER']
+        args += ['--nodes=%s' % path for path in self.node_files]
+        args += ['--relationships=%s' % path for path in self.rel_files]
+        return ' '.join(args)
+
+    def close(self):
+        return dict(self.stats)
+
+
+def load(reader, writer):
+    """ all nodes first, then the relationships by type and labels """
+    start = time.time()
+    tables = sorted(set(reader.table_names.values()))
+    writer.start([label_of(t) for t in tables])
+    for table_name in tables:
+        logging.info('nodes of %s', table_name)
+        writer.nodes(label_of(table_name), table_name, reader.nodes(table_name), reader)
+    if reader.root:
+        writer.root(label_of(reader.table_names[reader.root[1]]), reader.root[0])
+
+    for (rel_type, start_table, end_table, rows) in reader.relationships():
+        (start_label, end_label) = (label_of(start_table), label_of(end_table))
+        logging.info('%s relationships %s -> %s', rel_type, start_label, end_label)
+        writer.relationships(rel_type, start_label, end_label, rows)
+    stats = writer.close()
+    stats['seconds'] = round(time.time() - start, 3)
+    return stats
+
+
+def node_batches(reader, writer, tables):
+    """ (query, counter, rows) of the nodes, the rows as read """
+    for table_name in tables:
+        logging.info('nodes of %s', table_name)
+        query = writer.node_query(label_of(table_name))
+        for rows in chunked(reader.nodes(table_name), writer.batch_size):
+            yield (query, 'nodes', rows)
+
+
+def relationship_batches(reader, writer):
+    """ (query, counter, rows) of the relationships """
+    for (rel_type, start_table, end_table, rows) in reader.relationships():
+        (start_label, end_label) = (label_of(start_table), label_of(end_table))
+        logging.info('%s relationships %s -> %s', rel_type, start_label, end_label)
+        query = writer.relationship_query(rel_type, start_label, end_label)
+        for batch in chunked(rows, writer.batch_size):
+            yield (query, 'relationships', batch)
+
+
+def query_params(batches):
+    """ transform stage of load_pipelined: node rows into UNWIND rows """
+    return [(query, counter, list(node_params(rows)) if counter == 'nodes' else rows)
+            for (query, counter, rows) in batches]
+
+
+def load_pipelined(reader, writer, writers=4, rel_writers=1, queue_size=4):
+    """ load() with a CypherWriter in two geo_pipeline.Pipelines: one batch is
+    read from SQLite while the ones before are converted and writers of them
+    are written. The relationships MATCH their nodes, so they start when all
+    nodes are written; their MERGEs lock the nodes at both ends, shared LogVols
+    and Shapes among them, and more than one rel_writer can run into deadlocks.
+    """
+    start = time.time()
+    tables = sorted(set(reader.table_names.values()))
+    writer.start([label_of(t) for t in tables])
+    pipelines = {}
+    pipelines['nodes'] = geo_pipeline.Pipeline(node_batches(reader, writer, tables), query_params,
+                                               writer.run_batches, 1, queue_size, writers).run()
+    if reader.root:
+        writer.root(label_of(reader.table_names[reader.root[1]]), reader.root[0])
+    pipelines['relationships'] = geo_pipeline.Pipeline(relationship_batches(reader, writer), query_params,
+                                                       writer.run_batches, 1, queue_size, rel_writers).run()
+    stats = writer.close()
+    stats['pipelines'] = pipelines
+    stats['seconds'] = round(time.time() - start, 3)
+    return stats
+
+
+if __name__ == '__main__':
+    PARSER = argparse.ArgumentParser(description='Loads a GeoModel SQLite geometry into Neo4j in bulk.')
+    PARSER.add_argument('-i', '--input', help='Input file name', required=True)
+    PARSER.add_argument('--csv', metavar='DIR', help='write neo4j-admin import files to DIR instead of loading')
+    PARSER.add_argument('--batch-size', type=int, default=10000, help='rows in one UNWIND query')
+    PARSER.add_argument('--pipeline', action='store_true',
+                        help='overlap the SQLite reads with the queries, see load_pipelined')
+    PARSER.add_argument('--writers', type=int, default=4, help='node queries in flight with --pipeline')
+    PARSER.add_argument('--rel-writers', type=int, default=1,
+                        help='relationship queries in flight with --pipeline, more can deadlock')
+    PARSER.add_argument('-v', '--verbose', action='store_true', help='log the progress')
+    ARGS = PARSER.parse_args()
+    logging.basicConfig(level=logging.INFO if ARGS.verbose else logging.WARNING)
+
+    READER = GeometryReader(ARGS.input)
+    if ARGS.csv:
+        WRITER = CsvWriter(ARGS.csv)
+    else:
+        from atlas2neo4j_v2 import graph
+        WRITER = CypherWriter(graph(), ARGS.batch_size)
+    if ARGS.pipeline and not ARGS.csv:
+        print('loaded:', load_pipelined(READER, WRITER, ARGS.writers, ARGS.rel_writers))
+    else:
+        print('loaded:', load(READER, WRITER))
+    if ARGS.csv:
+        print(WRITER.command())
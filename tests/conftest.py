@@ -0,0 +1,42 @@
+"""
+Fixtures: a small synthetic geometry from geo_synth, with shared volumes,
+serial transformers, NameTags and AlignableTransforms, and gm2json.py runs on it.
+"""
+
+import os
+import sys
+import subprocess
+
+import pytest
+
+import geo_synth
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+@pytest.fixture(scope='session')
+def synth_db(tmp_path_factory):
+    path = str(tmp_path_factory.mktemp('geometry') / 'synth.db')
+    geo_synth.GeometryGenerator(depth=4, fanout=5, serial=0.2, seed=3).write(path)
+    return path
+
+
+@pytest.fixture(scope='session')
+def synth_snapshot(synth_db):
+    path = synth_db[:-len('.db')] + '.snap'
+    subprocess.check_call([sys.executable, os.path.join(ROOT, 'geo_snapshot.py'), synth_db, '-o', path],
+                          stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    return path
+
+
+@pytest.fixture
+def export(tmp_path):
+    """ export(input, *options): the NDJSON lines of a gm2json.py run """
+    def run(path, *options):
+        output = str(tmp_path / 'out.ndjson')
+        subprocess.check_call([sys.executable, os.path.join(ROOT, 'gm2json.py'), '-i', path, '-s', 'ndjson',
+                               '-o', output] + list(options), cwd=str(tmp_path),
+                              stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+        with open(output) as lines:
+            return lines.read().splitlines()
+    return run
@@ -0,0 +1,166 @@
+"""
+es_bulk.BulkIndexer against a stub Elasticsearch: an http.server answering
+GET / like a 7.x node and _bulk requests from a script of failures.
+"""
+
+import json
+import time
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import pytest
+
+pytest.importorskip('elasticsearch')
+from elasticsearch import Elasticsearch
+
+from es_bulk import BulkIndexer
+
+
+class StubHandler(BaseHTTPRequestHandler):
+    """ GET / is the product check of the client. The answer to the n-th _bulk
+    request is server.script[n]: 'drop' closes the connection without an
+    answer, a number is the HTTP status of the whole request, None (or past
+    the end of the script) answers every document. Documents with a 'reject'
+    field are answered 400, with a 'busy' field 429 the first time they come.
+    """
+    protocol_version = 'HTTP/1.1'
+
+    def log_message(self, *args):
+        pass
+
+    def reply(self, status, body):
+        data = json.dumps(body).encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(data)))
+        self.send_header('X-Elastic-Product', 'Elasticsearch')
+        self.end_headers()
+        self.wfile.write(data)
+
+    def do_GET(self):
+        self.reply(200, {'version': {'number': '7.17.0', 'build_flavor': 'default'},
+                         'tagline': 'You Know, for Search'})
+
+    def do_POST(self):
+        server = self.server
+        body = self.rfile.read(int(self.headers['Content-Length'])).decode('utf-8')
+        lines = [json.loads(line) for line in body.splitlines() if line]
+        with server.lock:
+            n = len(server.requests)
+            server.requests.append((time.time(), len(lines) // 2))
+            answer = server.script[n] if n < len(server.script) else None
+        if answer == 'drop':
+            self.close_connection = True
+            return
+        if answer is not None:
+            self.reply(answer, {'error': 'scripted', 'status': answer})
+            return
+        items = []
+        for (action, source) in zip(lines[::2], lines[1::2]):
+            doc_id = action['index'].get('_id')
+            if 'reject' in source:
+                result = {'status': 400, 'error': {'type': 'mapper_parsing_exception'}}
+            elif 'busy' in source and doc_id not in server.busy:
+                server.busy.add(doc_id)
+                result = {'status': 429, 'error': {'type': 'es_rejected_execution_exception'}}
+            else:
+                server.indexed.append(source['n'])
+                result = {'status': 201}
+            items.append({'index': dict(result, _id=doc_id)})
+        self.reply(200, {'took': 1, 'errors': False, 'items': items})
+
+
+@pytest.fixture
+def stub():
+    server = ThreadingHTTPServer(('127.0.0.1', 0), StubHandler)
+    server.script = []
+    server.requests = []
+    server.indexed = []
+    server.busy = set()
+    server.lock = threading.Lock()
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    yield server
+    server.shutdown()
+    server.server_close()
+
+
+def indexer(stub, tmp_path, **options):
+    # the client retries nothing itself, BulkIndexer does
+    es = Elasticsearch(['127.0.0.1:%d' % stub.server_address[1]], max_retries=0, timeout=5)
+    options.setdefault('backoff', 0.05)
+    return BulkIndexer(es, dead_letter=str(tmp_path / 'dead.ndjson'), **options)
+
+
+def test_429_retried_with_backoff(stub, tmp_path):
+    stub.script = [429, 429]
+    bulk = indexer(stub, tmp_path, threads=1, chunk_docs=10)
+    for n in range(10):
+        bulk.add({'_id': str(n), 'n': n})
+    stats = bulk.close()
+    assert sorted(stub.indexed) == list(range(10))
+    assert (stats['indexed'], stats['failed'], stats['retries']) == (10, 0, 2)
+    times = [t for (t, _) in stub.requests]
+    assert len(times) == 3
+    assert times[1] - times[0] >= 0.05 and times[2] - times[1] >= 0.1  # backoff doubles
+    assert not (tmp_path / 'dead.ndjson').exists()
+
+
+def test_document_429_retried_alone(stub, tmp_path):
+    bulk = indexer(stub, tmp_path, threads=1, chunk_docs=10)
+    for n in range(10):
+        bulk.add(dict({'_id': str(n), 'n': n}, **({'busy': 1} if n % 3 == 0 else {})))
+    stats = bulk.close()
+    assert sorted(stub.indexed) == list(range(10))
+    assert [docs for (_, docs) in stub.requests] == [10, 4]
+    assert (stats['indexed'], stats['failed'], stats['retries']) == (10, 0, 1)
+
+
+def test_connection_error_retried(stub, tmp_path):
+    stub.script = ['drop']
+    bulk = indexer(stub, tmp_path, threads=1, chunk_docs=5)
+    for n in range(5):
+        bulk.add({'_id': str(n), 'n': n})
+    stats = bulk.close()
+    assert sorted(stub.indexed) == list(range(5))
+    assert len(stub.requests) == 2
+    assert (stats['indexed'], stats['failed'], stats['retries']) == (5, 0, 1)
+
+
+def test_retries_exhausted_to_dead_letter(stub, tmp_path):
+    stub.script = [429] * 3
+    bulk = indexer(stub, tmp_path, threads=1, chunk_docs=10, max_retries=2, backoff=0.01)
+    for n in range(3):
+        bulk.add({'_id': str(n), 'n': n})
+    stats = bulk.close()
+    assert (stats['indexed'], stats['failed'], stats['retries']) == (0, 3, 2)
+    dead = [json.loads(line) for line in open(str(tmp_path / 'dead.ndjson'))]
+    assert [d['doc']['n'] for d in dead] == [0, 1, 2]
+    assert all(d['error'] == 'too many requests' for d in dead)
+
+
+def test_rejected_to_dead_letter(stub, tmp_path):
+    bulk = indexer(stub, tmp_path, threads=1, chunk_docs=4)
+    for n in range(12):
+        bulk.add(dict({'_id': str(n), 'n': n}, **({'reject': 1} if n in (2, 7) else {})))
+    stats = bulk.close()
+    assert sorted(stub.indexed) == [n for n in range(12) if n not in (2, 7)]
+    assert (stats['indexed'], stats['failed'], stats['retries']) == (10, 2, 0)
+    dead = [json.loads(line) for line in open(str(tmp_path / 'dead.ndjson'))]
+    assert sorted(d['doc']['n'] for d in dead) == [2, 7]
+    assert all(d['error']['type'] == 'mapper_parsing_exception' for d in dead)
+
+
+def test_stats(stub, tmp_path):
+    stub.script = [None, 429, 'drop']
+    bulk = indexer(stub, tmp_path, threads=3, chunk_docs=7, backoff=0.01)
+    docs = [dict({'_id': str(n), 'n': n}, **({'reject': 1} if n % 10 == 9 else {})) for n in range(100)]
+    for doc in docs:
+        bulk.add(doc)
+    stats = bulk.close()
+    assert sorted(stub.indexed) == [n for n in range(100) if n % 10 != 9]
+    assert (stats['docs'], stats['indexed'], stats['failed'], stats['retries']) == (100, 90, 10, 2)
+    assert stats['chunks'] == 15  # answered requests, 100 documents by 7
+    assert stats['bytes'] > 0 and stats['seconds'] > 0
+    assert stats['docs_per_s'] == pytest.approx(90 / stats['seconds'], rel=0.05)
+    assert stats['mb_per_s'] > 0
@@ -0,0 +1,69 @@
+"""
+geo_mass.MassAggregator on a hand-made volume tree.
+"""
+
+import pytest
+
+from geo_mass import MassAggregator
+
+NODE_TYPES = {1: ('GeoPhysVol', 'PhysVols'), 7: ('GeoSerialTransformer', 'SerialTransformers'),
+              9: ('GeoTransform', 'Transforms')}
+
+
+class Shapes():
+    """ shape id -> volume, as geo_shapes.ShapeParser.parse gives it """
+    def __init__(self, volumes):
+        self.volumes = volumes
+
+    def parse(self, shape_id):
+        return {'volume': self.volumes[shape_id]}
+
+
+def aggregator(volumes, children, serial=None):
+    """ PhysVol n has LogVol n, Shape n and Material 1 (density 2 g/cm3)
+    children - PhysVol id -> [(table id, child id)]
+    serial - SerialTransformer id -> (PhysVol id, copies)
+    """
+    def get_row(table_name, row_id):
+        if table_name == 'GeoNodesTypes':
+            (node_type, name) = NODE_TYPES[row_id]
+            return {'id': row_id, 'nodeType': node_type, 'tableName': name}
+        if table_name == 'PhysVols':
+            return {'id': row_id, 'logvol': row_id}
+        if table_name == 'LogVols':
+            return {'id': row_id, 'shape': row_id, 'material': 1}
+        if table_name == 'Materials':
+            return {'id': row_id, 'density': 2.0}
+        (vol_id, copies) = serial[row_id]
+        return {'id': row_id, 'volId': vol_id, 'volTable': 1, 'copies': copies}
+
+    def get_children(vol_id, table_id):
+        return [(0, vol_id, table, child, k) for (k, (table, child)) in enumerate(children.get(vol_id, []))]
+    return MassAggregator(get_row, get_children, Shapes(volumes))
+
+
+def test_mass_rolled_up():
+    # 1 holds a transform, 2 and 4 copies of 3 by a serial transformer
+    masses = aggregator({1: 1e6, 2: 1e5, 3: 1e3}, {1: [(9, 1), (1, 2), (7, 1)]}, {1: (3, 4)})
+    top = masses.fields(1, 1)
+    assert top['net_volume'] == pytest.approx(1e6 - 1e5 - 4e3)
+    assert top['own_mass'] == pytest.approx((1e6 - 1e5 - 4e3) * 2e-6)
+    assert top['mass'] == pytest.approx(1e6 * 2e-6)  # the daughters fill the rest with the same density
+    assert top['mass_unknown'] == 0
+    assert masses.fields(1, 3)['mass'] == pytest.approx(2e-3)
+
+
+def test_daughter_of_unknown_volume():
+    masses = aggregator({1: 1e6, 2: None, 3: 1e3}, {1: [(1, 2), (1, 3)], 2: [(1, 3)]})
+    top = masses.fields(1, 1)
+    # 2 has no volume: its own mass and that of its mother are unknown
+    assert (top['net_volume'], top['own_mass']) == (None, None)
+    assert top['mass_unknown'] == 2
+    assert top['mass'] == pytest.approx(2 * 2e-3)  # only the two placements of 3 are known
+    assert masses.fields(1, 2)['mass_unknown'] == 1
+
+
+def test_overfull_mother():
+    masses = aggregator({1: 1e3, 2: 2e3}, {1: [(1, 2)]})
+    assert masses.fields(1, 1)['net_volume'] == 0.0
+    assert masses.stats()['overfull'] == 1
@@ -0,0 +1,56 @@
+"""
+geo_normalize round trips: normalized exports read back with their values
+inline are the documents of the plain export.
+"""
+
+import os
+import sys
+import json
+import subprocess
+
+import geo_sinks
+from geo_normalize import REF_KINDS, Denormalizer, Normalizer, read_denormalized, ref_path
+
+from conftest import ROOT
+
+
+def parsed(lines):
+    return [json.loads(line) for line in lines]
+
+
+def test_export_round_trip(synth_db, export, tmp_path):
+    plain = parsed(export(synth_db))
+    normalized = parsed(export(synth_db, '--normalize'))
+    assert len(normalized) == len(plain)
+    assert all(k + '_ref' in doc and k not in doc for doc in normalized for k in REF_KINDS)
+    # the reference files are next to out.ndjson
+    assert list(read_denormalized(str(tmp_path / 'out.ndjson'))) == plain
+
+
+def test_command_round_trip(synth_db, export, tmp_path):
+    plain = export(synth_db)
+    (source, norm, back) = (str(tmp_path / 'plain.ndjson'), str(tmp_path / 'norm.ndjson.gz'),
+                            str(tmp_path / 'back.ndjson'))
+    with open(source, 'w') as f:
+        f.write('\n'.join(plain) + '\n')
+    script = os.path.join(ROOT, 'geo_normalize.py')
+    subprocess.check_call([sys.executable, script, source, '-o', norm], stdout=subprocess.DEVNULL)
+    assert all(os.path.exists(ref_path(norm, kind)) for kind in REF_KINDS)
+    subprocess.check_call([sys.executable, script, norm, '--denormalize', '-o', back], stdout=subprocess.DEVNULL)
+    assert list(geo_sinks.read_documents(back)) == parsed(plain)
+
+
+def test_one_stream_and_stable_refs(synth_db, export):
+    docs = parsed(export(synth_db))
+    (forward, backward) = (Normalizer(), Normalizer())
+    stream = []
+    for doc in docs:
+        (compact, ref_docs) = forward.normalize(doc)
+        stream += ref_docs + [compact]
+    for doc in reversed(docs):
+        backward.normalize(doc)
+    # a reference comes before its first use and its id depends on the content only
+    assert list(Denormalizer().documents(stream)) == docs
+    assert forward.tables['shape'].contents == backward.tables['shape'].contents
+    assert forward.tables['material'].contents == backward.tables['material'].contents
+    assert 0 < len(forward.tables['material']) < len(forward.tables['shape']) < len(docs)
@@ -0,0 +1,147 @@
+"""
+geo_overlaps.OverlapChecker on hand-built volumes: overlapping, touching and
+apart pairs of Boxes and Tubes, and mothers sharing their daughters.
+"""
+
+import numpy as np
+import pytest
+
+import geo_overlaps
+from geo_overlaps import OverlapChecker, box_penetration
+from geo_spatial import SpatialIndex
+
+IDENTITY = np.eye(3)
+
+
+def rot_z(degrees):
+    a = np.radians(degrees)
+    return np.array([[np.cos(a), -np.sin(a), 0.0], [np.sin(a), np.cos(a), 0.0], [0.0, 0.0, 1.0]])
+
+
+def box(name, depth, half, at=(0.0, 0.0, 0.0), rot=IDENTITY):
+    (hx, hy, hz) = half
+    return {'name': name, 'depth': depth, 'shape': 'Box',
+            'transform': list(np.ravel(rot)) + list(at),
+            'extent': {'xmin': -hx, 'ymin': -hy, 'zmin': -hz, 'xmax': hx, 'ymax': hy, 'zmax': hz}}
+
+
+def tube(name, depth, rmax, dz, at=(0.0, 0.0, 0.0)):
+    doc = box(name, depth, (rmax, rmax, dz), at)
+    doc.update(shape='Tube', shape_params={'RMin': 0.0, 'RMax': rmax, 'ZHalfLength': dz})
+    return doc
+
+
+def world(*daughters):
+    return [box('World', 0, (1000.0, 1000.0, 1000.0))] + list(daughters)
+
+
+def overlaps(docs, **options):
+    checker = OverlapChecker(SpatialIndex(docs), **options)
+    return (checker, checker.check())
+
+
+def pairs(found):
+    return sorted(tuple(sorted((o['a']['name'], o['b']['name']))) for o in found)
+
+
+def test_overlapping_boxes():
+    (checker, found) = overlaps(world(box('A', 1, (10.0, 10.0, 10.0)), box('B', 1, (10.0, 5.0, 5.0), (15.0, 2.0, 0.0))))
+    assert pairs(found) == [('A', 'B')]
+    assert found[0]['depth'] == pytest.approx(5.0, abs=1e-6)
+    assert (found[0]['method'], found[0]['approximate'], found[0]['placements']) == ('exact', False, 1)
+    assert found[0]['mother']['name'] == 'World'
+    assert checker.stats['overlaps'] == 1 and checker.stats['sampled'] == 0
+
+
+@pytest.mark.parametrize('gap', [0.0, -0.5e-3, 1.0])
+def test_touching_or_apart_boxes(gap):
+    # B's face is gap away from A's, a negative gap within the tolerance is still touching
+    (checker, found) = overlaps(world(box('A', 1, (10.0, 10.0, 10.0)),
+                                      box('B', 1, (5.0, 5.0, 5.0), (15.0 + gap, 0.0, 0.0))))
+    assert found == []
+    assert checker.stats['candidates'] == (1 if gap <= 0 else 0)
+
+
+def test_rotated_boxes():
+    # a square turned by 45 degrees reaches sqrt(2) from its center along x
+    reach = 1.0 + np.sqrt(2.0)
+    a = box('A', 1, (1.0, 1.0, 1.0))
+    (_, found) = overlaps(world(a, box('B', 1, (1.0, 1.0, 1.0), (reach - 0.1, 0.0, 0.0), rot_z(45))))
+    assert pairs(found) == [('A', 'B')]
+    assert found[0]['depth'] == pytest.approx(0.1, abs=1e-9)
+    # along the diagonal the world boxes overlap, the separating axis test tells them apart
+    d = (reach + 0.1) / np.sqrt(2.0)
+    (checker, found) = overlaps(world(a, box('B', 1, (1.0, 1.0, 1.0), (d, d, 0.0), rot_z(45))))
+    assert found == [] and checker.stats['candidates'] == 1
+
+
+def test_box_penetration_symmetric():
+    rng = np.random.default_rng(5)
+    n = 200
+    (ca, cb) = (rng.normal(size=(n, 3)), rng.normal(size=(n, 3)))
+    (ha, hb) = (rng.random((n, 3)) + 0.1, rng.random((n, 3)) + 0.1)
+    (ra, rb) = (np.linalg.qr(rng.normal(size=(n, 3, 3)))[0], np.linalg.qr(rng.normal(size=(n, 3, 3)))[0])
+    assert np.allclose(box_penetration(ca, ha, ra, cb, hb, rb), box_penetration(cb, hb, rb, ca, ha, ra))
+    # the same boxes shifted together do not change
+    shift = rng.normal(size=(n, 3))
+    assert np.allclose(box_penetration(ca, ha, ra, cb, hb, rb), box_penetration(ca + shift, ha, ra, cb + shift, hb, rb))
+
+
+def test_candidates_match_brute_force():
+    rng = np.random.default_rng(11)
+    centers = rng.random((60, 3)) * 100.0
+    halves = rng.random((60, 3)) * 8.0 + 0.5
+    docs = world(*[box('D%d' % k, 1, halves[k], centers[k]) for k in range(60)])
+    checker = OverlapChecker(SpatialIndex(docs))
+    (a, b) = checker.candidates(0)
+    found = sorted(tuple(sorted(p)) for p in zip(a.tolist(), b.tolist()))
+    index = checker.index
+    brute = [(i, j) for i in range(1, 61) for j in range(i + 1, 61)
+             if np.all(index.lo[i] < index.hi[j]) and np.all(index.lo[j] < index.hi[i])]
+    assert found == brute and len(brute) > 0
+    # axis aligned boxes overlap by their smallest overlap along x, y and z
+    depth = [(halves[i - 1] + halves[j - 1] - np.abs(centers[i - 1] - centers[j - 1])).min() for (i, j) in brute]
+    overlapping = [tuple(sorted(('D%d' % (i - 1), 'D%d' % (j - 1))))
+                   for ((i, j), d) in zip(brute, depth) if d > checker.tolerance]
+    assert pairs(checker.check()) == sorted(overlapping)
+
+
+def test_tubes_sampled():
+    # two tubes of radius 10, 15 apart: the lens between them is 5 wide
+    (checker, found) = overlaps(world(tube('A', 1, 10.0, 50.0), tube('B', 1, 10.0, 50.0, (15.0, 0.0, 0.0))))
+    assert pairs(found) == [('A', 'B')]
+    assert (found[0]['method'], found[0]['approximate']) == ('sampled', False)
+    assert found[0]['depth'] == pytest.approx(2.5, abs=0.1)
+    assert checker.stats['sampled'] == 1
+    # the corners of their boxes overlap, the tubes do not
+    (checker, found) = overlaps(world(tube('A', 1, 10.0, 50.0), tube('B', 1, 10.0, 50.0, (15.0, 15.0, 0.0))))
+    assert found == [] and checker.stats['sampled'] == 1
+
+
+def test_shared_mothers_checked_once():
+    def mother(at, rot, order, c=(-50.0, 0.0, 0.0)):
+        daughters = [box('A', 2, (10.0, 10.0, 10.0), at, rot),
+                     box('B', 2, (10.0, 10.0, 10.0), rot @ np.array([15.0, 0.0, 0.0]) + at, rot),
+                     box('C', 2, (5.0, 5.0, 5.0), rot @ np.array(c) + at, rot)]
+        return [box('M', 1, (100.0, 100.0, 100.0), at, rot)] + [daughters[k] for k in order]
+    # the first two are the same daughters in another order, the third has C elsewhere
+    docs = world(*(mother(np.array([0.0, 0.0, 0.0]), IDENTITY, [0, 1, 2]) +
+                   mother(np.array([300.0, 0.0, 0.0]), rot_z(30), [2, 0, 1]) +
+                   mother(np.array([-300.0, 0.0, 0.0]), rot_z(90), [1, 2, 0], c=(-50.0, 1.0, 0.0))))
+    (checker, found) = overlaps(docs)
+    assert (checker.stats['mothers'], checker.stats['checked']) == (4, 3)  # the world and the three M
+    assert sorted((pairs([o])[0], o['mother']['doc'], o['placements']) for o in found) == \
+        [(('A', 'B'), 1, 2), (('A', 'B'), 9, 1)]
+    assert all(o['depth'] == pytest.approx(5.0, abs=1e-6) for o in found)
+
+
+def test_workers_same_overlaps(monkeypatch):
+    rng = np.random.default_rng(2)
+    docs = world(*[d for k in range(8) for d in
+                   [box('M%d' % k, 1, (50.0, 50.0, 50.0), (k * 200.0 - 800.0, 0.0, 0.0))] +
+                   [tube('T%d_%d' % (k, t), 2, 8.0, 8.0, rng.random(3) * 30.0 - 15.0 + [k * 200.0 - 800.0, 0.0, 0.0])
+                    for t in range(6)]])
+    monkeypatch.setattr(geo_overlaps, 'CHUNK_MOTHERS', 2)
+    serial = OverlapChecker(SpatialIndex(docs)).check(workers=1)
+    parallel = OverlapChecker(SpatialIndex(docs)).check(workers=3)
+    assert serial and serial == parallel
@@ -0,0 +1,229 @@
+"""
+Stable ids, subtree hashes and --diff-from of geo_reindex, on hand-made
+manifests and on changed copies of the synthetic geometry.
+"""
+
+import json
+import shutil
+import sqlite3
+
+import numpy as np
+import pytest
+
+from geo_reindex import (PathIds, SubtreeHasher, Manifest, Reindex, doc_id, NEW, CHANGED, SAME, SKIPPED)
+
+
+def test_path_ids():
+    paths = PathIds()
+    # two volumes with the same name and a tagged one below the first
+    a0 = paths.assign(0, (), 'A')
+    t = paths.assign(1, ('T',), 'B')
+    a1 = paths.assign(0, (), 'A')
+    b = paths.assign(1, (), 'B')
+    assert len({a0, t, a1, b}) == 4
+    # the same path gives the same id in another traversal, whatever came before
+    again = PathIds()
+    again.assign(0, (), 'A')
+    assert again.assign(1, ('T',), 'Other name') == t
+    # a traversal continued from a frame gives the ids of the full one
+    frame = PathIds()
+    frame.assign(0, (), 'A')
+    frame.assign(1, ('T',), 'B')
+    continued = PathIds(*frame.frame(0))
+    assert continued.assign(0, (), 'A') == a1
+    assert continued.assign(1, (), 'B') == b
+
+
+class Tables():
+    """ rows by table name and id, children by volume id, for SubtreeHasher """
+    def __init__(self):
+        self.rows = {'GeoNodesTypes': {1: {'nodeType': 'GeoPhysVol', 'tableName': 'PhysVols'},
+                                       9: {'nodeType': 'GeoTransform', 'tableName': 'Transforms'}},
+                     'Materials': {1: {'id': 1, 'name': 'Iron', 'density': 7.87}},
+                     'Transforms': {1: dict(zip(('xx', 'xy', 'xz', 'yx', 'yy', 'yz', 'zx', 'zy', 'zz',
+                                                 'dx', 'dy', 'dz'), [1, 0, 0, 0, 1, 0, 0, 0, 1, 5, 0, 0]))},
+                     'PhysVols': {}, 'LogVols': {}, 'Shapes': {}}
+        self.children = {}
+
+    def volume(self, vol_id, name, size, children=()):
+        self.rows['PhysVols'][vol_id] = {'id': vol_id, 'logvol': vol_id}
+        self.rows['LogVols'][vol_id] = {'id': vol_id, 'name': name, 'shape': vol_id, 'material': 1}
+        self.rows['Shapes'][vol_id] = {'id': vol_id, 'type': 'Box', 'parameters': 'XHalfLength=%g' % size}
+        self.children[vol_id] = [(0, vol_id, table, child, k) for (k, (table, child)) in enumerate(children)]
+
+    def hasher(self):
+        return SubtreeHasher(lambda table, i: self.rows[table][i], lambda i, table: self.children[i])
+
+
+def tree(leaf_size=1, top=1, ids=(1, 2, 3, 4)):
+    tables = Tables()
+    (world, mother, leaf, other) = ids
+    tables.volume(leaf, 'Leaf', leaf_size)
+    tables.volume(other, 'Other', 2)
+    tables.volume(mother, 'Mother', 10, [(9, 1), (1, leaf), (1, leaf)])
+    tables.volume(world, 'World', 100, [(1, mother), (1, other)])
+    return tables
+
+
+def test_subtree_hashes():
+    base = tree().hasher()
+    changed = tree(leaf_size=3).hasher()
+    renumbered = tree(ids=(11, 7, 5, 20)).hasher()
+    assert [renumbered.subtree(1, i) for i in (11, 7, 5, 20)] == [base.subtree(1, i) for i in (1, 2, 3, 4)]
+    # a changed leaf changes the hashes of its ancestors, not those of the others
+    assert changed.subtree(1, 3) != base.subtree(1, 3)
+    assert changed.subtree(1, 2) != base.subtree(1, 2)
+    assert changed.subtree(1, 1) != base.subtree(1, 1)
+    assert changed.subtree(1, 4) == base.subtree(1, 4)
+
+
+def placements(hasher, sizes=None):
+    """ the documents of tree() in document order: (doc, key) """
+    docs = [(0, 2, 'Mother'), (1, 3, 'Leaf'), (1, 3, 'Leaf'), (0, 4, 'Other')]
+    return [({'depth': depth, 'tags': [], 'name': name, 'size': (sizes or {}).get(vol_id)}, (1, vol_id))
+            for (depth, vol_id, name) in docs]
+
+
+def baseline():
+    reindex = Reindex(tree().hasher())
+    for (doc, key) in placements(None):
+        assert reindex.place(doc, key) == NEW
+    return reindex.manifest({})
+
+
+def test_reindex_changed_leaf():
+    old = baseline()
+    reindex = Reindex(tree(leaf_size=3).hasher(), old)
+    statuses = []
+    for (doc, key) in placements(None, {3: 3}):
+        statuses.append(reindex.place(doc, key))
+    # the mother's document is the same, its subtree is not: it is compared, not skipped
+    assert statuses == [SAME, CHANGED, CHANGED, SKIPPED]
+    assert reindex.deleted() == []
+    new = reindex.manifest({})
+    assert new.ids.tolist() == old.ids.tolist()
+    assert new.subtrees[3] == old.subtrees[3] and new.subtrees[0] != old.subtrees[0]
+
+
+def test_reindex_keep_copies_baseline_slice():
+    old = baseline()
+    reindex = Reindex(tree().hasher(), old)
+    (doc, key) = placements(None)[0]
+    assert reindex.place(doc, key) == SKIPPED  # the mother and its two leaves
+    (doc, key) = placements(None)[3]
+    assert reindex.place(doc, key) == SKIPPED
+    assert reindex.stats['kept'] == 4
+    new = reindex.manifest({})
+    for column in ('ids', 'docs', 'subtrees', 'depths'):
+        assert getattr(new, column).tolist() == getattr(old, column).tolist()
+
+
+def test_reindex_deleted():
+    old = baseline()
+    reindex = Reindex(tree().hasher(), old)
+    (doc, key) = placements(None)[3]
+    assert reindex.place(doc, key) == SKIPPED  # only Other is left
+    assert sorted(reindex.deleted()) == sorted(doc_id(int(i)) for i in old.ids[:3])
+
+
+def test_manifest_roundtrip(tmp_path):
+    old = baseline()
+    old.options = {'max_depth': 20}
+    old.save(str(tmp_path / 'm.npz'))
+    loaded = Manifest.load(str(tmp_path / 'm.npz'))
+    assert loaded.ids.tolist() == old.ids.tolist()
+    assert loaded.ends.tolist() == [3, 2, 3, 4]
+    assert loaded.options == {'max_depth': 20}
+    assert loaded.find(int(old.ids[2])) == 2 and loaded.find(12345) == -1
+
+
+#----------------------------------------------------------------------
+# --diff-from on copies of the synthetic geometry
+
+
+def copy_db(synth_db, tmp_path, name, statements):
+    path = str(tmp_path / name)
+    shutil.copy(synth_db, path)
+    db = sqlite3.connect(path)
+    for statement in statements:
+        db.execute(statement)
+    db.commit()
+    db.close()
+    return path
+
+
+def by_id(lines):
+    docs = [json.loads(line) for line in lines]
+    return dict((doc['_id'], doc) for doc in docs)
+
+
+def diff(export, path, manifest, tmp_path):
+    stats = str(tmp_path / 'stats.json')
+    lines = export(path, '--diff-from', manifest, '--stats', stats)
+    with open(stats) as summary:
+        changes = json.load(summary)['changes']
+    docs = [json.loads(line) for line in lines]
+    stored = dict((doc['_id'], doc) for doc in docs if doc.get('_op_type') != 'delete')
+    deleted = set(doc['_id'] for doc in docs if doc.get('_op_type') == 'delete')
+    return (stored, deleted, changes)
+
+
+@pytest.fixture
+def baseline_export(synth_db, export, tmp_path):
+    manifest = str(tmp_path / 'old.npz')
+    return (by_id(export(synth_db, '--manifest-out', manifest)), manifest)
+
+
+RENUMBER = [
+    'UPDATE PhysVols SET id = 1000 - id',
+    'UPDATE ChildrenPositions SET parentId = 1000 - parentId WHERE parentTable = 1',
+    'UPDATE ChildrenPositions SET childId = 1000 - childId WHERE childTable = 1',
+    'UPDATE SerialTransformers SET volId = 1000 - volId WHERE volTable = 1',
+    'UPDATE RootVolume SET volId = 1000 - volId WHERE volTable = 1',
+    'UPDATE LogVols SET id = 500 + id',
+    'UPDATE PhysVols SET logvol = 500 + logvol',
+    'UPDATE FullPhysVols SET logvol = 500 + logvol',
+    'UPDATE ChildrenPositions SET id = 5000 - id',
+]
+
+
+def test_ids_survive_renumbering(synth_db, export, tmp_path, baseline_export):
+    (old, manifest) = baseline_export
+    path = copy_db(synth_db, tmp_path, 'renumbered.db', RENUMBER)
+    assert by_id(export(path)) == old
+    (stored, deleted, changes) = diff(export, path, manifest, tmp_path)
+    assert (stored, deleted) == ({}, set())
+    assert changes['changed'] == changes['new'] == changes['deleted'] == 0
+
+
+def test_diff_emits_changed_docs(synth_db, export, tmp_path, baseline_export):
+    (old, manifest) = baseline_export
+    # a leaf shape, placed under several mothers
+    path = copy_db(synth_db, tmp_path, 'changed.db', [
+        "UPDATE Shapes SET parameters = 'XHalfLength=1;YHalfLength=2;ZHalfLength=3', type = 'Box' "
+        "WHERE id = (SELECT shape FROM LogVols WHERE name = 'LV0_5')"])
+    new = by_id(export(path))
+    assert set(new) == set(old)
+    changed = set(i for i in new if new[i] != old[i])
+    assert changed and all(new[i]['name'] == 'LV0_5' for i in changed)
+    (stored, deleted, changes) = diff(export, path, manifest, tmp_path)
+    assert set(stored) == changed and deleted == set()
+    assert all(stored[i] == new[i] for i in stored)
+    assert changes['changed'] == len(changed) and changes['new'] == 0
+    assert changes['same'] > 0 and changes['skipped'] > 0  # the ancestors are compared, the rest skipped
+
+
+def test_diff_deletes_removed_subtree(synth_db, export, tmp_path, baseline_export):
+    (old, manifest) = baseline_export
+    # the first volume placed in the world volume, with everything below it
+    path = copy_db(synth_db, tmp_path, 'removed.db', [
+        'DELETE FROM ChildrenPositions WHERE id = (SELECT MIN(id) FROM ChildrenPositions WHERE childTable IN (1, 2) '
+        'AND parentTable = (SELECT volTable FROM RootVolume) AND parentId = (SELECT volId FROM RootVolume))'])
+    new = by_id(export(path))
+    gone = set(old) - set(new)
+    assert len(gone) > 1 and set(new) < set(old)
+    (stored, deleted, changes) = diff(export, path, manifest, tmp_path)
+    assert deleted == gone
+    # later siblings with the same step are renumbered, everything else is unchanged
+    assert set(stored) == set(i for i in new if new[i] != old[i])
+    assert changes['deleted'] == len(gone)
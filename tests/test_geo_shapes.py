@@ -0,0 +1,116 @@
+"""
+Extents and volumes of geo_shapes against closed-form values.
+"""
+
+import math
+
+import pytest
+
+import geo_transforms
+from geo_shapes import ShapeParser, parse_parameters
+
+PI = math.pi
+R2 = math.sqrt(2.0)
+
+# (type, parameters, extent, volume)
+CASES = [
+    ('Box', 'XHalfLength=10;YHalfLength=20;ZHalfLength=30', (-10, -20, -30, 10, 20, 30), 8 * 10 * 20 * 30),
+    ('Tube', 'RMin=5;RMax=10;ZHalfLength=20', (-10, -10, -20, 10, 10, 20), PI * (100 - 25) * 40),
+    # a quarter from the x axis: the extent is the quadrant, the volume a quarter of the tube
+    ('Tubs', 'RMin=5;RMax=10;ZHalfLength=20;SPhi=0;DPhi=%r' % (PI / 2), (0, 0, -20, 10, 10, 20),
+     PI * (100 - 25) * 40 / 4),
+    # a quarter around the y axis: reaches rmax on y, the inner corners bound y from below
+    ('Tubs', 'RMin=5;RMax=10;ZHalfLength=1;SPhi=%r;DPhi=%r' % (PI / 4, PI / 2),
+     (-10 / R2, 5 / R2, -1, 10 / R2, 10, 1), PI * 75 * 2 / 4),
+    ('Tubs', 'RMin=0;RMax=10;ZHalfLength=1;SPhi=0;DPhi=%r' % (2 * PI), (-10, -10, -1, 10, 10, 1), PI * 100 * 2),
+    # a full cone, pi r^2 h / 3
+    ('Cons', 'RMin1=0;RMin2=0;RMax1=10;RMax2=0;DZ=15;SPhi=0;DPhi=%r' % (2 * PI), (-10, -10, -15, 10, 10, 15),
+     PI * 100 * 30 / 3),
+    # half of a hollow frustum, pi h / 3 (R1^2 + R1 R2 + R2^2) less the same of the hole
+    ('Cons', 'RMin1=2;RMin2=4;RMax1=10;RMax2=20;DZ=5;SPhi=0;DPhi=%r' % PI, (-20, 0, -5, 20, 20, 5),
+     PI * 10 / 3 * ((100 + 200 + 400) - (4 + 8 + 16)) / 2),
+    # a prism with a trapezoid section, (20 + 40) / 2 * 20 * 10
+    ('Trd', 'XHalfLength1=10;XHalfLength2=20;YHalfLength1=5;YHalfLength2=5;ZHalfLength=10',
+     (-20, -5, -10, 20, 5, 10), 6000),
+    # a frustum of a square pyramid, h / 3 (A1 + A2 + sqrt(A1 A2))
+    ('Trd', 'XHalfLength1=10;XHalfLength2=20;YHalfLength1=10;YHalfLength2=20;ZHalfLength=10',
+     (-20, -20, -10, 20, 20, 10), 20 / 3 * (400 + 1600 + 800)),
+    # a Trap that is a box
+    ('Trap', 'ZHalfLength=20;Theta=0;Phi=0;Dydzn=5;Dxdyndzn=10;Dxdypdzn=10;Angleydzn=0;Dydzp=5;Dxdyndzp=10;'
+     'Dxdypdzp=10;Angleydzp=0', (-10, -5, -20, 10, 5, 20), 8000),
+    # the same box sheared along x by theta: same volume, the faces at z = +-20 move by +-10
+    ('Trap', 'ZHalfLength=20;Theta=%r;Phi=0;Dydzn=5;Dxdyndzn=10;Dxdypdzn=10;Angleydzn=0;Dydzp=5;Dxdyndzp=10;'
+     'Dxdypdzp=10;Angleydzp=0' % math.atan(0.5), (-20, -5, -20, 20, 5, 20), 8000),
+    # a Trd-like Trap: x half lengths 10 at -z and 20 at +z
+    ('Trap', 'ZHalfLength=10;Theta=0;Phi=0;Dydzn=5;Dxdyndzn=10;Dxdypdzn=10;Angleydzn=0;Dydzp=5;Dxdyndzp=20;'
+     'Dxdypdzp=20;Angleydzp=0', (-20, -5, -10, 20, 5, 10), 6000),
+    # a cylinder and a cone on top of it
+    ('Pcon', 'SPhi=0;DPhi=%r;NZPlanes=3;ZPos=-10;ZRmin=0;ZRmax=5;ZPos=10;ZRmin=0;ZRmax=5;ZPos=40;ZRmin=0;ZRmax=0'
+     % (2 * PI), (-5, -5, -10, 5, 5, 40), PI * 25 * 20 + PI * 25 * 30 / 3),
+    ('Pcon', 'SPhi=0;DPhi=%r;NZPlanes=2;ZPos=0;ZRmin=1;ZRmax=2;ZPos=10;ZRmin=1;ZRmax=2' % PI,
+     (-2, 0, 0, 2, 2, 10), PI * 3 * 10 / 2),
+    # a square prism of apothem 5, its corners on the axes
+    ('Pgon', 'SPhi=0;DPhi=%r;NSides=4;NZPlanes=2;ZPos=0;ZRmin=0;ZRmax=5;ZPos=10;ZRmin=0;ZRmax=5' % (2 * PI),
+     (-5 * R2, -5 * R2, 0, 5 * R2, 5 * R2, 10), 100 * 10),
+    # a hexagonal tube, area 6 tan(30 deg) a^2
+    ('Pgon', 'SPhi=0;DPhi=%r;NSides=6;NZPlanes=2;ZPos=-1;ZRmin=5;ZRmax=10;ZPos=1;ZRmin=5;ZRmax=10' % (2 * PI),
+     (-20 / math.sqrt(3), -10, -1, 20 / math.sqrt(3), 10, 1), 6 * math.tan(PI / 6) * (100 - 25) * 2),
+]
+
+
+def parser(shapes=(), transforms=None):
+    rows = dict(enumerate(shapes, 1))
+    return ShapeParser(lambda i: rows[i], lambda i: transforms[i])
+
+
+@pytest.mark.parametrize('shape_type, parameters, extent, volume', CASES,
+                         ids=['%s-%d' % (case[0], i) for (i, case) in enumerate(CASES)])
+def test_shape(shape_type, parameters, extent, volume):
+    shape = parser([(shape_type, parameters)]).parse(1)
+    assert shape['type'] == shape_type
+    assert shape['extent'] == pytest.approx(extent, abs=1e-9)
+    assert shape['volume'] == pytest.approx(volume, rel=1e-12)
+
+
+def test_shift():
+    mat = geo_transforms.from_row([0, -1, 0, 1, 0, 0, 0, 0, 1, 100, 0, -5])  # a quarter turn around z, then a shift
+    shapes = parser([('Box', 'XHalfLength=10;YHalfLength=20;ZHalfLength=30'), ('Shift', 'A=1;X=7')], {7: mat})
+    shape = shapes.parse(2)
+    assert shape['extent'] == pytest.approx((80, -10, -35, 120, 10, 25))
+    assert shape['volume'] == 48000
+
+
+def test_booleans():
+    shapes = parser([('Box', 'XHalfLength=10;YHalfLength=10;ZHalfLength=10'), ('Tube', 'RMin=0;RMax=5;ZHalfLength=30'),
+                     ('Shift', 'A=1;X=1'), ('Union', 'opA=1;opB=2'), ('Intersection', 'opA=1;opB=2'),
+                     ('Subtraction', 'opA=1;opB=2'), ('Intersection', 'opA=1;opB=3')],
+                    {1: geo_transforms.from_row([1, 0, 0, 0, 1, 0, 0, 0, 1, 50, 0, 0])})
+    assert shapes.parse(4)['extent'] == (-10, -10, -30, 10, 10, 30)
+    assert shapes.parse(4)['volume'] is None
+    assert shapes.parse(5)['extent'] == (-5, -5, -10, 5, 5, 10)
+    assert shapes.parse(6)['extent'] == (-10, -10, -10, 10, 10, 10)
+    assert shapes.parse(6)['volume'] is None
+    assert (shapes.parse(7)['extent'], shapes.parse(7)['volume']) == (None, 0.0)  # the boxes are apart
+
+
+def test_unparsed():
+    shapes = parser([('Torus', 'RMin=1;RMax=2'), ('Box', 'XHalfLength=1'), ('Shift', 'A=1;X=1')], {})
+    for i in (1, 2, 3):
+        assert (shapes.parse(i)['extent'], shapes.parse(i)['volume']) == (None, None)
+    assert shapes.unknown == {'Torus'}
+
+
+def test_parameters():
+    assert parse_parameters('A=1;B=2;B=3;N=name;junk') == {'A': 1.0, 'B': [2.0, 3.0], 'N': 'name'}
+    assert parse_parameters('') == {}
+
+
+def test_parsed_once():
+    calls = []
+
+    def get_shape(i):
+        calls.append(i)
+        return ('Box', 'XHalfLength=1;YHalfLength=1;ZHalfLength=1')
+    shapes = ShapeParser(get_shape, None)
+    assert shapes.parse(3) is shapes.parse(3)
+    assert calls == [3]
@@ -0,0 +1,54 @@
+"""
+geo_stats.RunStats counted from several threads at once.
+"""
+
+import threading
+
+from geo_stats import RunStats, ThreadCounters
+
+
+def run_threads(target, threads=8):
+    workers = [threading.Thread(target=target, args=(k,)) for k in range(threads)]
+    for w in workers:
+        w.start()
+    for w in workers:
+        w.join()
+
+
+def test_thread_counters_totals():
+    counters = ThreadCounters(('issued', 'avoided'))
+    assert counters.totals() == {'issued': 0, 'avoided': 0}
+
+    def work(k):
+        for _ in range(20000):
+            counters['issued'] += 1
+        counters['thread%d' % k] += k
+    run_threads(work)
+    assert counters.totals() == dict({'issued': 8 * 20000, 'avoided': 0},
+                                     **dict(('thread%d' % k, k) for k in range(8)))
+    counters.clear()
+    assert counters.totals() == {'issued': 0, 'avoided': 0}
+
+
+def test_run_stats_threads():
+    stats = RunStats()
+
+    def work(k):
+        for _ in range(10000):
+            stats.count('docs')
+            stats.add_time('sink', 0.5)
+            with stats.timer('transform'):
+                pass
+        stats.tick()
+    run_threads(work)
+    summary = stats.summary()
+    assert summary['counters'] == {'docs': 80000}
+    assert summary['timers']['sink'] == 40000.0
+    assert summary['timers']['transform'] > 0
+
+    merged = RunStats()
+    merged.count('docs', 5)
+    merged.merge(stats.snapshot())
+    assert merged.snapshot()['counters'] == {'docs': 80005}
+    stats.reset()
+    assert stats.snapshot() == {'counters': {}, 'timers': {}}
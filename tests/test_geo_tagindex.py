@@ -0,0 +1,134 @@
+"""
+geo_tagindex queries against a brute force path_matches over every document.
+"""
+
+import json
+import random
+
+import numpy as np
+import pytest
+
+from geo_tagindex import TagIndex, TagIndexBuilder, merge_ranges, path_matches, split_path
+
+STEPS = ['A', 'B', 'Module1', 'Module2', 'Module12', 'Tile']
+
+PATTERNS = ['', 'A', 'A/B', 'B/A', 'A/*', '*', '*/Module1', 'Module?', 'Module[12]', 'Module1*', '**',
+            '**/Module12', '**/B/**', 'A/**/B', 'A/**', '**/A/*/Module*', '**/*', '**/**/B', 'A/**/**/Module2',
+            'Tile/**/Module?', 'Nothing', 'A/Nothing/*', '**/Nothing', '*/*/*']
+
+
+def random_documents(seed, count=3000):
+    """ documents in depth first order, each volume gets a NameTag with a chance """
+    rng = random.Random(seed)
+    docs = []
+    stack = []  # tags of the volumes on the way down
+    for _ in range(count):
+        depth = rng.randint(0, len(stack)) if stack else 0
+        del stack[depth:]
+        parent = stack[-1] if stack else []
+        tags = parent + [rng.choice(STEPS)] if rng.random() < 0.6 else list(parent)
+        stack.append(tags)
+        docs.append({'depth': depth, 'tags': tags})
+    return docs
+
+
+def brute_force(docs, pattern, exact):
+    """ document numbers whose path (or with exact=False a prefix of it) matches """
+    steps = split_path(pattern)
+    if not exact or (steps and steps[-1] == '**'):
+        return [i for (i, doc) in enumerate(docs)
+                if any(path_matches(steps, doc['tags'][:k]) for k in range(len(doc['tags']) + 1))]
+    return [i for (i, doc) in enumerate(docs) if path_matches(steps, doc['tags'])]
+
+
+@pytest.fixture(scope='module', params=[1, 2, 3])
+def indexed(request, tmp_path_factory):
+    docs = random_documents(request.param)
+    index = TagIndex.from_documents(docs)
+    # queries of a loaded index are the same
+    path = str(tmp_path_factory.mktemp('tags') / 'index.tags')
+    index.save(path)
+    return (docs, TagIndex.load(path) if request.param == 3 else index)
+
+
+@pytest.mark.parametrize('exact', [False, True])
+@pytest.mark.parametrize('pattern', PATTERNS)
+def test_query_matches_brute_force(indexed, pattern, exact):
+    (docs, index) = indexed
+    ranges = index.query(pattern, exact)
+    selected = TagIndex.documents(ranges).tolist()
+    assert selected == brute_force(docs, pattern, exact)
+    # the ranges are merged: sorted, not empty, not touching
+    assert all(start < end for (start, end) in ranges.tolist())
+    assert all(ranges[k][1] < ranges[k + 1][0] for k in range(len(ranges) - 1))
+
+
+def test_prefix_exact_children(indexed):
+    (docs, index) = indexed
+    for doc in docs[:200]:
+        tags = doc['tags']
+        path = '/'.join(tags)
+        under = [i for (i, other) in enumerate(docs) if other['tags'][:len(tags)] == tags]
+        assert TagIndex.documents(index.prefix(path)).tolist() == under
+        assert TagIndex.documents(index.exact(path)).tolist() == [i for i in under if docs[i]['tags'] == tags]
+    children = index.children('A')
+    assert sorted(name for (name, _) in children) == \
+        sorted(set(doc['tags'][1] for doc in docs if len(doc['tags']) > 1 and doc['tags'][0] == 'A'))
+    assert all(count == TagIndex.count(index.prefix(['A', name])) for (name, count) in children)
+
+
+def test_tops(indexed):
+    (docs, index) = indexed
+    ranges = index.query('**/B')
+    tops = index.tops(ranges).tolist()
+    selected = set(TagIndex.documents(ranges).tolist())
+    # a top is selected and its closest selected ancestor is none
+    expected = []
+    for i in sorted(selected):
+        depth = docs[i]['depth']
+        j = i - 1
+        while j >= 0 and docs[j]['depth'] >= depth:
+            j -= 1
+        ancestors = []
+        while j >= 0:
+            ancestors.append(j)
+            depth = docs[j]['depth']
+            while j >= 0 and docs[j]['depth'] >= depth:
+                j -= 1
+        if not selected.intersection(ancestors):
+            expected.append(i)
+    assert tops == expected
+
+
+@pytest.mark.parametrize('seed', range(20))
+def test_merge_ranges(seed):
+    rng = np.random.default_rng(seed)
+    starts = rng.integers(0, 200, size=rng.integers(1, 30))
+    ranges = np.stack([starts, starts + rng.integers(1, 20, size=len(starts))], axis=1)
+    covered = sorted(set(i for (start, end) in ranges.tolist() for i in range(start, end)))
+    merged = merge_ranges(ranges)
+    assert TagIndex.documents(merged).tolist() == covered
+    assert all(merged[k][1] < merged[k + 1][0] for k in range(len(merged) - 1))
+    assert merge_ranges(np.zeros((0, 2), dtype=np.int64)).shape == (0, 2)
+
+
+def test_path_matches_partial():
+    assert path_matches('Tile/*/Module3', ['Tile', 'Barrel'], partial=True)
+    assert not path_matches('Tile/*/Module3', ['Tile', 'Barrel'])
+    assert not path_matches('Tile/*/Module3', ['LAr'], partial=True)
+    assert path_matches('**/Module3', ['Tile', 'Barrel', 'Module3'])
+
+
+def test_tag_query_export(synth_db, export, tmp_path):
+    """ --tag-query re-exports exactly the documents of the full export under the paths """
+    index = str(tmp_path / 'synth.tags')
+    full = [json.loads(line) for line in export(synth_db, '--tag-index-out', index)]
+    builder = TagIndexBuilder()
+    for doc in full:
+        builder.add_document(doc)
+    tags = [doc['tags'] for doc in full]
+    assert TagIndex.load(index).ids.tolist() == builder.index().ids.tolist()
+    for pattern in ('**/Copy1*', 'Tag4_*/*', sorted(set('/'.join(t[:2]) for t in tags if len(t) > 1))[0]):
+        selected = [json.loads(line) for line in export(synth_db, '--tag-index', index, '--tag-query', pattern)]
+        expected = [full[i] for i in brute_force(full, pattern, False)]
+        assert expected and selected == expected
@@ -0,0 +1,108 @@
+"""
+Serial transformer functions of geo_transforms against transforms built by hand.
+"""
+
+import re
+import math
+
+import numpy as np
+import pytest
+
+import geo_transforms
+from geo_transforms import serial_transforms
+
+
+def translate(x, y, z):
+    m = np.eye(4)
+    m[:3, 3] = (x, y, z)
+    return m
+
+
+def rotate(axis, angle):
+    (c, s) = (math.cos(angle), math.sin(angle))
+    rot = {'x': [[1, 0, 0], [0, c, -s], [0, s, c]],
+           'y': [[c, 0, s], [0, 1, 0], [-s, 0, c]],
+           'z': [[c, -s, 0], [s, c, 0], [0, 0, 1]]}[axis]
+    m = np.eye(4)
+    m[:3, :3] = rot
+    return m
+
+
+def transform3d(*numbers):
+    return geo_transforms.from_row(numbers)
+
+
+def by_hand(copies, make):
+    return np.stack([make(k) for k in range(copies)])
+
+
+TILT = (1, 0, 0, 0, 0, -1, 0, 1, 0, 10, 0, -500)  # a quarter turn around x, then a shift
+
+CASES = [
+    ('TranslateX3D(100)', lambda k: translate(100, 0, 0)),
+    ('Pow(TranslateZ3D(30),X)', lambda k: translate(0, 0, 30 * k)),
+    ('RotateZ3D(0.1963*X) * TranslateX3D(2000)', lambda k: rotate('z', 0.1963 * k) @ translate(2000, 0, 0)),
+    ('Pow(RotateZ3D(0.3927), X+0.5)', lambda k: rotate('z', 0.3927 * (k + 0.5))),
+    ('Pow(RotateY3D(0.2),X) * TranslateY3D(50)', lambda k: rotate('y', 0.2 * k) @ translate(0, 50, 0)),
+    ('TranslateX3D(100*Cos(X)) * TranslateY3D(-100*Sin(X))',
+     lambda k: translate(100 * math.cos(k), -100 * math.sin(k), 0)),
+    ('RotateX3D(-(X-1)/2) * RotateZ3D(Sqrt(4)*X)', lambda k: rotate('x', -(k - 1) / 2.0) @ rotate('z', 2.0 * k)),
+    ('Transform3D(%s) * Pow(RotateZ3D(0.3927), X+0.5)' % ','.join('%g' % v for v in TILT),
+     lambda k: transform3d(*TILT) @ rotate('z', 0.3927 * (k + 0.5))),
+    ('Transform3D(1,0,0,0,1,0,0,0,1,0,0,10*X) * (RotateZ3D(X) * TranslateX3D(1e2))',
+     lambda k: translate(0, 0, 10 * k) @ rotate('z', k) @ translate(100, 0, 0)),
+    ('GeoXF::Pow(HepGeom::TranslateZ3D(2.5e1), X)', lambda k: translate(0, 0, 25 * k)),
+]
+
+
+@pytest.mark.parametrize('expression, make', CASES, ids=[case[0] for case in CASES])
+def test_serial_transforms(expression, make):
+    mats = serial_transforms(expression, 7)
+    assert mats.shape == (7, 4, 4)
+    np.testing.assert_allclose(mats, by_hand(7, make), rtol=0, atol=1e-9)
+
+
+def test_pow_scales_angle_and_translation():
+    # GeoXF::Pow scales the rotation angle and the translation, it is not a matrix power
+    base = rotate('z', 0.5) @ translate(10, 0, 0)
+    row = geo_transforms.to_row(base)
+    mats = serial_transforms('Pow(Transform3D(%s), X)' % ','.join(repr(v) for v in row), 4)
+    for k in range(4):
+        expected = rotate('z', 0.5 * k)
+        expected[:3, 3] = k * base[:3, 3]
+        np.testing.assert_allclose(mats[k], expected, rtol=0, atol=1e-9)
+
+
+def test_pow_half_turn():
+    mats = serial_transforms('Pow(RotateY3D(3.141592653589793), X/2)', 3)
+    np.testing.assert_allclose(mats, by_hand(3, lambda k: rotate('y', math.pi * k / 2)), rtol=0, atol=1e-9)
+
+
+def test_vectorized_same_as_per_copy():
+    # one evaluation for all copies gives the transforms of one copy at a time
+    for (expression, _) in CASES:
+        mats = serial_transforms(expression, 9)
+        for k in range(9):
+            one = serial_transforms(re.sub(r'\bX\b', '(%d)' % k, expression), 1)
+            np.testing.assert_allclose(mats[k], one[0], rtol=0, atol=1e-9)
+
+
+def test_no_copies():
+    assert serial_transforms('Pow(TranslateZ3D(30),X)', 0).shape == (0, 4, 4)
+
+
+@pytest.mark.parametrize('expression', [
+    'Pow(TranslateZ3D(X),X)',  # the transform of Pow must not depend on X
+    'Pow(X, 2)',
+    'X + 1',  # not a transform
+    'TranslateX3D(1) + TranslateX3D(2)',
+    '2 * TranslateX3D(1)',
+    '-RotateZ3D(1)',
+    'Transform3D(1,0,0,0,1,0,0,0,1,0,0)',
+    'ShiftZ3D(1)',
+    'TranslateX3D(1',
+    'TranslateX3D(1) $',
+])
+def test_invalid(expression):
+    with pytest.raises(ValueError):
+        serial_transforms(expression, 4)
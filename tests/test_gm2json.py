@@ -0,0 +1,62 @@
+"""
+gm2json exports of a synthetic geometry: every way of reading and
+traversing it makes the same documents, down to the last bit.
+"""
+
+import pytest
+
+import gm2json
+
+
+def documents(path, **options):
+    with gm2json.open_geometry(path, **options) as geometry:
+        return list(geometry.documents())
+
+
+def test_subtree_cache_same_floats(synth_db):
+    cached = documents(synth_db)
+    uncached = documents(synth_db, cache_size=0)
+    assert len(cached) == 15858
+    assert cached == uncached
+
+
+def test_small_cache_same_floats(synth_db):
+    # subtrees evicted and too big to keep are expanded again
+    assert documents(synth_db, cache_size=50) == documents(synth_db)
+
+
+def test_one_geometry_open(synth_db, synth_snapshot):
+    geometry = gm2json.open_geometry(synth_db, max_depth=1)
+    with pytest.raises(RuntimeError):
+        gm2json.open_geometry(synth_snapshot)
+    first = list(geometry.documents())
+    geometry.close()
+    with pytest.raises(ValueError):
+        geometry.row('LogVols', 1)
+    with gm2json.open_geometry(synth_snapshot, max_depth=1) as snapshot:
+        assert list(snapshot.documents()) == first
+    geometry.close()  # closing again does nothing
+    assert gm2json.OPENED is None
+
+
+@pytest.mark.parametrize('options', [['-p'], ['--orm'], ['--orm', '-p'], ['--no-index-copy'], ['--pipeline'],
+                                     ['--pipeline', '-p', '--pipeline-batch', '7']])
+def test_modes_same_documents(synth_db, export, options):
+    # the prepared statements of geo_db, the ORM and the preloaded tables read the same rows
+    assert export(synth_db, *options) == export(synth_db)
+
+
+def test_snapshot_same_documents(synth_db, synth_snapshot, export):
+    assert export(synth_snapshot) == export(synth_db)
+
+
+def test_workers_same_as_serial(synth_db, export):
+    serial = export(synth_db)
+    assert len(serial) == 15858
+    assert export(synth_db, '-w', '4', '--split-depth', '1') == serial
+    assert export(synth_db, '-w', '3', '--split-depth', '2') == serial
+    assert export(synth_db, '-w', '2', '--cache-size', '0') == serial
+
+
+def test_snapshot_workers_same_as_serial(synth_db, synth_snapshot, export):
+    assert export(synth_snapshot, '-w', '3') == export(synth_db)
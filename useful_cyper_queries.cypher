@@ -16,9 +16,15 @@ match (n:NameTag {id: "45916"}) return n;
 
 // return all NameTag nodes which are children of the RootVolume, and order them by position; also, return the relationships.
 match (n:RootVolume)-[r:CHILD]->(m:NameTag) with r,m order by r.position return r.position, m, labels(m), r;
+// without Neo4j, from the NameTag path index of a gm2json export (gm2json.py --tag-index-out atlas.tags):
+// geo_tagindex.py atlas.tags --children ""
 
 // the same, but filter on "name" property of NameTag node
 match (n:RootVolume)-[r:CHILD]->(m:NameTag) where m.name = "Tile" with r,m order by r.position return r.position, m, labels(m), r;
+// without Neo4j: the volumes tagged Tile, everything under them, or a tag anywhere in the path
+// geo_tagindex.py atlas.tags --query Tile --exact
+// geo_tagindex.py atlas.tags --query Tile --ids
+// geo_tagindex.py atlas.tags --query "**/TileBarrel"
 
 // get the LogVol node which is linked through a PhysVol node through a LOGVOL relationship and whose "name" property is "TileEndcapNeg"
 match (n:PhysVol)-[r:LOGVOL]->(m:LogVol) where m.name = "TileEndcapNeg" return m, labels(m);